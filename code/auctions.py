@@ -0,0 +1,102 @@
+class Auction:
+    __slots__ = ('id', 'card_id', 'card_name', 'seller_id', 'price', 'bidder_id', 'channel', 'timer', 'closed')
+
+    def __init__(self, auction_id, card, seller_id, price, channel):
+        self.id = auction_id
+        self.card_id = card['id']
+        self.card_name = card['name']
+        self.seller_id = seller_id
+        self.price = price
+        self.bidder_id = None
+        self.channel = channel
+        self.timer = None
+        self.closed = False
+
+
+class AuctionHouse:
+    """A guild's running auctions, keyed by id, and the coins held by their leading bids.
+
+    A leading bid holds its amount until it is outbid or the auction settles,
+    so a user can never commit more coins across auctions and purchases than
+    they have.
+    """
+
+    def __init__(self):
+        self.auctions = {}
+        self.by_card = {}
+        self.holds = {}
+        self.next_id = 1
+
+    def __len__(self):
+        return len(self.auctions)
+
+    def open(self, card, seller_id, price, channel):
+        auction = Auction(self.next_id, card, seller_id, price, channel)
+        self.next_id += 1
+        self.auctions[auction.id] = auction
+        self.by_card[auction.card_id] = auction
+        return auction
+
+    def get(self, auction_id):
+        return self.auctions.get(auction_id)
+
+    def for_card(self, card_id):
+        return self.by_card.get(card_id)
+
+    def held(self, user_id):
+        return self.holds.get(user_id, 0)
+
+    def available(self, user_id, coins):
+        return coins - self.held(user_id)
+
+    def _release(self, auction):
+        if auction.bidder_id is not None:
+            self.holds[auction.bidder_id] -= auction.price
+            if not self.holds[auction.bidder_id]:
+                del self.holds[auction.bidder_id]
+
+    def bid(self, auction, user_id, amount):
+        """Make user_id the leading bidder, moving the hold from the previous one."""
+        self._release(auction)
+        auction.price = amount
+        auction.bidder_id = user_id
+        self.holds[user_id] = self.holds.get(user_id, 0) + amount
+
+    def close(self, auction):
+        """Take the auction off the house; False if it was already closed."""
+        if auction.closed:
+            return False
+        auction.closed = True
+        self._release(auction)
+        self.auctions.pop(auction.id, None)
+        if self.by_card.get(auction.card_id) is auction:
+            del self.by_card[auction.card_id]
+        return True
+
+
+class AuctionEngine:
+    """Auction houses per guild, kept apart from the guild cache so evicting or reloading a guild keeps its auctions."""
+
+    def __init__(self):
+        self.houses = {}
+        self.settled = 0
+
+    def house(self, guild_id):
+        if guild_id not in self.houses:
+            self.houses[guild_id] = AuctionHouse()
+        return self.houses[guild_id]
+
+    def available(self, guild_id, user_id, coins):
+        house = self.houses.get(guild_id)
+        return house.available(user_id, coins) if house else coins
+
+    def stats(self):
+        return {
+            'active': sum(len(house) for house in self.houses.values()),
+            'guilds': sum(1 for house in self.houses.values() if house),
+            'held': sum(sum(house.holds.values()) for house in self.houses.values()),
+            'settled': self.settled,
+        }
+
+
+auctions = AuctionEngine()
@@ -1,13 +1,15 @@
 import os
 import discord
-from discord.ext import commands, tasks
-from discord import app_commands
+from discord.ext import commands
 import asyncio
-from datetime import datetime, timedelta
-from utils import load_data, save_data
-from config import initialize_guild_data, load_guild_data, guild_data
+import signal
+from config import guild_data
 from commands import setup_commands
-from utils import get_time_until_next_reset
+from persistence import manager as persistence
+from timers import scheduler
+from transactions import manager as transactions
+from members import members
+from quiz import quizzes
 
 intents = discord.Intents.default()
 intents.messages = True
@@ -15,44 +17,46 @@ intents.guilds = True
 intents.message_content = True
 intents.members = True
 
-bot = commands.Bot(command_prefix="!", intents=intents)
-
-@tasks.loop(minutes=1)
-async def reset_rolls():
-    now = datetime.utcnow()
-    next_reset = (now + timedelta(hours=1)).replace(minute=0, second=0, microsecond=0)
-    await asyncio.sleep((next_reset - now).total_seconds())
-    global roll_cooldowns
-    roll_cooldowns = {}
-    for guildid in guild_data:
-        for memberid in guild_data[guildid][2]:
-            user_data = guild_data[guildid][2]
-            user_data[str(memberid)]['rolls'] = 5
-            print("roll reset for" + memberid)
-
-@tasks.loop(minutes=1)
-async def reset_claim():
-    next_reset = get_time_until_next_reset()
-    print("Next claim reset in : next_reset")
-    await asyncio.sleep((next_reset).total_seconds())
-    for guildid in guild_data:
-        for memberid in guild_data[guildid][2]:
-                user_data = guild_data[guildid][2]
-                user_data[str(memberid)]['claims'] = 1
-                print("claim reset for" + memberid)
+class NapoBot(commands.Bot):
+    async def setup_hook(self):
+        persistence.start()
+        scheduler.start()
+        guild_data.start(persistence, transactions)
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, lambda: asyncio.create_task(self.close()))
+        except NotImplementedError:
+            pass
+
+    async def close(self):
+        await quizzes.close_all()
+        guild_data.stop()
+        await scheduler.stop()
+        await persistence.stop()
+        await super().close()
+
+bot = NapoBot(command_prefix="!", intents=intents)
 
 @bot.event
 async def on_ready():
     print(f'Bot is ready. Logged in as {bot.user}')
     try:
-        initialize_guild_data(bot)
         synced = await bot.tree.sync()
         print(f'Synced {len(synced)} commands.')
-        reset_rolls.start() 
-        reset_claim.start()
     except Exception as e:
         print(f'Error syncing commands: {e}')
 
+@bot.event
+async def on_member_update(before, after):
+    members.invalidate(after.guild.id, after.id)
+
+@bot.event
+async def on_member_remove(member):
+    members.invalidate(member.guild.id, member.id)
+
+@bot.event
+async def on_user_update(before, after):
+    members.invalidate_user(after.id)
+
 setup_commands(bot)
 
 bot.run(os.getenv('DISCORD_BOT_TOKEN'))
@@ -1,10 +1,11 @@
 import discord
-from discord.ext import commands, tasks
+from discord.ext import commands
 from discord import app_commands
 import random
 import asyncio
 from datetime import datetime, timedelta
-from utils import save_data, load_data, rank_sort_key, get_time_until_next_reset, scores, quiz_data, save_black_market, load_black_market
+from utils import get_time_until_next_reset, rolls_left, claims_left, roll_window, claim_window, max_rolls_per_hour, max_claims_per_3_hours, quiz_data
+from storage import export_guild, import_guild, run_io, run_ordered
 from views import ClaimButton, GemButton, Paginator, GlobalPaginator, ImagePaginator, CollectionPaginator, TopPaginator, BlackMarketPaginator
 import os
 from PIL import Image
@@ -12,18 +13,30 @@ import requests
 import io
 import aiohttp
 import sys
-from config import guild_data
-import yt_dlp
+from config import guild_data, CACHE_GUILD_DATA
+from state import GuildState
+from records import UserRecord
+from sampling import AliasSampler
+from persistence import manager as persistence, snapshot
+from transactions import manager as transactions
+from timers import scheduler
+from auctions import auctions
+from members import members
+import journal
+from quiz import quizzes
+from quiz_audio import QUIZ_TRACK_TIMEOUT, QUIZ_CLIP_SECONDS, audio_cache, clips, quiz_source, voice_meter
 from fuzzywuzzy import fuzz
 from fuzzywuzzy import process
 
 # Define global variables for tracking rolls
-active_auctions = {}
-roll_cooldowns = {}
-max_rolls_per_hour = 5
-claim_cooldowns = {}
-max_claims_per_3_hours = 1
 MAX_WISHES = 3
+ROLL_CLAIM_SECONDS = 45
+# Words accepted after !roll to narrow what can be rolled
+ROLL_FILTERS = ('unclaimed', 'new')
+AUCTION_SECONDS = 60
+AUCTION_EXTENSION_SECONDS = 30
+TRADE_REPLY_SECONDS = 60
+UPGRADE_CONFIRM_SECONDS = 30
 
 # Define probability distribution
 base_probabilities = {
@@ -53,7 +66,8 @@ def is_admin():
         return ctx.author.guild_permissions.administrator
     return commands.check(predicate)
 
-def reload_bot():
+async def reload_bot():
+    await persistence.stop()
     os.execv(sys.executable, ['python'] + sys.argv)
 
 def get_cooldown(bucket):
@@ -63,24 +77,28 @@ def get_cooldown(bucket):
     return True, None
 
 def setup_commands(bot):
-    def initialize_guild(guild_id):
-        if guild_id not in guild_data:
-            guild_data[guild_id] = load_data(guild_id)
+    async def initialize_guild(guild_id):
+        # Without the cache a guild is reloaded per command, but never under a transaction still
+        # holding its old state; leased guilds are kept by guild_data.load itself.
+        await guild_data.load(guild_id, refresh=not CACHE_GUILD_DATA and not transactions.busy(guild_id))
 
     def initialize_user(guild_id, user_id):
-        if user_id not in guild_data[guild_id][2]:
-            guild_data[guild_id][2][user_id] = {
+        if user_id not in guild_data[guild_id].user_data:
+            guild_data[guild_id].user_data[user_id] = UserRecord({
                 'coins': 0,
                 'luck_purchases': 0,
-                'luck': base_probabilities,
+                'luck': dict(base_probabilities),
                 'rolls': max_rolls_per_hour,
-                'claims': max_claims_per_3_hours
-            }
+                'rolls_window': roll_window(),
+                'claims': max_claims_per_3_hours,
+                'claims_window': claim_window()
+            })
+            persistence.record(guild_id, journal.update_user(user_id, guild_data[guild_id].user_data[user_id]))
 
     def get_user_probabilities(guild_id, user_id):
         initialize_user(guild_id, user_id)
         base_chances = base_probabilities.copy()
-        luck_bonus = guild_data[guild_id][2][user_id]['luck']
+        luck_bonus = guild_data[guild_id].user_data[user_id]['luck']
         for rank in base_chances:
             base_chances[rank] += luck_bonus.get(rank, 0)
         total = sum(base_chances.values())
@@ -88,29 +106,67 @@ def setup_commands(bot):
             base_chances[rank] /= total
         return base_chances
 
-    def roll_card(guild_id, user_id):
-        probabilities = get_user_probabilities(guild_id, user_id)
-        ranks = list(probabilities.keys())
-        rank_probabilities = []
-
-        # Adjust probabilities based on the available cards
-        for rank in ranks:
-            rank_count = sum(1 for card in guild_data[guild_id][0] if card['rank'] == rank)
-            if rank_count == 0:
-                rank_probabilities.append(0)
-            else:
-                rank_probabilities.append(probabilities[rank])
+    def character_choices(cards, prefix=''):
+        return [app_commands.Choice(name=(prefix + card['name'])[:100], value=(prefix + card['name'])[:100]) for card in cards]
 
-        total_prob = sum(rank_probabilities)
-        if total_prob == 0:
-            return None
+    async def character_autocomplete(interaction: discord.Interaction, current: str):
+        guild_id = str(interaction.guild.id)
+        await initialize_guild(guild_id)
+        return character_choices(guild_data[guild_id].complete(current))
 
-        # Normalize probabilities
-        rank_probabilities = [prob / total_prob for prob in rank_probabilities]
-        rank = random.choices(ranks, rank_probabilities)[0]
+    async def owned_character_autocomplete(interaction: discord.Interaction, current: str):
+        guild_id = str(interaction.guild.id)
+        await initialize_guild(guild_id)
+        return character_choices(guild_data[guild_id].complete(current, owner=str(interaction.user.id)))
+
+    async def owned_characters_autocomplete(interaction: discord.Interaction, current: str):
+        # Complete the last of the '$'-separated names, keeping the ones before it
+        guild_id = str(interaction.guild.id)
+        await initialize_guild(guild_id)
+        chosen, _, current = current.rpartition(" $ ")
+        prefix = chosen + " $ " if chosen else ""
+        return character_choices(guild_data[guild_id].complete(current.strip(), owner=str(interaction.user.id)), prefix)
 
-        possible_cards = [card for card in guild_data[guild_id][0] if card['rank'] == rank]
-        return random.choice(possible_cards)
+    def rank_sampler(guild_id, user_id):
+        state = guild_data[guild_id]
+
+        def build():
+            probabilities = get_user_probabilities(guild_id, user_id)
+            # Only ranks that have cards can be rolled
+            ranks = [rank for rank in probabilities if state.rank_buckets.count(rank)]
+            return AliasSampler(ranks, [probabilities[rank] for rank in ranks])
+
+        initialize_user(guild_id, user_id)
+        return state.samplers.get(user_id, state.rank_buckets.version, build)
+
+    def roll_card(guild_id, user_id, unclaimed_only=False, exclude_recent=False):
+        state = guild_data[guild_id]
+        recent = state.rolled_this_hour(user_id)
+
+        def accept(card):
+            if unclaimed_only and card['claimed_by']:
+                return False
+            return not (exclude_recent and card['id'] in recent)
+
+        sampler = rank_sampler(guild_id, user_id)
+        rank = sampler.sample()
+        if rank is None:
+            return None
+        card = state.rank_buckets.pick(rank, accept if unclaimed_only or exclude_recent else None)
+
+        if card is None:
+            # Nothing in the drawn rank passes the filters, so draw again among the other ranks
+            probabilities = get_user_probabilities(guild_id, user_id)
+            ranks = [other for other in sampler.outcomes if other != rank]
+            while card is None and ranks:
+                rank = random.choices(ranks, [probabilities[other] for other in ranks])[0]
+                ranks.remove(rank)
+                card = state.rank_buckets.pick(rank, accept)
+            if card is None:
+                return None
+
+        recent.add(card['id'])
+        return card
 
     @bot.tree.command(name="add_character", description="Add a new character card")
     @is_admin()
@@ -118,11 +174,11 @@ def setup_commands(bot):
     async def add_character(interaction: discord.Interaction, name: str, value: int, rank: str, description: str, image_urls: str):
         """Command to add a new card."""
         guild_id = str(interaction.guild.id)
-        initialize_guild(guild_id)
+        await initialize_guild(guild_id)
         image_url_list = image_urls.split(';')
         card = {'name': name, 'value': value, 'rank': rank, 'description': description, 'image_urls': image_url_list, 'claimed_by': None}
-        guild_data[guild_id][0].append(card)
-        save_data(guild_id, *guild_data[guild_id])
+        card = guild_data[guild_id].add_card(card)
+        persistence.record(guild_id, journal.add_card(card))
         await interaction.response.send_message(f'Character {name} added successfully!', ephemeral=True)
 
     @bot.command(name="add_character")
@@ -130,98 +186,107 @@ def setup_commands(bot):
     async def add_character_cmd(ctx, name: str, value: int, rank: str, description: str, image_urls: str):
         """Command to add a new card."""
         guild_id = str(ctx.guild.id)
-        initialize_guild(guild_id)
+        await initialize_guild(guild_id)
         image_url_list = image_urls.split(';')
         card = {'name': name, 'value': value, 'rank': rank, 'description': description, 'image_urls': image_url_list, 'claimed_by': None}
-        guild_data[guild_id][0].append(card)
-        save_data(guild_id, *guild_data[guild_id])
+        card = guild_data[guild_id].add_card(card)
+        persistence.record(guild_id, journal.add_card(card))
         await ctx.send(f'Character {name} added successfully!')
 
+    def did_you_mean(guild_id, name, owner):
+        # Destructive commands only act on exact names; the closest match is just suggested.
+        match = guild_data[guild_id].find_card(name, owner=owner)
+        return f" Did you mean **{match['name']}**?" if match else ""
+
     @bot.command(name="divorce")
     async def divorce(ctx, *, character_name: str):
         """Command to unclaim a character in exchange for its value."""
         guild_id = str(ctx.guild.id)
-        initialize_guild(guild_id)
+        await initialize_guild(guild_id)
         user_id = str(ctx.author.id)
-        card = next((c for c in guild_data[guild_id][1].get(user_id, []) if c['name'].lower() == character_name.lower()), None)
+        card = guild_data[guild_id].owned_card(user_id, character_name)
 
         if not card:
-            await ctx.send('Character not found in your collection.')
+            await ctx.send('Character not found in your collection.' + did_you_mean(guild_id, character_name, user_id))
             return
 
         if card['claimed_by'] != user_id:
             await ctx.send('You do not own this character.')
             return
 
-        guild_data[guild_id][1][user_id].remove(card)
+        guild_data[guild_id].uncollect(user_id, card)
         card['claimed_by'] = None
-        guild_data[guild_id][2][user_id]['coins'] += card['value']
+        guild_data[guild_id].user_data[user_id]['coins'] += card['value']
 
-        save_data(guild_id, *guild_data[guild_id])
-        await ctx.send(f'You have successfully divorced {character_name} and received {card["value"]} coins.')
+        persistence.record(guild_id, journal.uncollect(user_id, card), journal.update_card(card, 'claimed_by'), journal.coins(user_id, guild_data[guild_id].user_data[user_id], card['value']))
+        await ctx.send(f'You have successfully divorced {card["name"]} and received {card["value"]} coins.')
 
     @bot.tree.command(name="divorce", description="Unclaim a character in exchange for its value")
     @app_commands.describe(character_name="Character name")
+    @app_commands.autocomplete(character_name=owned_character_autocomplete)
     async def divorce_app(interaction: discord.Interaction, character_name: str):
         """Slash command to unclaim a character in exchange for its value."""
         guild_id = str(interaction.guild.id)
-        initialize_guild(guild_id)
+        await initialize_guild(guild_id)
         user_id = str(interaction.user.id)
-        card = next((c for c in guild_data[guild_id][1].get(user_id, []) if c['name'].lower() == character_name.lower()), None)
+        card = guild_data[guild_id].owned_card(user_id, character_name)
 
         if not card:
-            await interaction.response.send_message('Character not found in your collection.', ephemeral=True)
+            await interaction.response.send_message('Character not found in your collection.' + did_you_mean(guild_id, character_name, user_id), ephemeral=True)
             return
 
         if card['claimed_by'] != user_id:
             await interaction.response.send_message('You do not own this character.', ephemeral=True)
             return
 
-        guild_data[guild_id][1][user_id].remove(card)
+        guild_data[guild_id].uncollect(user_id, card)
         card['claimed_by'] = None
-        guild_data[guild_id][2][user_id]['coins'] += card['value']
+        guild_data[guild_id].user_data[user_id]['coins'] += card['value']
 
-        save_data(guild_id, *guild_data[guild_id])
-        await interaction.response.send_message(f'You have successfully divorced {character_name} and received {card["value"]} coins.', ephemeral=True)
+        persistence.record(guild_id, journal.uncollect(user_id, card), journal.update_card(card, 'claimed_by'), journal.coins(user_id, guild_data[guild_id].user_data[user_id], card['value']))
+        await interaction.response.send_message(f'You have successfully divorced {card["name"]} and received {card["value"]} coins.', ephemeral=True)
 
     @bot.command(name="roll")
-    async def roll(ctx):
-        """Command to roll (5 times) every hour."""
+    async def roll(ctx, *filters):
+        """Command to roll (5 times) every hour. `!roll unclaimed` and `!roll new` skip claimed cards and cards already rolled this hour."""
+        unknown = [word for word in filters if word.lower() not in ROLL_FILTERS]
+        if unknown:
+            await ctx.send(f'Unknown roll filter: {", ".join(unknown)}. Use {" or ".join(ROLL_FILTERS)}.')
+            return
+        filters = {word.lower() for word in filters}
         guild_id = str(ctx.guild.id)
-        initialize_guild(guild_id)
+        await initialize_guild(guild_id)
         user_id = str(ctx.author.id)
         cards, user_collections, user_data = guild_data[guild_id]
         initialize_user(guild_id, user_id)
 
-        rolls_left = user_data[user_id].get('rolls', max_rolls_per_hour)
-        if rolls_left <= 0:
+        if rolls_left(user_data[user_id]) <= 0:
             now = datetime.utcnow()
             next_hour = (now + timedelta(hours=1)).replace(minute=0, second=0, microsecond=0)
             minutes_left = (next_hour - now).seconds // 60
             await ctx.send(f'No rolls left. Rolls reset in {minutes_left} minutes.')
             return
 
-        user_data[user_id]['rolls'] -= 1
-
-        card = roll_card(guild_id, user_id)
+        card = roll_card(guild_id, user_id, unclaimed_only='unclaimed' in filters, exclude_recent='new' in filters)
         if not card:
+            # No roll is spent when nothing matches the filters
             await ctx.send('No cards available for the current probability distribution.')
             return
 
+        user_data[user_id]['rolls'] -= 1
+        persistence.record(guild_id, journal.update_user(user_id, user_data[user_id], 'rolls', 'rolls_window'))
+
         embed = discord.Embed(title=card['name'], description=card['description'])
-        wished_by = []
-        for member_id, data in guild_data[guild_id][2].items():
-            if 'wishes' in data and card['name'] in data['wishes']:
-                wished_by.append(f"<@{member_id}>")
+        wished_by = [f"<@{member_id}>" for member_id in guild_data[guild_id].wishers_of(card)]
 
         if wished_by:
             wished_users = ", ".join(wished_by)
             await ctx.send(f"🎉 Wished card! {wished_users}")
 
         if card['claimed_by']:
-            user = await ctx.guild.fetch_member(card['claimed_by'])
+            user = await members.get(ctx.guild, card['claimed_by'])
             claimed_by = f'Claimed by {user.name}'
-            profile_url = user.avatar.url if user.avatar else user.default_avatar.url
+            profile_url = user.avatar_url
             embed.set_footer(text=claimed_by, icon_url=profile_url)
             embed.color = discord.Color.red()
         else:
@@ -233,48 +298,46 @@ def setup_commands(bot):
 
         view = discord.ui.View()
         if card['claimed_by']:
-            view.add_item(GemButton(guild_id, card, user_data, user_collections, cards))
+            view.add_item(GemButton(guild_id, card))
         else:
-            view.add_item(ClaimButton(guild_id, card, user_data, user_collections, cards))
+            view.add_item(ClaimButton(guild_id, card))
 
         message = await ctx.send(embed=embed, view=view)
-        await asyncio.sleep(45)
-        await message.edit(content="Time to claim the character has expired.", view=None)
+        scheduler.schedule(ROLL_CLAIM_SECONDS, expire_roll, message)
 
-        save_data(guild_id, cards, user_collections, user_data)
+    async def expire_roll(message):
+        await message.edit(content="Time to claim the character has expired.", view=None)
 
     @bot.command(name="mm")
     async def mm(ctx, member: discord.Member = None):
         """Command to display the user's collection or another user's collection."""
         guild_id = str(ctx.guild.id)
-        initialize_guild(guild_id)
+        await initialize_guild(guild_id)
         if member is None:
             member = ctx.author
         user_id = str(member.id)
-        user_collections = guild_data[guild_id][1]
+        user_collections = guild_data[guild_id].user_collections
         if user_id not in user_collections or not user_collections[user_id]:
             await ctx.send(f'{member.display_name} has no cards in their collection.')
             return
 
-        collection = user_collections[user_id]
-        paginator = CollectionPaginator(guild_id, collection, member)
+        paginator = CollectionPaginator(guild_id, guild_data[guild_id], member)
         await paginator.send_initial_message(ctx)
 
     @bot.tree.command(name="mm", description="Display your card collection or another user's collection")
     @app_commands.describe(member="The member whose collection you want to see")
     async def mm_app(interaction: discord.Interaction, member: discord.Member = None):
         guild_id = str(interaction.guild.id)
-        initialize_guild(guild_id)
+        await initialize_guild(guild_id)
         if member is None:
             member = interaction.user
         user_id = str(member.id)
-        user_collections = guild_data[guild_id][1]
+        user_collections = guild_data[guild_id].user_collections
         if user_id not in user_collections or not user_collections[user_id]:
             await interaction.response.send_message(f'{member.display_name} has no cards in their collection.', ephemeral=True)
             return
 
-        collection = user_collections[user_id]
-        paginator = CollectionPaginator(guild_id, collection)
+        paginator = CollectionPaginator(guild_id, guild_data[guild_id], member)
         await paginator.send_initial_message(interaction)
 
 
@@ -283,27 +346,25 @@ def setup_commands(bot):
     async def top(ctx):
         """Command to display the top characters globally."""
         guild_id = str(ctx.guild.id)
-        initialize_guild(guild_id)
-        cards = guild_data[guild_id][0]
+        await initialize_guild(guild_id)
+        cards = guild_data[guild_id].cards
         if not cards:
             await ctx.send('No cards available.')
             return
 
-        sorted_cards = sorted(cards, key=rank_sort_key)
-        paginator = TopPaginator(guild_id, sorted_cards)
+        paginator = TopPaginator(guild_id, guild_data[guild_id])
         await paginator.send_initial_message(ctx)
 
     @bot.tree.command(name="top", description="Display the top characters globally")
     async def top_app(interaction: discord.Interaction):
         guild_id = str(interaction.guild.id)
-        initialize_guild(guild_id)
-        cards = guild_data[guild_id][0]
+        await initialize_guild(guild_id)
+        cards = guild_data[guild_id].cards
         if not cards:
             await interaction.response.send_message('No cards available.', ephemeral=True)
             return
 
-        sorted_cards = sorted(cards, key=rank_sort_key)
-        paginator = TopPaginator(guild_id, sorted_cards)
+        paginator = TopPaginator(guild_id, guild_data[guild_id])
         await paginator.send_initial_message(interaction)
 
 
@@ -311,11 +372,11 @@ def setup_commands(bot):
     async def mmi(ctx, member: discord.Member = None):
         """Command to display the user's collection with images or another user's collection."""
         guild_id = str(ctx.guild.id)
-        initialize_guild(guild_id)
+        await initialize_guild(guild_id)
         if member is None:
             member = ctx.author
         user_id = str(member.id)
-        user_collections = guild_data[guild_id][1]
+        user_collections = guild_data[guild_id].user_collections
         if user_id not in user_collections or not user_collections[user_id]:
             await ctx.send(f'{member.display_name} has no cards in their collection.')
             return
@@ -332,11 +393,11 @@ def setup_commands(bot):
     @app_commands.describe(member="The member whose claimed cards you want to see")
     async def mmi_app(interaction: discord.Interaction, member: discord.Member = None):
         guild_id = str(interaction.guild.id)
-        initialize_guild(guild_id)
+        await initialize_guild(guild_id)
         if member is None:
             member = interaction.user
         user_id = str(member.id)
-        user_collections = guild_data[guild_id][1]
+        user_collections = guild_data[guild_id].user_collections
         if user_id not in user_collections or not user_collections[user_id]:
             await interaction.response.send_message(f'{member.display_name} has no cards in their collection.', ephemeral=True)
             return
@@ -354,49 +415,41 @@ def setup_commands(bot):
     async def topi(ctx):
         """Command to display the top characters globally with images."""
         guild_id = str(ctx.guild.id)
-        initialize_guild(guild_id)
-        cards = guild_data[guild_id][0]
+        await initialize_guild(guild_id)
+        cards = guild_data[guild_id].cards
         if not cards:
             await ctx.send('No cards available.')
             return
 
-        sorted_cards = sorted(cards, key=rank_sort_key)
-        paginator = GlobalPaginator(guild_id, sorted_cards)
+        paginator = GlobalPaginator(guild_id, guild_data[guild_id].sorted_cards())
         await paginator.send_initial_message(ctx)
 
     @bot.tree.command(name="topi", description="Display the top characters globally with images")
     async def topi_app(interaction: discord.Interaction):
         guild_id = str(interaction.guild.id)
-        initialize_guild(guild_id)
-        cards = guild_data[guild_id][0]
+        await initialize_guild(guild_id)
+        cards = guild_data[guild_id].cards
         if not cards:
             await interaction.response.send_message('No cards available.', ephemeral=True)
             return
 
-        sorted_cards = sorted(cards, key=rank_sort_key)
-        paginator = GlobalPaginator(guild_id, sorted_cards)
+        paginator = GlobalPaginator(guild_id, guild_data[guild_id].sorted_cards())
         await paginator.send_initial_message(interaction)
 
     @bot.command(name="mu")
     async def mu(ctx):
         """Command to check the remaining time before the next global claim reset and if the user can claim."""
         guild_id = str(ctx.guild.id)
-        initialize_guild(guild_id)
+        await initialize_guild(guild_id)
         user_id = str(ctx.author.id)
-        user_data = guild_data[guild_id][2]
+        user_data = guild_data[guild_id].user_data
         initialize_user(guild_id, user_id)
 
         time_until_reset = get_time_until_next_reset()
         hours, remainder = divmod(time_until_reset.seconds, 3600)
         minutes, _ = divmod(remainder, 60)
 
-        if 'claims' in user_data.get(user_id, {}):
-            if user_data[user_id]['claims'] == 0:
-                can_claim = False
-            else:
-                can_claim = True
-        else:
-            can_claim = True
+        can_claim = claims_left(user_data[user_id]) > 0
 
         claim_status = "You can claim now!" if can_claim else f"You can claim again in **{hours}h {minutes}m**."
         await ctx.send(f"The next global claim reset is in **{hours}h {minutes}m**.\n{claim_status}")
@@ -405,22 +458,16 @@ def setup_commands(bot):
     async def mu_app(interaction: discord.Interaction):
         """Slash command to check the remaining time before the next global claim reset and if the user can claim."""
         guild_id = str(interaction.guild.id)
-        initialize_guild(guild_id)
+        await initialize_guild(guild_id)
         user_id = str(interaction.user.id)
-        user_data = guild_data[guild_id][2]
+        user_data = guild_data[guild_id].user_data
         initialize_user(guild_id, user_id)
 
         time_until_reset = get_time_until_next_reset()
         hours, remainder = divmod(time_until_reset.seconds, 3600)
         minutes, _ = divmod(remainder, 60)
 
-        if 'claims' in user_data.get(user_id, {}):
-            if user_data[user_id]['claims'] == 0:
-                can_claim = False
-            else:
-                can_claim = True
-        else:
-            can_claim = True
+        can_claim = claims_left(user_data[user_id]) > 0
 
         claim_status = "You can claim now!" if can_claim else f"You can claim again in **{hours}h {minutes}m**."
         await interaction.response.send_message(f"The next global claim reset is in **{hours}h {minutes}m**.\n{claim_status}", ephemeral=True)
@@ -429,37 +476,30 @@ def setup_commands(bot):
     async def im(ctx, *, args: str):
         """Command to display detailed information about a card."""
         guild_id = str(ctx.guild.id)
-        initialize_guild(guild_id)
-        cards = guild_data[guild_id][0]
+        await initialize_guild(guild_id)
         
         # Split the arguments on the '$' character
         parts = args.split(" $ ")
         character_name = parts[0].strip()
         page_number = int(parts[1].strip()) if len(parts) > 1 and parts[1].strip().isdigit() else 1
 
-        card_names = [card['name'] for card in cards]  # Replace 'name' with the appropriate key
-
         # Find the most matching character using fuzzy matching
-        matched_character, score = process.extractOne(character_name, card_names, scorer=fuzz.ratio)
-
-        if not matched_character:
+        card = guild_data[guild_id].find_card(character_name)
+        if not card:
             await ctx.send('Card not found.')
             return
 
-        # Find the corresponding card dictionary
-        card = next(card for card in cards if card['name'] == matched_character)
-        
         paginator = ImagePaginator(guild_id, card, page_number - 1)
         await paginator.send_initial_message(ctx)
 
     @bot.tree.command(name="im", description="Display detailed information about a card with image navigation")
     @app_commands.describe(name="Character name", page_number="Page number (optional)")
+    @app_commands.autocomplete(name=character_autocomplete)
     async def im_app(interaction: discord.Interaction, name: str, page_number: int = 1):
         guild_id = str(interaction.guild.id)
-        initialize_guild(guild_id)
-        cards = guild_data[guild_id][0]
+        await initialize_guild(guild_id)
 
-        card = next((c for c in cards if c['name'].lower() == name.lower()), None)
+        card = guild_data[guild_id].find_card(name)
         if not card:
             await interaction.response.send_message('Card not found.', ephemeral=True)
             return
@@ -473,8 +513,7 @@ def setup_commands(bot):
     async def add_image(ctx, *, args: str):
         """Command to add an image to an existing character. Usage: !ai <character_name> $ <image_url>"""
         guild_id = str(ctx.guild.id)
-        initialize_guild(guild_id)
-        cards = guild_data[guild_id][0]
+        await initialize_guild(guild_id)
         try:
             character_name, image_url = args.split(" $ ")
             character_name = character_name.strip()
@@ -483,7 +522,7 @@ def setup_commands(bot):
             await ctx.send("Invalid format. Use: !ai <character_name> $ <image_url>")
             return
 
-        card = next((c for c in cards if c['name'].lower() == character_name.lower()), None)
+        card = guild_data[guild_id].card(character_name)
         if not card:
             await ctx.send('Character not found.')
             return
@@ -492,18 +531,18 @@ def setup_commands(bot):
             card['image_urls'] = []
 
         card['image_urls'].append(image_url)
-        save_data(guild_id, *guild_data[guild_id])
+        persistence.record(guild_id, journal.update_card(card, 'image_urls'))
         await ctx.send(f'Image added to character {character_name} successfully!')
 
     @bot.tree.command(name="add_image", description="Add an image to an existing character")
     @is_admin()
     @app_commands.describe(character_name="Character name", image_url="Image URL")
+    @app_commands.autocomplete(character_name=character_autocomplete)
     async def add_image_app(interaction: discord.Interaction, character_name: str, image_url: str):
         """Slash command to add an image to an existing character."""
         guild_id = str(interaction.guild.id)
-        initialize_guild(guild_id)
-        cards = guild_data[guild_id][0]
-        card = next((c for c in cards if c['name'].lower() == character_name.lower()), None)
+        await initialize_guild(guild_id)
+        card = guild_data[guild_id].card(character_name)
         if not card:
             await interaction.response.send_message('Character not found.', ephemeral=True)
             return
@@ -512,13 +551,13 @@ def setup_commands(bot):
             card['image_urls'] = []
 
         card['image_urls'].append(image_url)
-        save_data(guild_id, *guild_data[guild_id])
+        persistence.record(guild_id, journal.update_card(card, 'image_urls'))
         await interaction.response.send_message(f'Image added to character {character_name} successfully!', ephemeral=True)
 
     @bot.command(name="balance")
     async def balance(ctx):
         guild_id = str(ctx.guild.id)
-        initialize_guild(guild_id)
+        await initialize_guild(guild_id)
         user_id = str(ctx.author.id)
         cards, user_collections, user_data = guild_data[guild_id]
         initialize_user(guild_id, user_id)
@@ -530,7 +569,7 @@ def setup_commands(bot):
     async def luck(ctx, member: discord.Member = None):
         """Command to display the user's luck percentages or another user's luck percentages."""
         guild_id = str(ctx.guild.id)
-        initialize_guild(guild_id)
+        await initialize_guild(guild_id)
         if member is None:
             member = ctx.author
         user_id = str(member.id)
@@ -547,7 +586,7 @@ def setup_commands(bot):
     @app_commands.describe(member="The member whose luck percentages you want to see")
     async def luck_app(interaction: discord.Interaction, member: discord.Member = None):
         guild_id = str(interaction.guild.id)
-        initialize_guild(guild_id)
+        await initialize_guild(guild_id)
         if member is None:
             member = interaction.user
         user_id = str(member.id)
@@ -564,7 +603,7 @@ def setup_commands(bot):
     @bot.command(name="buyluck")
     async def buyluck(ctx):
         guild_id = str(ctx.guild.id)
-        initialize_guild(guild_id)
+        await initialize_guild(guild_id)
         user_id = str(ctx.author.id)
         cards, user_collections, user_data = guild_data[guild_id]
         initialize_user(guild_id, user_id)
@@ -579,7 +618,7 @@ def setup_commands(bot):
             if cost >= 10000:
                 cost = 10000
 
-        if coins < cost:
+        if auctions.available(guild_id, user_id, coins) < cost:
             await ctx.send(f"You don't have enough coins to buy luck. You need {cost} coins.")
             return
 
@@ -590,18 +629,22 @@ def setup_commands(bot):
         total_increment = sum(max_increment[rank] for rank in ['SS', 'S', 'A'])
         decrement_fraction = total_increment / sum(base_probabilities[rank] for rank in ['B', 'C', 'D', 'E'])
 
+        luck = user_info['luck']
         for rank in base_probabilities:
             if rank in ['SS', 'S', 'A']:
-                user_info['luck'][rank] += max_increment[rank]
+                luck[rank] += max_increment[rank]
             elif rank in ['B', 'C', 'D', 'E']:
-                user_info['luck'][rank] -= base_probabilities[rank] * decrement_fraction
+                luck[rank] -= base_probabilities[rank] * decrement_fraction
 
         # Normalize probabilities
-        total = sum(user_info['luck'].values())
-        for rank in user_info['luck']:
-            user_info['luck'][rank] /= total
-
-        save_data(guild_id, cards, user_collections, user_data)
+        total = sum(luck.values())
+        for rank in luck:
+            luck[rank] /= total
+        # The record keeps luck in a compact form, so the changed copy has to be stored back
+        user_info['luck'] = luck
+
+        guild_data[guild_id].samplers.invalidate(user_id)
+        persistence.record(guild_id, journal.coins(user_id, user_info, -cost), journal.update_user(user_id, user_info, 'luck_purchases', 'luck'))
         luck_purchases += 1
         next_cost = 500 * (2 ** luck_purchases)
         if luck_purchases >= 3:
@@ -622,25 +665,25 @@ def setup_commands(bot):
             return
 
         guild_id = str(ctx.guild.id)
-        initialize_guild(guild_id)
-        cards = guild_data[guild_id][0]
+        await initialize_guild(guild_id)
+        # Leased so this state is still the live one when the user replies
+        state = guild_data.lease(guild_id, UPGRADE_CONFIRM_SECONDS)
         user_id = str(ctx.author.id)
-        user_collections = guild_data[guild_id][1]
-        user_data = guild_data[guild_id][2]
         initialize_user(guild_id, user_id)
 
         # Check if the user owns the character they want to gamble
-        card = next((c for c in user_collections.get(user_id, []) if c['name'].lower() == character_name.lower()), None)
+        card = state.find_card(character_name, owner=user_id)
         if not card:
             await ctx.send('You do not own this character.')
             return
 
         # Check if the target character is not claimed
-        target_card = next((c for c in cards if c['name'].lower() == target_character_name.lower()), None)
+        target_card = state.find_card(target_character_name)
         if not target_card:
             await ctx.send('Target character not found.')
             return
 
+        character_name, target_character_name = card['name'], target_card['name']
         if target_card['claimed_by']:
             await ctx.send('Target character is already claimed.')
             return
@@ -662,7 +705,7 @@ def setup_commands(bot):
             return msg.author == ctx.author and msg.channel == ctx.channel and msg.content.lower() in ['yes', 'no']
 
         try:
-            msg = await bot.wait_for('message', check=check, timeout=30)
+            msg = await bot.wait_for('message', check=check, timeout=UPGRADE_CONFIRM_SECONDS)
             if msg.content.lower() == 'no':
                 await ctx.send('Upgrade cancelled.')
                 return
@@ -670,6 +713,21 @@ def setup_commands(bot):
             await ctx.send('Upgrade timed out. Please try again.')
             return
 
+        # Settle the outcome up front, while the cards are locked; the roulette below only reveals it
+        async with transactions.transaction(guild_id, users=[user_id], cards=[card['id'], target_card['id']]) as tx:
+            still_valid = state.owned_card(user_id, card['name']) is card and not target_card['claimed_by']
+            if still_valid:
+                upgraded = random.random() < success_probability
+                state.uncollect(user_id, card)
+                card['claimed_by'] = None  # Unclaim the card
+                tx.record(journal.uncollect(user_id, card), journal.update_card(card, 'claimed_by'))
+                if upgraded:
+                    state.collect(user_id, target_card)
+                    tx.record(journal.update_card(target_card, 'claimed_by'), journal.collect(user_id, target_card))
+        if not still_valid:
+            await ctx.send('Upgrade cancelled, one of the cards changed hands in the meantime.')
+            return
+
         # Create the roulette bar
         total_segments = 20
         success_segments = int(success_probability * total_segments)
@@ -691,47 +749,38 @@ def setup_commands(bot):
             await msg.edit(content=f'Attempting to upgrade **{character_name}** to **{target_character_name}**...\nChance: **{success_probability:.2%}**\nUpgrade: {"".join(current_bar)}')
             await asyncio.sleep(0.5)
 
-        # Determine the outcome
-        if random.random() < success_probability:
-            # Successful upgrade
-            user_collections[user_id].remove(card)
-            card['claimed_by'] = None  # Unclaim the card
-            target_card['claimed_by'] = user_id
-            user_collections[user_id].append(target_card)
+        # Reveal the outcome
+        if upgraded:
             await msg.edit(content=f'🎉 Success! You upgraded **{character_name}** to **{target_character_name}**!')
         else:
-            # Failed upgrade
-            user_collections[user_id].remove(card)
-            card['claimed_by'] = None  # Unclaim the card
             await msg.edit(content=f'❌ Failed! You lost **{character_name}** and did not gain **{target_character_name}**.')
 
-        save_data(guild_id, cards, user_collections, user_data)
-
     # Add the same command in app_commands format for slash commands
     @bot.tree.command(name="upgrade", description="Gamble a card for a chance to upgrade to another card")
     @app_commands.describe(character_name="Character name to gamble", target_character_name="Character name to upgrade to")
+    @app_commands.autocomplete(character_name=owned_character_autocomplete, target_character_name=character_autocomplete)
     async def roulette_app(interaction: discord.Interaction, character_name: str, target_character_name: str):
         """Slash command to gamble a card for a chance to upgrade to another card."""
         guild_id = str(interaction.guild.id)
-        initialize_guild(guild_id)
-        cards = guild_data[guild_id][0]
+        await initialize_guild(guild_id)
+        # Leased so this state is still the live one when the user replies
+        state = guild_data.lease(guild_id, UPGRADE_CONFIRM_SECONDS)
         user_id = str(interaction.user.id)
-        user_collections = guild_data[guild_id][1]
-        user_data = guild_data[guild_id][2]
         initialize_user(guild_id, user_id)
 
         # Check if the user owns the character they want to gamble
-        card = next((c for c in user_collections.get(user_id, []) if c['name'].lower() == character_name.lower()), None)
+        card = state.find_card(character_name, owner=user_id)
         if not card:
             await interaction.response.send_message('You do not own this character.', ephemeral=True)
             return
 
         # Check if the target character is not claimed
-        target_card = next((c for c in cards if c['name'].lower() == target_character_name.lower()), None)
+        target_card = state.find_card(target_character_name)
         if not target_card:
             await interaction.response.send_message('Target character not found.', ephemeral=True)
             return
 
+        character_name, target_character_name = card['name'], target_card['name']
         if target_card['claimed_by']:
             await interaction.response.send_message('Target character is already claimed.', ephemeral=True)
             return
@@ -753,7 +802,7 @@ def setup_commands(bot):
             return msg.author == interaction.user and msg.channel == interaction.channel and msg.content.lower() in ['yes', 'no']
 
         try:
-            msg = await bot.wait_for('message', check=check, timeout=30)
+            msg = await bot.wait_for('message', check=check, timeout=UPGRADE_CONFIRM_SECONDS)
             if msg.content.lower() == 'no':
                 await interaction.followup.send('Upgrade cancelled.', ephemeral=True)
                 return
@@ -761,6 +810,21 @@ def setup_commands(bot):
             await interaction.followup.send('Upgrade timed out. Please try again.', ephemeral=True)
             return
 
+        # Settle the outcome up front, while the cards are locked; the roulette below only reveals it
+        async with transactions.transaction(guild_id, users=[user_id], cards=[card['id'], target_card['id']]) as tx:
+            still_valid = state.owned_card(user_id, card['name']) is card and not target_card['claimed_by']
+            if still_valid:
+                upgraded = random.random() < success_probability
+                state.uncollect(user_id, card)
+                card['claimed_by'] = None  # Unclaim the card
+                tx.record(journal.uncollect(user_id, card), journal.update_card(card, 'claimed_by'))
+                if upgraded:
+                    state.collect(user_id, target_card)
+                    tx.record(journal.update_card(target_card, 'claimed_by'), journal.collect(user_id, target_card))
+        if not still_valid:
+            await interaction.followup.send('Upgrade cancelled, one of the cards changed hands in the meantime.')
+            return
+
         # Create the roulette bar
         total_segments = 20
         success_segments = int(success_probability * total_segments)
@@ -782,22 +846,12 @@ def setup_commands(bot):
             await interaction.edit_original_response(content=f'Attempting to upgrade **{character_name}** to **{target_character_name}**...\nChance: **{success_probability:.2%}**\nUpgrade: {"".join(current_bar)}')
             await asyncio.sleep(0.5)
 
-        # Determine the outcome
-        if random.random() < success_probability:
-            # Successful upgrade
-            user_collections[user_id].remove(card)
-            card['claimed_by'] = None  # Unclaim the card
-            target_card['claimed_by'] = user_id
-            user_collections[user_id].append(target_card)
+        # Reveal the outcome
+        if upgraded:
             await interaction.edit_original_response(content=f'🎉 Success! You upgraded **{character_name}** to **{target_character_name}**!')
         else:
-            # Failed upgrade
-            user_collections[user_id].remove(card)
-            card['claimed_by'] = None  # Unclaim the card
             await interaction.edit_original_response(content=f'❌ Failed! You lost **{character_name}** and did not gain **{target_character_name}**.')
 
-        save_data(guild_id, cards, user_collections, user_data)
-
     
     @bot.command(name="ci")
     async def change_image(ctx, *, args: str):
@@ -810,11 +864,10 @@ def setup_commands(bot):
             return
 
         guild_id = str(ctx.guild.id)
-        initialize_guild(guild_id)
-        cards = guild_data[guild_id][0]
+        await initialize_guild(guild_id)
 
         # Find the card by character name
-        card = next((c for c in cards if c['name'].lower() == character_name.lower()), None)
+        card = guild_data[guild_id].card(character_name)
         if not card:
             await ctx.send('Character not found.')
             return
@@ -826,20 +879,20 @@ def setup_commands(bot):
 
         # Swap the images
         card['image_urls'][0], card['image_urls'][img_num - 1] = card['image_urls'][img_num - 1], card['image_urls'][0]
-        save_data(guild_id, *guild_data[guild_id])
+        persistence.record(guild_id, journal.update_card(card, 'image_urls'))
         await ctx.send(f'Image {img_num} has been set as the first image for {character_name}.')
 
     # Add the same command in app_commands format for slash commands
     @bot.tree.command(name="ci", description="Change the first image of a character to the specified image number")
     @app_commands.describe(character_name="Character name", img_num="Image number")
+    @app_commands.autocomplete(character_name=character_autocomplete)
     async def change_image_app(interaction: discord.Interaction, character_name: str, img_num: int):
         """Slash command to change the first image of the character to the specified image number."""
         guild_id = str(interaction.guild.id)
-        initialize_guild(guild_id)
-        cards = guild_data[guild_id][0]
+        await initialize_guild(guild_id)
 
         # Find the card by character name
-        card = next((c for c in cards if c['name'].lower() == character_name.lower()), None)
+        card = guild_data[guild_id].card(character_name)
         if not card:
             await interaction.response.send_message('Character not found.', ephemeral=True)
             return
@@ -851,14 +904,14 @@ def setup_commands(bot):
 
         # Swap the images
         card['image_urls'][0], card['image_urls'][img_num - 1] = card['image_urls'][img_num - 1], card['image_urls'][0]
-        save_data(guild_id, *guild_data[guild_id])
+        persistence.record(guild_id, journal.update_card(card, 'image_urls'))
         await interaction.response.send_message(f'Image {img_num} has been set as the first image for {character_name}.', ephemeral=True)
 
     @bot.command(name="wish")
     async def wish(ctx, *, character_name: str):
         """Command to add a character to the user's wish list."""
         guild_id = str(ctx.guild.id)
-        initialize_guild(guild_id)
+        await initialize_guild(guild_id)
         user_id = str(ctx.author.id)
         cards, user_collections, user_data = guild_data[guild_id]
         initialize_user(guild_id, user_id)
@@ -870,20 +923,24 @@ def setup_commands(bot):
             await ctx.send(f"You can only have a maximum of {MAX_WISHES} wishes.")
             return
 
-        card = next((c for c in cards if c['name'].lower() == character_name.lower()), None)
+        card = guild_data[guild_id].find_card(character_name)
         if not card:
             await ctx.send(f"Character {character_name} not found.")
             return
 
-        user_data[user_id]['wishes'].append(card['name'])
-        save_data(guild_id, cards, user_collections, user_data)
-        await ctx.send(f"Character {character_name} has been added to your wish list!")
+        if user_id in guild_data[guild_id].wishers_of(card):
+            await ctx.send(f"Character {card['name']} is already in your wish list.")
+            return
+
+        guild_data[guild_id].add_wish(user_id, card)
+        persistence.record(guild_id, journal.update_user(user_id, user_data[user_id], 'wishes'))
+        await ctx.send(f"Character {card['name']} has been added to your wish list!")
 
     @bot.command(name="wishremove")
     async def wishremove(ctx, *, character_name: str):
         """Command to remove a character from the user's wish list."""
         guild_id = str(ctx.guild.id)
-        initialize_guild(guild_id)
+        await initialize_guild(guild_id)
         user_id = str(ctx.author.id)
         cards, user_collections, user_data = guild_data[guild_id]
         initialize_user(guild_id, user_id)
@@ -892,19 +949,22 @@ def setup_commands(bot):
             await ctx.send("You don't have any wishes.")
             return
 
+        card = guild_data[guild_id].card(character_name)
+        if card:
+            character_name = card['name']
         if character_name not in user_data[user_id]['wishes']:
             await ctx.send(f"Character {character_name} is not in your wish list.")
             return
 
-        user_data[user_id]['wishes'].remove(character_name)
-        save_data(guild_id, cards, user_collections, user_data)
+        guild_data[guild_id].remove_wish(user_id, character_name)
+        persistence.record(guild_id, journal.update_user(user_id, user_data[user_id], 'wishes'))
         await ctx.send(f"Character {character_name} has been removed from your wish list!")
 
     @bot.command(name="wishlist")
     async def wishlist(ctx, member: discord.Member = None):
         """Command to display the user's wish list."""
         guild_id = str(ctx.guild.id)
-        initialize_guild(guild_id)
+        await initialize_guild(guild_id)
         if member is None:
             member = ctx.author
         user_id = str(member.id)
@@ -918,11 +978,11 @@ def setup_commands(bot):
         wishlist_display = []
         firstcharacter = None
         for character_name in wishlist:
-            card = next((c for c in cards if c['name'].lower() == character_name.lower()), None)
-            if firstcharacter == None:
-                firstcharacter = card['image_urls'][0]
+            card = guild_data[guild_id].card(character_name)
             if not card:
                 continue
+            if firstcharacter == None:
+                firstcharacter = card['image_urls'][0]
             status = ""
             if card['claimed_by'] == user_id:
                 status = " ✅"
@@ -940,11 +1000,30 @@ def setup_commands(bot):
             embed.set_thumbnail(url=firstcharacter)
             await ctx.send(embed=embed)
     
+    @bot.command(name="wishers")
+    async def wishers(ctx, *, character_name: str):
+        """Command to display who wishes for a character."""
+        guild_id = str(ctx.guild.id)
+        await initialize_guild(guild_id)
+
+        card = guild_data[guild_id].card(character_name)
+        if not card:
+            await ctx.send(f"Character {character_name} not found.")
+            return
+
+        wished_by = guild_data[guild_id].wishers_of(card)
+        if not wished_by:
+            await ctx.send(f"Nobody wishes for **{card['name']}**.")
+            return
+
+        embed = discord.Embed(title=f"{card['name']} is wished by", description="\n".join(f"<@{member_id}>" for member_id in wished_by))
+        await ctx.send(embed=embed)
+
     @bot.command(name="daily")
     async def daily(ctx):
         """Command get free coins every day"""
         guild_id = str(ctx.guild.id)
-        initialize_guild(guild_id)
+        await initialize_guild(guild_id)
         user_id = str(ctx.author.id)
         cards, user_collections, user_data = guild_data[guild_id]
         initialize_user(guild_id, user_id)
@@ -960,22 +1039,19 @@ def setup_commands(bot):
         coins_received = random.randint(100, 400)
         user_data[user_id]['coins'] += coins_received
         user_data[user_id]['last_daily_time'] = datetime.utcnow().isoformat()
-        save_data(guild_id, cards, user_collections, user_data)
+        persistence.record(guild_id, journal.coins(user_id, user_data[user_id], coins_received), journal.update_user(user_id, user_data[user_id], 'last_daily_time'))
         await ctx.send(f"You received {coins_received} coins!")
 
     @bot.command(name="dailyreset")
     async def dailyreset(ctx):
         """Command to reset the claim timer every day"""
         guild_id = str(ctx.guild.id)
-        initialize_guild(guild_id)
+        await initialize_guild(guild_id)
         user_id = str(ctx.author.id)
         cards, user_collections, user_data = guild_data[guild_id]
         initialize_user(guild_id, user_id)
 
-        if 'claims' not in user_data[user_id]:
-            user_data[user_id]['claims'] = 1
-            
-        if user_data[user_id]['claims'] == 1:
+        if claims_left(user_data[user_id]) > 0:
             pass
             await ctx.send("Your still have a claim left... You cannot use this command right now")
         else:
@@ -989,27 +1065,28 @@ def setup_commands(bot):
 
             user_data[user_id]['claims'] = 1
             user_data[user_id]['last_daily_reset_time'] = datetime.utcnow().isoformat()
-            save_data(guild_id, cards, user_collections, user_data)
+            persistence.record(guild_id, journal.update_user(user_id, user_data[user_id], 'claims', 'claims_window', 'last_daily_reset_time'))
             await ctx.send("Your claim has been reset!")
 
     @bot.command(name="trade")
     async def trade(ctx, user: discord.User, *, args: str):
         """Command to trade cards with another player"""
         guild_id = str(ctx.guild.id)
-        initialize_guild(guild_id)
-        user_collections = guild_data[guild_id][1]
-        user_cards= guild_data[guild_id][0]
+        await initialize_guild(guild_id)
+        # Leased so this state is still the live one when the user replies
+        state = guild_data.lease(guild_id, 2 * TRADE_REPLY_SECONDS)
         sender = ctx.message.author
         sender_id = str(sender.id)
         receiver_id = str(user.id)
 
-        sender_cards = [name.strip() for name in args.split(" $ ")]
-
         # Vérifier si l'expéditeur possède toutes les cartes
-        for card_name in sender_cards:
-            if not any(c for c in user_collections.get(sender_id, []) if c['name'].lower() == card_name.lower()):
-                await ctx.send(f'You do not have the card {card_name}.')
+        sender_cards = []
+        for card_name in (name.strip() for name in args.split(" $ ")):
+            card = state.owned_card(sender_id, card_name)
+            if not card:
+                await ctx.send(f'You do not have the card {card_name}.' + did_you_mean(guild_id, card_name, sender_id))
                 return
+            sender_cards.append(card['name'])
 
         await ctx.send(f'{user.mention}, {sender.display_name} wants to trade {", ".join(sender_cards)}. What card(s) will you trade in return? (Reply with card names separated by $)')
 
@@ -1017,14 +1094,15 @@ def setup_commands(bot):
             return msg.author == user and msg.channel == ctx.channel
 
         try:
-            msg = await bot.wait_for('message', check=check, timeout=60)
-            receiver_cards = [name.strip() for name in msg.content.split(" $ ")]
-
+            msg = await bot.wait_for('message', check=check, timeout=TRADE_REPLY_SECONDS)
             # Vérifier si le récepteur possède toutes les cartes
-            for card_name in receiver_cards:
-                if not any(c for c in user_collections.get(receiver_id, []) if c['name'].lower() == card_name.lower()):
-                    await ctx.send(f'{user.display_name} does not have the card {card_name}.')
+            receiver_cards = []
+            for card_name in (name.strip() for name in msg.content.split(" $ ")):
+                card = state.owned_card(receiver_id, card_name)
+                if not card:
+                    await ctx.send(f'{user.display_name} does not have the card {card_name}.' + did_you_mean(guild_id, card_name, receiver_id))
                     return
+                receiver_cards.append(card['name'])
 
             await ctx.send(f'{sender.mention}, {user.display_name} wants to trade {", ".join(receiver_cards)} for {", ".join(sender_cards)}. Do you accept? (yes/no)')
 
@@ -1032,26 +1110,26 @@ def setup_commands(bot):
                 return msg.author == sender and msg.channel == ctx.channel and msg.content.lower() in ['yes', 'y', 'no', 'n']
 
             try:
-                confirm_msg = await bot.wait_for('message', check=check_confirm, timeout=60)
+                confirm_msg = await bot.wait_for('message', check=check_confirm, timeout=TRADE_REPLY_SECONDS)
                 if confirm_msg.content.lower() in ['yes', 'y']:
-                    for card_name in sender_cards:
-                        sender_card = next(c for c in user_collections[sender_id] if c['name'].lower() == card_name.lower())
-                        user_collections[sender_id].remove(sender_card)
-                        cards = next(c for c in user_cards if c['name'].lower() == card_name.lower())
-                        cards['claimed_by'] = receiver_id
-                        sender_card['claimed_by'] = receiver_id
-                        user_collections[receiver_id].append(sender_card)
-
-                    for card_name in receiver_cards:
-                        receiver_card = next(c for c in user_collections[receiver_id] if c['name'].lower() == card_name.lower())
-                        user_collections[receiver_id].remove(receiver_card)
-                        cards = next(c for c in user_cards if c['name'].lower() == card_name.lower())
-                        cards['claimed_by'] = sender_id
-                        receiver_card['claimed_by'] = sender_id
-                        user_collections[sender_id].append(receiver_card)
-                    
-
-                    save_data(guild_id, *guild_data[guild_id])
+                    offered = list(dict.fromkeys(state.owned_card(sender_id, name) for name in sender_cards))
+                    asked = list(dict.fromkeys(state.owned_card(receiver_id, name) for name in receiver_cards))
+                    traded = None not in offered and None not in asked
+                    if traded:
+                        async with transactions.transaction(guild_id, users=[sender_id, receiver_id], cards=[card['id'] for card in offered + asked]) as tx:
+                            traded = all(state.owned_card(sender_id, card['name']) is card for card in offered) and all(state.owned_card(receiver_id, card['name']) is card for card in asked)
+                            if traded:
+                                for sender_card in offered:
+                                    state.uncollect(sender_id, sender_card)
+                                    state.collect(receiver_id, sender_card)
+                                    tx.record(journal.uncollect(sender_id, sender_card), journal.update_card(sender_card, 'claimed_by'), journal.collect(receiver_id, sender_card))
+                                for receiver_card in asked:
+                                    state.uncollect(receiver_id, receiver_card)
+                                    state.collect(sender_id, receiver_card)
+                                    tx.record(journal.uncollect(receiver_id, receiver_card), journal.update_card(receiver_card, 'claimed_by'), journal.collect(sender_id, receiver_card))
+                    if not traded:
+                        await ctx.send('Trade cancelled, some of the cards changed hands in the meantime.')
+                        return
                     await ctx.send(f'Trade successful! {sender.display_name} traded {", ".join(sender_cards)} with {user.display_name} for {", ".join(receiver_cards)}.')
                 else:
                     await ctx.send('Trade cancelled.')
@@ -1063,21 +1141,24 @@ def setup_commands(bot):
 
     @bot.tree.command(name="trade", description="Trade cards with another user")
     @app_commands.describe(user="The user to trade with", cards="The cards you want to trade, separated by $")
+    @app_commands.autocomplete(cards=owned_characters_autocomplete)
     async def trade_app(interaction: discord.Interaction, user: discord.User, cards: str):
         guild_id = str(interaction.guild.id)
-        initialize_guild(guild_id)
-        user_collections = guild_data[guild_id][1]
+        await initialize_guild(guild_id)
+        # Leased so this state is still the live one when the user replies
+        state = guild_data.lease(guild_id, 2 * TRADE_REPLY_SECONDS)
         sender = interaction.user
         sender_id = str(sender.id)
         receiver_id = str(user.id)
 
-        sender_cards = [name.strip() for name in cards.split(" $ ")]
-
         # Vérifier si l'expéditeur possède toutes les cartes
-        for card_name in sender_cards:
-            if not any(c for c in user_collections.get(sender_id, []) if c['name'].lower() == card_name.lower()):
-                await interaction.response.send_message(f'You do not have the card {card_name}.', ephemeral=True)
+        sender_cards = []
+        for card_name in (name.strip() for name in cards.split(" $ ")):
+            card = state.owned_card(sender_id, card_name)
+            if not card:
+                await interaction.response.send_message(f'You do not have the card {card_name}.' + did_you_mean(guild_id, card_name, sender_id), ephemeral=True)
                 return
+            sender_cards.append(card['name'])
 
         await interaction.response.send_message(f'{user.mention}, {sender.display_name} wants to trade {", ".join(sender_cards)}. What card(s) will you trade in return? (Reply with card names separated by $)', ephemeral=True)
 
@@ -1085,14 +1166,15 @@ def setup_commands(bot):
             return msg.author == user and msg.channel == interaction.channel
 
         try:
-            msg = await bot.wait_for('message', check=check, timeout=60)
-            receiver_cards = [name.strip() for name in msg.content.split(" $ ")]
-
+            msg = await bot.wait_for('message', check=check, timeout=TRADE_REPLY_SECONDS)
             # Vérifier si le récepteur possède toutes les cartes
-            for card_name in receiver_cards:
-                if not any(c for c in user_collections.get(receiver_id, []) if c['name'].lower() == card_name.lower()):
-                    await interaction.channel.send(f'{user.display_name} does not have the card {card_name}.')
+            receiver_cards = []
+            for card_name in (name.strip() for name in msg.content.split(" $ ")):
+                card = state.owned_card(receiver_id, card_name)
+                if not card:
+                    await interaction.channel.send(f'{user.display_name} does not have the card {card_name}.' + did_you_mean(guild_id, card_name, receiver_id))
                     return
+                receiver_cards.append(card['name'])
 
             await interaction.channel.send(f'{sender.mention}, {user.display_name} wants to trade {", ".join(receiver_cards)} for {", ".join(sender_cards)}. Do you accept? (yes/no)')
 
@@ -1100,21 +1182,26 @@ def setup_commands(bot):
                 return msg.author == sender and msg.channel == interaction.channel and msg.content.lower() in ['yes', 'y', 'no', 'n']
 
             try:
-                confirm_msg = await bot.wait_for('message', check=check_confirm, timeout=60)
+                confirm_msg = await bot.wait_for('message', check=check_confirm, timeout=TRADE_REPLY_SECONDS)
                 if confirm_msg.content.lower() in ['yes', 'y']:
-                    for card_name in sender_cards:
-                        sender_card = next(c for c in user_collections[sender_id] if c['name'].lower() == card_name.lower())
-                        user_collections[sender_id].remove(sender_card)
-                        sender_card['claimed_by'] = receiver_id
-                        user_collections[receiver_id].append(sender_card)
-
-                    for card_name in receiver_cards:
-                        receiver_card = next(c for c in user_collections[receiver_id] if c['name'].lower() == card_name.lower())
-                        user_collections[receiver_id].remove(receiver_card)
-                        receiver_card['claimed_by'] = sender_id
-                        user_collections[sender_id].append(receiver_card)
-                        
-                    save_data(guild_id, *guild_data[guild_id])
+                    offered = list(dict.fromkeys(state.owned_card(sender_id, name) for name in sender_cards))
+                    asked = list(dict.fromkeys(state.owned_card(receiver_id, name) for name in receiver_cards))
+                    traded = None not in offered and None not in asked
+                    if traded:
+                        async with transactions.transaction(guild_id, users=[sender_id, receiver_id], cards=[card['id'] for card in offered + asked]) as tx:
+                            traded = all(state.owned_card(sender_id, card['name']) is card for card in offered) and all(state.owned_card(receiver_id, card['name']) is card for card in asked)
+                            if traded:
+                                for sender_card in offered:
+                                    state.uncollect(sender_id, sender_card)
+                                    state.collect(receiver_id, sender_card)
+                                    tx.record(journal.uncollect(sender_id, sender_card), journal.update_card(sender_card, 'claimed_by'), journal.collect(receiver_id, sender_card))
+                                for receiver_card in asked:
+                                    state.uncollect(receiver_id, receiver_card)
+                                    state.collect(sender_id, receiver_card)
+                                    tx.record(journal.uncollect(receiver_id, receiver_card), journal.update_card(receiver_card, 'claimed_by'), journal.collect(sender_id, receiver_card))
+                    if not traded:
+                        await interaction.channel.send('Trade cancelled, some of the cards changed hands in the meantime.')
+                        return
                     await interaction.channel.send(f'Trade successful! {sender.display_name} traded {", ".join(sender_cards)} with {user.display_name} for {", ".join(receiver_cards)}.')
                 else:
                     await interaction.channel.send('Trade cancelled.')
@@ -1131,45 +1218,108 @@ def setup_commands(bot):
     async def download_data(ctx):
         """Command to download the JSON files."""
         guild_id = str(ctx.guild.id)
-        initialize_guild(guild_id)
-        await ctx.send(file=discord.File(f'data/{guild_id}_cards.json'))
-        await ctx.send(file=discord.File(f'data/{guild_id}_collections.json'))
-        await ctx.send(file=discord.File(f'data/{guild_id}_user_data.json'))
+        await initialize_guild(guild_id)
+        for path in await run_io(export_guild, guild_id, *snapshot(tuple(guild_data[guild_id]))):
+            await ctx.send(file=discord.File(path))
 
     @bot.tree.command(name="download_data", description="Download the current data as JSON files")
     @is_admin()
     async def download_data_app(interaction: discord.Interaction):
         """Slash command to download the JSON files."""
         guild_id = str(interaction.guild.id)
-        initialize_guild(guild_id)
+        await initialize_guild(guild_id)
+        paths = await run_io(export_guild, guild_id, *snapshot(tuple(guild_data[guild_id])))
         await interaction.response.send_message("Downloading data...", ephemeral=True)
-        await interaction.followup.send(file=discord.File(f'data/{guild_id}_cards.json'))
-        await interaction.followup.send(file=discord.File(f'data/{guild_id}_collections.json'))
-        await interaction.followup.send(file=discord.File(f'data/{guild_id}_user_data.json'))
+        for path in paths:
+            await interaction.followup.send(file=discord.File(path))
+
+    @bot.command(name="stats")
+    @is_admin()
+    async def stats(ctx):
+        """Command to display the bot's internal performance counters."""
+        embed = discord.Embed(title="<:naporight:1246789280211406888> • Bot Stats")
+        persistence_stats = persistence.stats()
+        embed.add_field(name="Persistence", value=(
+            f"{persistence_stats['flushes']} flushes • {persistence_stats['files_written']} files written\n"
+            f"{persistence_stats['dirty_guilds']} dirty guilds • {persistence_stats['pending_mutations']} pending mutations • {persistence_stats['coalesced_writes']} coalesced writes\n"
+            f"Flush latency: last {persistence_stats['last_flush_ms']:.1f}ms • avg {persistence_stats['avg_flush_ms']:.1f}ms • max {persistence_stats['max_flush_ms']:.1f}ms"
+        ), inline=False)
+        cache_stats = guild_data.stats()
+        embed.add_field(name="Guild cache", value=(
+            f"{cache_stats['resident_guilds']} resident guilds ({cache_stats['leased']} leased) • {cache_stats['resident_records']} records\n"
+            f"Hit rate: {cache_stats['hit_rate']:.1%} • {cache_stats['loads']} loads • {cache_stats['evictions']} evictions\n"
+            f"Load latency: avg {cache_stats['avg_load_ms']:.1f}ms • max {cache_stats['max_load_ms']:.1f}ms\n"
+            f"Sorted/rendered views: {cache_stats['memo_hits']} reused • {cache_stats['memo_builds']} built"
+        ), inline=False)
+        timer_stats = scheduler.stats()
+        embed.add_field(name="Timers", value=(
+            f"{timer_stats['pending']} pending • {timer_stats['queued']} queued • {timer_stats['fired']} fired • {timer_stats['errors']} errors\n"
+            f"Lateness: avg {timer_stats['avg_lateness_ms']:.1f}ms • max {timer_stats['max_lateness_ms']:.1f}ms"
+        ), inline=False)
+        transaction_stats = transactions.stats()
+        embed.add_field(name="Transactions", value=(
+            f"{transaction_stats['commits']} commits • {transaction_stats['held_locks']} locks held\n"
+            f"Lock waits: {transaction_stats['waits']} • avg {transaction_stats['avg_wait_ms']:.1f}ms"
+        ), inline=False)
+        member_stats = members.stats()
+        embed.add_field(name="Member cache", value=(
+            f"{member_stats['cached']} cached profiles • {member_stats['gateway_hits']} gateway hits • {member_stats['hits']} cache hits\n"
+            f"{member_stats['fetches']} REST fetches ({member_stats['rest_rate']:.1%}) • {member_stats['coalesced']} coalesced"
+        ), inline=False)
+        auction_stats = auctions.stats()
+        embed.add_field(name="Auctions", value=(
+            f"{auction_stats['active']} active in {auction_stats['guilds']} guilds • {auction_stats['held']} coins held • {auction_stats['settled']} settled"
+        ), inline=False)
+        audio_stats = audio_cache.stats()
+        clip_stats = clips.stats()
+        embed.add_field(name="Quiz audio cache", value=(
+            f"{audio_stats['entries']} tracks • {audio_stats['bytes'] / 2**20:.1f} of {audio_stats['budget'] / 2**20:.0f} MiB\n"
+            f"Hit rate: {audio_stats['hit_rate']:.1%} • {audio_stats['hits']} hits • {audio_stats['misses']} misses • {audio_stats['evictions']} evictions • {audio_stats['corrupt']} failed checks\n"
+            f"Preprocessed clips: {clip_stats['clips']} • {clip_stats['bytes'] / 2**20:.1f} MiB • {clip_stats['hits']} played • {clip_stats['misses']} not preprocessed"
+        ), inline=False)
+        quiz_stats = quizzes.stats()
+        embed.add_field(name="Quiz sessions", value=(
+            f"{quiz_stats['active']} of {quiz_stats['limit']} running • {quiz_stats['started']} started • {quiz_stats['rejected']} turned away\n" + "\n".join(
+                f"Guild {session['guild_id']}: round {session['rounds']} • {session['players']} scoring players • {session['minutes']:.0f} min"
+                for session in quiz_stats['sessions']
+            )
+        ), inline=False)
+        voice_stats = voice_meter.stats()
+        embed.add_field(name="Quiz voice CPU", value=(
+            f"{voice_stats['active']} tracks playing\n" + "\n".join(
+                f"{mode}: {mode_stats['cpu_per_session']:.1%} of a core per session over {mode_stats['tracks']} tracks"
+                for mode, mode_stats in voice_stats['modes'].items()
+            )
+        ), inline=False)
+        await ctx.send(embed=embed)
 
     @bot.command(name="upload_data")
     @is_admin()
     async def upload_data(ctx, cards_file: discord.Attachment, collections_file: discord.Attachment, user_data_file: discord.Attachment):
         """Command to upload the JSON files."""
         guild_id = str(ctx.guild.id)
-        initialize_guild(guild_id)
+        await initialize_guild(guild_id)
         await cards_file.save(f'data/{guild_id}_cards.json')
         await collections_file.save(f'data/{guild_id}_collections.json')
         await user_data_file.save(f'data/{guild_id}_user_data.json')
         
         # Reload the data
         global guild_data
-        guild_data[guild_id] = load_data(guild_id)
+        persistence.discard(guild_id)
+        listings = guild_data[guild_id].black_market.listings
+        guild_data[guild_id] = GuildState(*await run_ordered(import_guild, guild_id), listings)
+        # Importing resets the journal, so the black market needs a snapshot of its own.
+        persistence.mark_dirty(guild_id, 'black_market')
         
         # Debug print statements to verify data loading
-        print(f'Loaded {len(guild_data[guild_id][0])} cards')
-        print(f'Loaded {len(guild_data[guild_id][1])} user collections')
-        print(f'Loaded {len(guild_data[guild_id][2])} user data entries')
+        print(f'Loaded {len(guild_data[guild_id].cards)} cards')
+        print(f'Loaded {len(guild_data[guild_id].user_collections)} user collections')
+        print(f'Loaded {len(guild_data[guild_id].user_data)} user data entries')
 
         await ctx.send("Data uploaded and loaded successfully!")
         
         # Restart the bot to apply the new data
-        reload_bot()
+        await reload_bot()
 
     @bot.tree.command(name="upload_data", description="Upload the current data as JSON files")
     @is_admin()
@@ -1177,79 +1327,80 @@ def setup_commands(bot):
     async def upload_data_app(interaction: discord.Interaction, cards_file: discord.Attachment, collections_file: discord.Attachment, user_data_file: discord.Attachment):
         """Slash command to upload the JSON files."""
         guild_id = str(interaction.guild.id)
-        initialize_guild(guild_id)
+        await initialize_guild(guild_id)
         await cards_file.save(f'data/{guild_id}_cards.json')
         await collections_file.save(f'data/{guild_id}_collections.json')
         await user_data_file.save(f'data/{guild_id}_user_data.json')
         
         # Reload the data
         global guild_data
-        guild_data[guild_id] = load_data(guild_id)
+        persistence.discard(guild_id)
+        listings = guild_data[guild_id].black_market.listings
+        guild_data[guild_id] = GuildState(*await run_ordered(import_guild, guild_id), listings)
+        # Importing resets the journal, so the black market needs a snapshot of its own.
+        persistence.mark_dirty(guild_id, 'black_market')
         
         # Debug print statements to verify data loading
-        print(f'Loaded {len(guild_data[guild_id][0])} cards')
-        print(f'Loaded {len(guild_data[guild_id][1])} user collections')
-        print(f'Loaded {len(guild_data[guild_id][2])} user data entries')
+        print(f'Loaded {len(guild_data[guild_id].cards)} cards')
+        print(f'Loaded {len(guild_data[guild_id].user_collections)} user collections')
+        print(f'Loaded {len(guild_data[guild_id].user_data)} user data entries')
 
         await interaction.response.send_message("Data uploaded and loaded successfully!", ephemeral=True)
-        reload_bot()
+        await reload_bot()
     
     @bot.command(name='start_quiz')
     async def start_quiz(ctx):
         guild = ctx.guild
-        existing_channel = discord.utils.get(guild.voice_channels, name='Quizz')
-        if not existing_channel:
-            channel = await guild.create_voice_channel('Quizz')
-        else:
-            channel = existing_channel
-
-        await ctx.send(f'Quiz starting in {channel.mention}. Join the voice channel to participate!')
+        if quizzes.get(guild.id):
+            await ctx.send("A quiz is already running in this server.")
+            return
+        # Opening the session first keeps a second !start_quiz out while the bot connects.
+        session = quizzes.open(guild.id, quiz_data)
+        if session is None:
+            await ctx.send("Too many quizzes are running right now, try again later.")
+            return
 
-        # Move bot to the voice channel
-        voice_channel = discord.utils.get(ctx.guild.voice_channels, name='Quizz')
-        if voice_channel:
-            vc = ctx.voice_client
-            if vc:
-                if vc.channel != voice_channel:
-                    await vc.move_to(voice_channel)
+        try:
+            existing_channel = discord.utils.get(guild.voice_channels, name='Quizz')
+            if not existing_channel:
+                channel = await guild.create_voice_channel('Quizz')
             else:
-                vc = await voice_channel.connect()
+                channel = existing_channel
 
-            await play_quiz(vc, ctx)
-        else:
-            await ctx.send("Couldn't create/find a voice channel named 'Quizz'.")
+            await ctx.send(f'Quiz starting in {channel.mention}. Join the voice channel to participate!')
+
+            # Move bot to the voice channel
+            voice_channel = discord.utils.get(ctx.guild.voice_channels, name='Quizz')
+            if voice_channel:
+                vc = ctx.voice_client
+                if vc:
+                    if vc.channel != voice_channel:
+                        await vc.move_to(voice_channel)
+                else:
+                    vc = await voice_channel.connect()
+                session.voice_client = vc
+
+                await run_quiz(vc, ctx, session)
+            else:
+                await ctx.send("Couldn't create/find a voice channel named 'Quizz'.")
+        finally:
+            await quizzes.close(session)
 
-    async def play_quiz(vc, ctx):
+    async def run_quiz(vc, ctx, session):
         while True:
-            anime, youtube_url = random.choice(list(quiz_data.items()))
-
-            ydl_opts = {
-                'format': 'bestaudio/best',
-                'postprocessors': [{
-                    'key': 'FFmpegExtractAudio',
-                    'preferredcodec': 'mp3',
-                    'preferredquality': '192',
-                }],
-                'outtmpl': 'audio.%(ext)s',
-                'quiet': True
-            }
-
-            audio_file = None
-            while not audio_file:
-                try:
-                    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                        info_dict = ydl.extract_info(youtube_url, download=True)
-                        audio_file = ydl.prepare_filename(info_dict).replace('.webm', '.mp3').replace('.m4a', '.mp3')
-                except Exception as e:
-                    await ctx.send(f"Error downloading audio from YouTube: {e}")
-                    anime, youtube_url = random.choice(list(quiz_data.items()))
+            # The next track was downloading while the previous round played
+            track = await session.next_track(timeout=QUIZ_TRACK_TIMEOUT * 2)
+            if track is None:
+                await ctx.send("Couldn't download any opening from YouTube, the quiz is stopped.")
+                break
+            anime, audio_file = track
 
             await ctx.send(f'Playing an opening, guess the anime!')
 
             def check(m):
                 return m.channel == ctx.channel and m.author.voice and m.author.voice.channel == vc.channel
 
-            vc.play(discord.FFmpegPCMAudio(audio_file), after=lambda e: print('done', e))
+            vc.play(quiz_source(audio_file), after=lambda e: print('done', e))
 
             try:
                 correct = False
@@ -1257,13 +1408,11 @@ def setup_commands(bot):
                 while vc.is_playing():
                     try:
                         msg = await bot.wait_for('message', check=check, timeout=1)
-                        matched_anime, score = process.extractOne(msg.content, quiz_data.keys(), scorer=fuzz.ratio)
+                        matched_anime, score = process.extractOne(msg.content, session.tracks.keys(), scorer=fuzz.ratio)
                         if score >= 70 and matched_anime == anime:
                             user = msg.author
-                            if user not in scores:
-                                scores[user] = 0
-                            scores[user] += 1
-                            await ctx.send(f'{user.name} guessed it right! The correct answer was {matched_anime}. They now have **{scores[user]}** points.')
+                            points = session.add_point(user)
+                            await ctx.send(f'{user.name} guessed it right! The correct answer was {matched_anime}. They now have **{points}** points.')
                             vc.stop()
                             correct = True
                             break
@@ -1273,7 +1422,7 @@ def setup_commands(bot):
                             await ctx.send(f'Music skipped because the song is unknown, it was: {anime}')
                             break
                         elif msg.content.lower() == 'end':
-                            fastend = True
+                            session.ended = True
                             vc.stop()
                             correct = True
                             break
@@ -1281,28 +1430,22 @@ def setup_commands(bot):
                         pass
 
                 if not correct:
-                    await asyncio.sleep(max(0, 30 - (asyncio.get_event_loop().time() - start_time)))
+                    await asyncio.sleep(max(0, QUIZ_CLIP_SECONDS - (asyncio.get_event_loop().time() - start_time)))
                     await ctx.send(f'Music skipped because no one found it, it was: {anime}')
                         
             except Exception as e:
                 print(f"Error playing audio: {e}")
                 await ctx.send(f"Error playing audio: {e}")
 
-            os.remove(audio_file)
+            session.finish_round()
 
-            if any(score >= 10 for score in scores.values()) or fastend == True:
-                if fastend == True:
-                    scores.clear()
-                    fastend = False
-                    await ctx.send(f'Game ended because of !end.')
-                    break
-                else: 
-                    winner = max(scores, key=scores.get)
-                    await ctx.send(f'**{winner.name}** has won the quiz with **{scores[winner]}** points!')
-                    scores.clear()
-                    break
-
-        await vc.disconnect()
+            if session.ended:
+                await ctx.send(f'Game ended because of !end.')
+                break
+            winner = session.winner()
+            if winner is not None:
+                await ctx.send(f'**{winner.name}** has won the quiz with **{session.scores[winner]}** points!')
+                break
 
     @bot.command()
     async def upload(ctx):
@@ -1370,14 +1513,13 @@ def setup_commands(bot):
     @bot.command()
     async def init_server(ctx, mod_rank: str, admin_rank: str):
         guild_id = str(ctx.guild.id)
-        initialize_guild(guild_id)
+        await initialize_guild(guild_id)
         cards, user_collections, user_data = guild_data[guild_id]
         
         async with aiohttp.ClientSession() as session:
             for member in ctx.guild.members:
                 if member.bot:
                     continue
-                user_id = str(member.id)
                 nickname = member.display_name
                 profile_picture = member.avatar.url if member.avatar else member.default_avatar.url
 
@@ -1415,9 +1557,9 @@ def setup_commands(bot):
                     'image_urls': img_url,
                     'claimed_by': None
                 }
-                cards.append(card)
-        
-        save_data(guild_id, cards, user_collections, user_data)
+                card = guild_data[guild_id].add_card(card)
+                persistence.record(guild_id, journal.add_card(card))
+
         await ctx.send("Server initialized successfully with member cards.")
 
     @is_admin()
@@ -1429,161 +1571,202 @@ def setup_commands(bot):
             return
 
         guild_id = str(ctx.guild.id)
-        cards, user_collections, user_data = guild_data[guild_id]
+        await initialize_guild(guild_id)
 
         # Find the card by name
-        for card in cards:
-            if card['name'].lower() == card_name.lower():
-                card['rank'] = new_rank
-                card['description'] = new_rank
-                card['value'] = {'SS': 500, 'S': 400, 'A': 300, 'B': 200, 'C': 100, 'D': 50, 'E': 20}[new_rank]
-                save_data(guild_id, cards, user_collections, user_data)
-                await ctx.send(f"The rank of card '{card_name}' has been changed to {new_rank}.")
-                return
+        card = guild_data[guild_id].card(card_name)
+        if not card:
+            await ctx.send(f"No card found with the name '{card_name}'.")
+            return
+
+        guild_data[guild_id].change_rank(card, new_rank)
+        card['description'] = new_rank
+        card['value'] = {'SS': 500, 'S': 400, 'A': 300, 'B': 200, 'C': 100, 'D': 50, 'E': 20}[new_rank]
+        persistence.record(guild_id, journal.update_card(card, 'rank', 'description', 'value'))
+        await ctx.send(f"The rank of card '{card_name}' has been changed to {new_rank}.")
 
-        await ctx.send(f"No card found with the name '{card_name}'.")
+    @is_admin()
+    @bot.command()
+    async def rename_character(ctx, card_name: str, new_name: str):
+        guild_id = str(ctx.guild.id)
+        await initialize_guild(guild_id)
+
+        card = guild_data[guild_id].card(card_name)
+        if not card:
+            await ctx.send(f"No card found with the name '{card_name}'.")
+            return
+
+        # Names index the cards, so two cards may not share one
+        existing = guild_data[guild_id].card(new_name)
+        if existing is not None and existing is not card:
+            await ctx.send(f"Another card is already named '{existing['name']}'.")
+            return
+
+        guild_data[guild_id].rename_card(card, new_name)
+        entries = [journal.update_card(card, 'name')]
+        for member_id in guild_data[guild_id].wishers_of(card):
+            entries.append(journal.update_user(member_id, guild_data[guild_id].user_data[member_id], 'wishes'))
+        persistence.record(guild_id, *entries)
+        await ctx.send(f"The card '{card_name}' has been renamed to '{new_name}'.")
 
     @bot.command(name="auction")
     async def auction(ctx, character_name: str, starting_price: int):
         """Command to start an auction for a character."""
         guild_id = str(ctx.guild.id)
-        initialize_guild(guild_id)
+        await initialize_guild(guild_id)
         user_id = str(ctx.author.id)
-        cards, user_collections, user_data = guild_data[guild_id]
+        house = auctions.house(guild_id)
         
         # Check if the user owns the character
-        character = next((c for c in user_collections.get(user_id, []) if c['name'].lower() == character_name.lower()), None)
+        character = guild_data[guild_id].owned_card(user_id, character_name)
         if not character:
             await ctx.send("You don't own this character.")
             return
 
         # Check if there is already an active auction for this character
-        if character_name.lower() in active_auctions:
+        if house.for_card(character['id']):
             await ctx.send("An auction for this character is already active.")
             return
 
-        # Create auction entry
-        auction_data = {
-            "character": character,
-            "starting_price": starting_price,
-            "current_price": starting_price,
-            "current_bidder": None,
-            "end_time": datetime.utcnow() + timedelta(seconds=60),
-            "auctioneer": user_id
-        }
-        active_auctions[character_name.lower()] = auction_data
+        auction = house.open(character, user_id, starting_price, ctx.channel)
+        auction.timer = scheduler.schedule(AUCTION_SECONDS, settle_auction, guild_id, auction)
 
-        await ctx.send(f"Auction started for **{character_name}** with a starting price of {starting_price} coins!")
+        await ctx.send(f"Auction **#{auction.id}** started for **{character['name']}** with a starting price of {starting_price} coins! Bid with `!bid {auction.id} <amount>`.")
 
-        await check_auction_timeout(ctx, character_name.lower(), auction_data)
+    @bot.command(name="auctions")
+    async def list_auctions(ctx):
+        """Command to list the active auctions of the server."""
+        house = auctions.house(str(ctx.guild.id))
+        if not house:
+            await ctx.send("There are no active auctions.")
+            return
+        lines = [f"**#{auction.id}** • {auction.card_name} • {auction.price} coins" + (f" by <@{auction.bidder_id}>" if auction.bidder_id else " (no bids)")
+                 for auction in house.auctions.values()]
+        await ctx.send("\n".join(lines))
 
     @bot.command(name="bid")
-    async def bid(ctx, bid_amount: int):
-        """Command to place a bid on an active auction."""
+    async def bid(ctx, *args: int):
+        """Command to place a bid on an active auction: !bid <auction_id> <amount>, or !bid <amount> when only one auction is running."""
         guild_id = str(ctx.guild.id)
-        initialize_guild(guild_id)
+        await initialize_guild(guild_id)
         user_id = str(ctx.author.id)
-        user_data = guild_data[guild_id][2]
-
-        # Check if there is an active auction
-        if not active_auctions:
-            await ctx.send("There are no active auctions.")
-            return
+        initialize_user(guild_id, user_id)
+        user_data = guild_data[guild_id].user_data
+        house = auctions.house(guild_id)
 
         # Find the auction
-        auction_data = next(iter(active_auctions.values()))
+        if len(args) == 2:
+            auction = house.get(args[0])
+        elif len(args) == 1 and len(house) == 1:
+            auction = next(iter(house.auctions.values()))
+        elif len(args) == 1 and house:
+            await ctx.send("Several auctions are running. Use: !bid <auction_id> <amount> (see !auctions)")
+            return
+        elif len(args) == 1:
+            auction = None
+        else:
+            await ctx.send("Invalid format. Use: !bid <auction_id> <amount>")
+            return
+        bid_amount = args[-1]
+        if not auction or auction.closed:
+            await ctx.send("There is no such active auction.")
+            return
 
         # Check if the bid is higher than the current price
-        if bid_amount <= auction_data['current_price']:
-            await ctx.send(f"Your bid must be higher than the current price of {auction_data['current_price']} coins.")
+        if bid_amount <= auction.price:
+            await ctx.send(f"Your bid must be higher than the current price of {auction.price} coins.")
             return
 
-        # Check if the user has enough coins
-        if bid_amount > user_data[user_id]['coins']:
+        # Check if the user has enough coins that are not held by their other bids
+        available = house.available(user_id, user_data[user_id]['coins'])
+        if auction.bidder_id == user_id:
+            available += auction.price
+        if bid_amount > available:
             await ctx.send("You don't have enough coins to place this bid.")
             return
         
-        # Check if the user has enough coins
-        if user_id == auction_data['auctioneer']:
+        # Check if the user is the auctioneer
+        if user_id == auction.seller_id:
             await ctx.send("You cannot bid on your own auction.")
             return
 
         # Update the auction
-        auction_data['current_price'] = bid_amount
-        auction_data['current_bidder'] = user_id
-        auction_data['end_time'] = datetime.utcnow() + timedelta(seconds=30)
-
-        await ctx.send(f"{ctx.author.display_name} has bid {bid_amount} coins on **{auction_data['character']['name']}**!")
+        house.bid(auction, user_id, bid_amount)
+        scheduler.reschedule(auction.timer, AUCTION_EXTENSION_SECONDS)
 
-    async def check_auction_timeout(ctx, character_name, auction_data):
-        while datetime.utcnow() < auction_data['end_time']:
-            await asyncio.sleep(5)  # Check every 5 seconds
-            if datetime.utcnow() >= auction_data['end_time']:
-                break
+        await ctx.send(f"{ctx.author.display_name} has bid {bid_amount} coins on **{auction.card_name}** (auction #{auction.id})!")
 
-        guild_id = str(ctx.guild.id)
-        cards, user_collections, user_data = guild_data[guild_id]
-
-        # Auction ended
-        if auction_data['current_bidder']:
-            winner_id = auction_data['current_bidder']
-            auctioneer_id = auction_data['auctioneer']
-            winner = await ctx.guild.fetch_member(winner_id)
-            winner_data = user_data[str(winner_id)]
-
-            # Update the claimed_by attribute
-            auction_data['character']['claimed_by'] = winner_id
-
-            # Deduct coins from the winner and add the card to their collection
-            winner_data['coins'] -= auction_data['current_price']
-            cards = next(c for c in cards if c['name'].lower() == auction_data['character']['name'].lower())
-            cards['claimed_by'] = str(winner_id)
-            user_collections.setdefault(str(winner_id), []).append(auction_data['character'])
-            # Remove character from user's collection and reset claimed_by
-            user_collections[auctioneer_id].remove(auction_data['character'])
-            # Calculate the auctioneer's earnings (97% of the final bid)
-            auctioneer_earnings = int(auction_data['current_price'] * 0.97)
-            auctioneer_data = user_data[str(auctioneer_id)]
-            auctioneer_data['coins'] += auctioneer_earnings
-
-            save_data(guild_id, cards, user_collections, user_data)
-            await ctx.send(f"Auction for **{auction_data['character']['name']}** won by {winner.display_name} for {auction_data['current_price']} coins! The auctioneer earns {auctioneer_earnings} coins. Because of the 3% taxes...")
-        else:
-            await ctx.send(f"Auction for **{auction_data['character']['name']}** ended with no bids.")
+    async def settle_auction(guild_id, auction):
+        # Closed before the first await, so no bid can land on an auction being settled
+        if not auctions.house(guild_id).close(auction):
+            return
+        auctions.settled += 1
+        await initialize_guild(guild_id)
+        state = guild_data[guild_id]
+        user_data = state.user_data
+        winner_id = auction.bidder_id
+        auctioneer_id = auction.seller_id
+
+        if not winner_id:
+            await auction.channel.send(f"Auction for **{auction.card_name}** ended with no bids.")
+            return
 
-        del active_auctions[character_name]
+        async with transactions.transaction(guild_id, users=[winner_id, auctioneer_id], cards=[auction.card_id]) as tx:
+            card = state.cards_by_id.get(auction.card_id)
+            if card is None or state.owned_card(auctioneer_id, card['name']) is not card:
+                outcome = f"Auction for **{auction.card_name}** was cancelled: the auctioneer no longer owns it."
+            elif user_data[winner_id]['coins'] < auction.price:
+                outcome = f"Auction for **{auction.card_name}** was cancelled: <@{winner_id}> can no longer pay {auction.price} coins."
+            else:
+                winner_data = user_data[winner_id]
+                auctioneer_data = user_data[auctioneer_id]
+                # Deduct coins from the winner and move the card from the auctioneer's collection to theirs
+                winner_data['coins'] -= auction.price
+                state.uncollect(auctioneer_id, card)
+                state.collect(winner_id, card)
+                # Calculate the auctioneer's earnings (97% of the final bid)
+                auctioneer_earnings = int(auction.price * 0.97)
+                auctioneer_data['coins'] += auctioneer_earnings
+
+                tx.record(
+                    journal.update_card(card, 'claimed_by'),
+                    journal.coins(winner_id, winner_data, -auction.price),
+                    journal.collect(winner_id, card),
+                    journal.uncollect(auctioneer_id, card),
+                    journal.coins(auctioneer_id, auctioneer_data, auctioneer_earnings),
+                )
+                outcome = f"Auction for **{card['name']}** won by <@{winner_id}> for {auction.price} coins! The auctioneer earns {auctioneer_earnings} coins. Because of the 3% taxes..."
+        await auction.channel.send(outcome)
 
     @bot.command(name="sell")
     async def sell(ctx, character_name: str, price: int):
         """Command to list a character on the black market."""
         guild_id = str(ctx.guild.id)
-        initialize_guild(guild_id)
+        await initialize_guild(guild_id)
         user_id = str(ctx.author.id)
         cards, user_collections, user_data = guild_data[guild_id]
-        black_market = load_black_market(guild_id)
+        black_market = guild_data[guild_id].black_market
         
         # Check if the user owns the character
-        character = next((c for c in user_collections.get(user_id, []) if c['name'].lower() == character_name.lower()), None)
+        character = guild_data[guild_id].owned_card(user_id, character_name)
         if not character:
             await ctx.send("You don't own this character.")
             return
 
         # Check if the user already has 3 items on the market
-        user_listings = [item for item in black_market.values() if item['seller_id'] == user_id]
-        if len(user_listings) >= 3:
+        if black_market.seller_count(user_id) >= 3:
             await ctx.send("You can only have 3 items on the market at a time.")
             return
 
         # Add the character to the black market
         listing_id = f"{character_name.lower()}_{user_id}"
-        black_market[listing_id] = {
+        black_market.add(listing_id, {
             "character": character,
             "price": price,
             "seller_id": user_id
-        }
-        user_collections[user_id].remove(character)
-        save_black_market(guild_id, black_market)
-        save_data(guild_id, cards, user_collections, user_data)
+        })
+        guild_data[guild_id].uncollect(user_id, character)
+        persistence.record(guild_id, journal.uncollect(user_id, character), journal.list_item(listing_id, black_market[listing_id]))
 
         await ctx.send(f"Character **{character_name}** listed on the black market for {price} coins.")
 
@@ -1591,47 +1774,55 @@ def setup_commands(bot):
     async def buy(ctx, character_name: str):
         """Command to buy a character from the black market."""
         guild_id = str(ctx.guild.id)
-        initialize_guild(guild_id)
+        await initialize_guild(guild_id)
         user_id = str(ctx.author.id)
-        user_data = guild_data[guild_id][2]
-        user_collections = guild_data[guild_id][1]
-        black_market = load_black_market(guild_id)
+        user_data = guild_data[guild_id].user_data
+        black_market = guild_data[guild_id].black_market
 
         # Find the listing
-        listing_id = next((id for id in black_market if black_market[id]['character']['name'].lower() == character_name.lower()), None)
+        listing_id = black_market.find(character_name)
         if not listing_id:
             await ctx.send("This character is not on the black market.")
             return
 
         listing = black_market[listing_id]
         price = listing['price']
-
-        # Check if the user has enough coins
-        if user_data[user_id]['coins'] < price:
-            await ctx.send("You don't have enough coins to buy this character.")
+        seller_id = listing['seller_id']
+        character = listing['character']
+        if character.get('id') is None:
+            await ctx.send("This character no longer exists.")
             return
 
-        # Transfer the character and update coins
-        seller_id = listing['seller_id']
-        seller_data = guild_data[guild_id][2][seller_id]
-        tax = int(price * 0.03)
-        net_price = price - tax
+        async with transactions.transaction(guild_id, users=[user_id, seller_id], cards=[character['id']]) as tx:
+            # Another buyer may have taken the listing while this one waited for the locks
+            if black_market.listings.get(listing_id) is not listing:
+                await ctx.send("This character is not on the black market.")
+                return
 
-        user_data[user_id]['coins'] -= price
-        seller_data['coins'] += net_price
-        character = listing['character']
-        character['claimed_by'] = user_id
-        cards, user_collections, user_data = guild_data[guild_id]
-        cards = next(c for c in cards if c['name'].lower() == character['name'].lower())
-        cards['claimed_by'] = user_id
-        user_collections[seller_id].remove(character)
-        user_collections[user_id].append(character)
-        # guild_data[guild_id][1].setdefault(user_id, []).append(character)
-        save_data(guild_id, *guild_data[guild_id])
+            # Check if the user has enough coins
+            if auctions.available(guild_id, user_id, user_data[user_id]['coins']) < price:
+                await ctx.send("You don't have enough coins to buy this character.")
+                return
 
-        # Remove the listing
-        del black_market[listing_id]
-        save_black_market(guild_id, black_market)
+            # Transfer the character and update coins
+            seller_data = guild_data[guild_id].user_data[seller_id]
+            tax = int(price * 0.03)
+            net_price = price - tax
+
+            user_data[user_id]['coins'] -= price
+            seller_data['coins'] += net_price
+            # The card already left the seller's collection when it was listed
+            guild_data[guild_id].collect(user_id, character)
+
+            # Remove the listing
+            black_market.remove(listing_id)
+            tx.record(
+                journal.coins(user_id, user_data[user_id], -price),
+                journal.coins(seller_id, seller_data, net_price),
+                journal.update_card(character, 'claimed_by'),
+                journal.collect(user_id, character),
+                journal.delist(listing_id),
+            )
 
         await ctx.send(f"You bought **{character_name}** for {price} coins. The seller received {net_price} coins after tax.")
 
@@ -1639,36 +1830,41 @@ def setup_commands(bot):
     async def black_market_command(ctx):
         """Command to display the black market listings."""
         guild_id = str(ctx.guild.id)
-        black_market = load_black_market(guild_id)
+        await initialize_guild(guild_id)
+        black_market = guild_data[guild_id].black_market
 
         if not black_market:
             await ctx.send("The black market is empty.")
             return
 
-        paginator = BlackMarketPaginator(guild_id, black_market)
+        paginator = BlackMarketPaginator(guild_id, guild_data[guild_id])
         await paginator.send_initial_message(ctx) 
 
     @bot.command(name="remove-item")
     async def remove_item(ctx, character_name: str):
         """Command to remove a character from the black market."""
         guild_id = str(ctx.guild.id)
-        initialize_guild(guild_id)
+        await initialize_guild(guild_id)
         user_id = str(ctx.author.id)
-        black_market = load_black_market(guild_id)
-        user_collections = guild_data[guild_id][1]
+        black_market = guild_data[guild_id].black_market
 
         # Find the listing
-        listing_id = next((id for id in black_market if black_market[id]['character']['name'].lower() == character_name.lower() and black_market[id]['seller_id'] == user_id), None)
+        listing_id = black_market.find(character_name, user_id)
         if not listing_id:
             await ctx.send("You don't have this character listed on the black market.")
             return
 
         # Remove the listing and restore the character to the user's collection
         character = black_market[listing_id]['character']
-        user_collections.setdefault(user_id, []).append(character)
-        save_data(guild_id, *guild_data[guild_id])
+        if character.get('id') is None:
+            # A legacy listing whose card no longer exists has nothing to give back
+            black_market.remove(listing_id)
+            persistence.record(guild_id, journal.delist(listing_id))
+            await ctx.send(f"Character **{character_name}** no longer exists, its listing has been removed.")
+            return
+        guild_data[guild_id].collect(user_id, character)
 
-        del black_market[listing_id]
-        save_black_market(guild_id, black_market)
+        black_market.remove(listing_id)
+        persistence.record(guild_id, journal.collect(user_id, character), journal.delist(listing_id))
 
         await ctx.send(f"Character **{character_name}** has been removed from the black market and returned to your collection.")
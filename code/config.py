@@ -1,12 +1,158 @@
-from utils import load_data
+import asyncio
+import os
+import time
+from state import GuildState
+from storage import guild_lock, load_guild_async, run_io
 
-guild_data = {}
+# With the cache disabled every command reloads its guild from storage instead
+# of keeping it resident in guild_data. Guilds that are leased or inside a
+# transaction are not reloaded, so a flow waiting on users or locks never ends
+# up changing a GuildState that has been replaced under it.
+CACHE_GUILD_DATA = os.getenv('NAPO_CACHE_GUILD_DATA', '1') != '0'
+# Guilds untouched for GUILD_IDLE_SECONDS are written back and dropped; beyond
+# that, the least recently used guilds are evicted while the resident cards,
+# collected cards, users and listings add up to more than GUILD_CACHE_BUDGET records.
+GUILD_IDLE_SECONDS = float(os.getenv('NAPO_GUILD_IDLE_SECONDS', '1800'))
+GUILD_CACHE_BUDGET = int(os.getenv('NAPO_GUILD_CACHE_BUDGET', '500000'))
+EVICTION_INTERVAL = float(os.getenv('NAPO_EVICTION_INTERVAL', '60'))
+# Added to every lease, so work finishing just after its timeout is still covered.
+GUILD_LEASE_GRACE = 30
 
-def initialize_guild_data(bot):
-    global guild_data
-    for guild in bot.guilds:
-        guild_data[guild.id] = load_data(guild.id)
 
-def load_guild_data(guild):
-    global guild_data
-    guild_data[guild.id] = load_data(guild.id)
+def guild_size(data):
+    cards, user_collections, user_data = data
+    return len(cards) + sum(len(collection) for collection in user_collections.values()) + len(user_data) + len(data.black_market)
+
+
+class GuildCache(dict):
+    """Resident guild data, loaded on first access and evicted when idle.
+
+    Commands that wait for users before changing a guild lease it first: a
+    leased guild is neither evicted nor reloaded, so the GuildState they hold
+    is still the live one when they resume.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.last_access = {}
+        self.leases = {}
+        self.loading = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.total_load_latency = 0.0
+        self.max_load_latency = 0.0
+        self._task = None
+
+    def __getitem__(self, guild_id):
+        self.last_access[guild_id] = time.monotonic()
+        return super().__getitem__(guild_id)
+
+    def __setitem__(self, guild_id, data):
+        self.last_access[guild_id] = time.monotonic()
+        super().__setitem__(guild_id, data)
+
+    async def load(self, guild_id, refresh=False):
+        if guild_id in self and (not refresh or self.leased(guild_id)):
+            self.hits += 1
+            return self[guild_id]
+        # Concurrent commands for a cold guild share a single load.
+        if guild_id not in self.loading:
+            load = self.loading[guild_id] = asyncio.ensure_future(self._load(guild_id))
+            # Dropped only once the load itself is done: a cancelled caller leaves it running,
+            # and a second load would replace the state it installs.
+            load.add_done_callback(lambda _: self.loading.pop(guild_id, None))
+        return await asyncio.shield(self.loading[guild_id])
+
+    def lease(self, guild_id, seconds):
+        """Keep the resident guild in place for at least seconds and return it."""
+        until = time.monotonic() + seconds + GUILD_LEASE_GRACE
+        self.leases[guild_id] = max(self.leases.get(guild_id, until), until)
+        return self[guild_id]
+
+    def leased(self, guild_id):
+        until = self.leases.get(guild_id)
+        if until is not None and until <= time.monotonic():
+            del self.leases[guild_id]
+            until = None
+        return until is not None
+
+    async def _load(self, guild_id):
+        self.misses += 1
+        start = time.perf_counter()
+        # Building the indexes of a large guild takes a while, so it happens off the event loop too.
+        data = await run_io(GuildState, *await load_guild_async(guild_id))
+        latency = time.perf_counter() - start
+        self.total_load_latency += latency
+        self.max_load_latency = max(self.max_load_latency, latency)
+        self[guild_id] = data
+        return data
+
+    def in_use(self, guild_id, transactions):
+        # Commands inside a transaction hold this GuildState across their lock waits.
+        return self.leased(guild_id) or transactions.busy(guild_id)
+
+    async def evict(self, guild_id, persistence, transactions):
+        if self.in_use(guild_id, transactions):
+            return False
+        last_access = self.last_access.get(guild_id)
+        # Waits for a flush already writing the guild instead of taking its early return.
+        await persistence.flush_guild(guild_id, wait=True)
+        # Keep the guild if it is still dirty, was used or leased meanwhile, or another flush is writing it now.
+        if (guild_id in persistence.dirty or self.last_access.get(guild_id) != last_access
+                or self.in_use(guild_id, transactions) or guild_lock(guild_id).locked()):
+            return False
+        self.pop(guild_id, None)
+        self.last_access.pop(guild_id, None)
+        self.evictions += 1
+        return True
+
+    async def evict_idle(self, persistence, transactions):
+        now = time.monotonic()
+        by_age = sorted(self.last_access, key=self.last_access.get)
+        for guild_id in by_age:
+            if now - self.last_access.get(guild_id, now) >= GUILD_IDLE_SECONDS:
+                await self.evict(guild_id, persistence, transactions)
+        resident = sum(guild_size(data) for data in self.values())
+        for guild_id in by_age:
+            if resident <= GUILD_CACHE_BUDGET:
+                break
+            if guild_id in self:
+                size = guild_size(super().__getitem__(guild_id))
+                if await self.evict(guild_id, persistence, transactions):
+                    resident -= size
+
+    async def run(self, persistence, transactions):
+        while True:
+            await asyncio.sleep(EVICTION_INTERVAL)
+            try:
+                await self.evict_idle(persistence, transactions)
+            except Exception as e:
+                print(f"Error evicting guilds: {e}")
+
+    def start(self, persistence, transactions):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self.run(persistence, transactions))
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'resident_guilds': len(self),
+            'resident_records': sum(guild_size(data) for data in self.values()),
+            'leased': sum(1 for guild_id in list(self.leases) if self.leased(guild_id)),
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'loads': self.misses,
+            'evictions': self.evictions,
+            'avg_load_ms': self.total_load_latency / self.misses * 1000 if self.misses else 0.0,
+            'max_load_ms': self.max_load_latency * 1000,
+            'memo_hits': sum(data.memo_hits for data in self.values()),
+            'memo_builds': sum(data.memo_builds for data in self.values()),
+        }
+
+
+guild_data = GuildCache()
@@ -0,0 +1,162 @@
+import glob
+import json
+import os
+
+from records import to_json
+
+# Every mutation is appended to the guild's journal as one JSON line holding a
+# list of entries, so a command's changes are either fully on disk or not at all
+# (a torn last line is ignored on replay). Entries record the resulting state
+# rather than a relative change, which makes replaying a segment on top of a
+# snapshot that already contains it harmless.
+
+# Guild files each operation touches, used to decide what the compactor rewrites.
+OP_FILES = {
+    'add_card': ('cards',),
+    'card': ('cards',),
+    'collect': ('collections',),
+    'uncollect': ('collections',),
+    'user': ('user_data',),
+    'coins': ('user_data',),
+    'list': ('black_market',),
+    'delist': ('black_market',),
+}
+
+
+class Journal:
+    def __init__(self, prefix):
+        self.prefix = prefix
+        generations = [generation for generation, _ in self.segments()]
+        self.generation = max(generations) + 1 if generations else 0
+
+    def segment_file(self, generation):
+        return f'{self.prefix}.{generation}.log'
+
+    def segments(self):
+        segments = []
+        for path in glob.glob(f'{glob.escape(self.prefix)}.*.log'):
+            generation = path[len(self.prefix) + 1:-len('.log')]
+            if generation.isdigit():
+                segments.append((int(generation), path))
+        return sorted(segments)
+
+    def append(self, payload):
+        with open(self.segment_file(self.generation), 'a') as f:
+            f.write(payload + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def rotate(self):
+        """Seal the current segment; every segment before the returned generation is sealed."""
+        self.generation += 1
+        return self.generation
+
+    def discard_before(self, generation):
+        for segment_generation, path in self.segments():
+            if segment_generation < generation:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    def entries(self):
+        for _, path in self.segments():
+            with open(path, 'r') as f:
+                for line in f:
+                    try:
+                        batch = json.loads(line)
+                    except json.JSONDecodeError:
+                        break
+                    yield from batch
+
+
+def encode(entries):
+    return json.dumps(entries, separators=(',', ':'), default=to_json)
+
+
+def files_for(entries):
+    file_types = set()
+    for entry in entries:
+        file_types.update(OP_FILES[entry['op']])
+    return file_types
+
+
+def add_card(card):
+    return {'op': 'add_card', 'card': card}
+
+
+def update_card(card, *fields):
+    return {'op': 'card', 'id': card['id'], 'fields': {field: card.get(field) for field in fields}}
+
+
+def collect(user_id, card):
+    return {'op': 'collect', 'user': user_id, 'id': card['id']}
+
+
+def uncollect(user_id, card):
+    return {'op': 'uncollect', 'user': user_id, 'id': card['id']}
+
+
+def update_user(user_id, user, *fields):
+    """Record the given fields of a user, or the whole record if none are given."""
+    return {'op': 'user', 'user': user_id, 'fields': {field: user.get(field) for field in (fields or user)}}
+
+
+def coins(user_id, user, delta):
+    return {'op': 'coins', 'user': user_id, 'delta': delta, 'balance': user['coins']}
+
+
+def list_item(listing_id, listing):
+    return {'op': 'list', 'listing_id': listing_id, 'listing': listing}
+
+
+def delist(listing_id):
+    return {'op': 'delist', 'listing_id': listing_id}
+
+
+def find_card(cards_by_id, cards, entry):
+    # Entries written before cards had ids refer to them by name.
+    if 'id' in entry:
+        return cards_by_id.get(entry['id'])
+    return next((c for c in cards if c['name'] == entry['name']), None)
+
+
+def replay(journal, cards, user_collections, user_data):
+    cards_by_id = {card['id']: card for card in cards}
+    for entry in journal.entries():
+        op = entry['op']
+        if op == 'add_card':
+            card = entry['card']
+            if 'id' not in card:
+                if any(c['name'] == card['name'] for c in cards):
+                    continue
+                card['id'] = max(cards_by_id, default=0) + 1
+            if card['id'] not in cards_by_id:
+                cards.append(card)
+                cards_by_id[card['id']] = card
+        elif op == 'card':
+            card = find_card(cards_by_id, cards, entry)
+            if card:
+                card.update(entry['fields'])
+        elif op == 'collect':
+            collection = user_collections.setdefault(entry['user'], [])
+            card = find_card(cards_by_id, cards, entry)
+            if card and card not in collection:
+                collection.append(card)
+        elif op == 'uncollect':
+            collection = user_collections.get(entry['user'], [])
+            card = find_card(cards_by_id, cards, entry)
+            if card in collection:
+                collection.remove(card)
+        elif op == 'user':
+            user_data.setdefault(entry['user'], {}).update(entry['fields'])
+        elif op == 'coins':
+            user_data.setdefault(entry['user'], {})['coins'] = entry['balance']
+
+
+def replay_black_market(journal, black_market):
+    for entry in journal.entries():
+        if entry['op'] == 'list':
+            black_market[entry['listing_id']] = entry['listing']
+        elif entry['op'] == 'delist':
+            black_market.pop(entry['listing_id'], None)
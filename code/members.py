@@ -0,0 +1,104 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict
+
+import discord
+
+# Profiles fetched over REST are kept for MEMBER_CACHE_TTL seconds, at most
+# MEMBER_CACHE_SIZE of them, least recently used first out.
+MEMBER_CACHE_TTL = float(os.getenv('NAPO_MEMBER_CACHE_TTL', '600'))
+MEMBER_CACHE_SIZE = int(os.getenv('NAPO_MEMBER_CACHE_SIZE', '10000'))
+
+
+class Profile:
+    """What embeds show of a member: their names and avatar."""
+
+    __slots__ = ('name', 'display_name', 'avatar_url')
+
+    def __init__(self, name, display_name, avatar_url):
+        self.name = name
+        self.display_name = display_name
+        self.avatar_url = avatar_url
+
+    @classmethod
+    def from_member(cls, member):
+        avatar = member.avatar or member.default_avatar
+        return cls(member.name, member.display_name, avatar.url)
+
+
+# Shown for members who have left the guild.
+UNKNOWN_MEMBER = Profile('Unknown member', 'Unknown member', None)
+
+
+class MemberCache:
+    """Member profiles for embeds, without a REST request per page flip.
+
+    The gateway member cache is checked first. Members missing from it are
+    fetched once, with concurrent requests for the same member sharing the
+    fetch, and kept until the TTL runs out or a member event invalidates them.
+    """
+
+    def __init__(self, ttl=MEMBER_CACHE_TTL, size=MEMBER_CACHE_SIZE):
+        self.ttl = ttl
+        self.size = size
+        self.profiles = OrderedDict()
+        self.fetching = {}
+        self.gateway_hits = 0
+        self.hits = 0
+        self.fetches = 0
+        self.coalesced = 0
+
+    async def get(self, guild, user_id):
+        user_id = int(user_id)
+        member = guild.get_member(user_id)
+        if member is not None:
+            self.gateway_hits += 1
+            return Profile.from_member(member)
+        key = (guild.id, user_id)
+        entry = self.profiles.get(key)
+        if entry and entry[0] > time.monotonic():
+            self.profiles.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+        if key in self.fetching:
+            self.coalesced += 1
+        else:
+            fetch = self.fetching[key] = asyncio.ensure_future(self._fetch(guild, user_id))
+            # Dropped only once the fetch itself is done: a cancelled caller leaves it running.
+            fetch.add_done_callback(lambda _: self.fetching.pop(key, None))
+        return await asyncio.shield(self.fetching[key])
+
+    async def _fetch(self, guild, user_id):
+        self.fetches += 1
+        try:
+            profile = Profile.from_member(await guild.fetch_member(user_id))
+        except discord.NotFound:
+            profile = UNKNOWN_MEMBER
+        self.profiles[(guild.id, user_id)] = (time.monotonic() + self.ttl, profile)
+        self.profiles.move_to_end((guild.id, user_id))
+        while len(self.profiles) > self.size:
+            self.profiles.popitem(last=False)
+        return profile
+
+    def invalidate(self, guild_id, user_id):
+        self.profiles.pop((guild_id, int(user_id)), None)
+
+    def invalidate_user(self, user_id):
+        # A global name or avatar change applies to every guild the user is in.
+        for key in [key for key in self.profiles if key[1] == int(user_id)]:
+            del self.profiles[key]
+
+    def stats(self):
+        lookups = self.gateway_hits + self.hits + self.fetches + self.coalesced
+        return {
+            'cached': len(self.profiles),
+            'gateway_hits': self.gateway_hits,
+            'hits': self.hits,
+            'fetches': self.fetches,
+            'coalesced': self.coalesced,
+            'rest_rate': self.fetches / lookups if lookups else 0.0,
+        }
+
+
+members = MemberCache()
@@ -0,0 +1,151 @@
+import asyncio
+import os
+import pickle
+import time
+
+from config import guild_data
+from journal import encode, files_for
+from storage import backend, guild_lock, guild_locks, run_io, run_ordered, save_guild, SNAPSHOT_TYPES
+
+# Mutations are durable as soon as they hit the journal, so dirty guilds only
+# need compacting into a fresh snapshot every FLUSH_INTERVAL seconds, or sooner
+# once FLUSH_THRESHOLD mutations have piled up since the last flush.
+FLUSH_INTERVAL = float(os.getenv('NAPO_FLUSH_INTERVAL', '60'))
+FLUSH_THRESHOLD = int(os.getenv('NAPO_FLUSH_THRESHOLD', '100'))
+
+
+def snapshot(data):
+    # A C-speed deep copy taken on the event loop, so the slow indented JSON
+    # encoding can run in a worker thread while commands keep mutating the original.
+    return pickle.loads(pickle.dumps(data, pickle.HIGHEST_PROTOCOL))
+
+
+class PersistenceManager:
+    """Write-behind persistence for guild_data.
+
+    Commands append their changes to the guild journal and mark the files they
+    touched as dirty; a background task compacts the journal by writing the
+    dirty files out as a new snapshot. All disk access happens in the storage
+    executors, with at most one snapshot write per guild in flight.
+    """
+
+    def __init__(self, interval=FLUSH_INTERVAL, threshold=FLUSH_THRESHOLD):
+        self.interval = interval
+        self.threshold = threshold
+        self.dirty = {}
+        self.pending = 0
+        self.flush_count = 0
+        self.files_written = 0
+        self.coalesced = 0
+        self.total_latency = 0.0
+        self.last_latency = 0.0
+        self.max_latency = 0.0
+        self.locks = guild_locks
+        self._wakeup = None
+        self._task = None
+
+    def mark_dirty(self, guild_id, *file_types):
+        self.dirty.setdefault(guild_id, set()).update(file_types or SNAPSHOT_TYPES)
+        self.pending += 1
+        if self.pending >= self.threshold and self._wakeup:
+            self._wakeup.set()
+
+    def record(self, guild_id, *entries):
+        # Encode now so the journal gets the state as of this call; the writer thread appends it in order.
+        future = run_ordered(backend.record, guild_id, encode(entries))
+        future.add_done_callback(lambda f: f.exception() and print(f"Error journaling guild {guild_id}: {f.exception()}"))
+        file_types = files_for(entries)
+        data = guild_data.get(guild_id)
+        if data is not None:
+            data.touch(*file_types)
+        if file_types and backend.needs_compaction:
+            self.mark_dirty(guild_id, *file_types)
+
+    def discard(self, guild_id):
+        self.dirty.pop(guild_id, None)
+
+    async def flush_guild(self, guild_id, wait=False):
+        lock = guild_lock(guild_id)
+        if lock.locked() and not wait:
+            # The guild stays dirty and the next flush writes whatever is latest by then.
+            self.coalesced += 1
+            return 0
+        async with lock:
+            file_types = self.dirty.pop(guild_id, None)
+            # dict.get does not count as an access, so flushing never keeps a guild resident.
+            data = guild_data.get(guild_id)
+            if not file_types or data is None:
+                return 0
+            file_types = [t for t in SNAPSHOT_TYPES if t in file_types]
+            contents = snapshot((data.cards, data.user_collections, data.user_data, data.black_market.listings))
+            # Entries queued before the seal land in the segments this snapshot replaces.
+            generation = await run_ordered(backend.seal, guild_id)
+            try:
+                await run_io(save_guild, guild_id, *contents, file_types)
+            except Exception:
+                self.dirty.setdefault(guild_id, set()).update(file_types)
+                raise
+            await run_ordered(backend.release, guild_id, generation)
+            return len(file_types)
+
+    async def flush_all(self):
+        if not self.dirty:
+            return
+        start = time.perf_counter()
+        self.pending = 0
+        written = 0
+        for guild_id in list(self.dirty):
+            try:
+                written += await self.flush_guild(guild_id)
+            except Exception as e:
+                print(f"Error flushing data for guild {guild_id}: {e}")
+        latency = time.perf_counter() - start
+        self.flush_count += 1
+        self.files_written += written
+        self.total_latency += latency
+        self.last_latency = latency
+        self.max_latency = max(self.max_latency, latency)
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush_all()
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for lock in list(self.locks.values()):
+            async with lock:
+                pass
+        await self.flush_all()
+        await run_ordered(lambda: None)
+
+    def stats(self):
+        average = self.total_latency / self.flush_count if self.flush_count else 0.0
+        return {
+            'dirty_guilds': len(self.dirty),
+            'pending_mutations': self.pending,
+            'flushes': self.flush_count,
+            'files_written': self.files_written,
+            'coalesced_writes': self.coalesced,
+            'last_flush_ms': self.last_latency * 1000,
+            'avg_flush_ms': average * 1000,
+            'max_flush_ms': self.max_latency * 1000,
+        }
+
+
+manager = PersistenceManager()
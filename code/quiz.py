@@ -0,0 +1,108 @@
+import os
+import time
+
+from quiz_audio import TrackPrefetcher
+
+# At most QUIZ_MAX_SESSIONS quizzes play at once in this process, one per guild
+# since a bot has a single voice connection per guild.
+QUIZ_MAX_SESSIONS = int(os.getenv('NAPO_QUIZ_MAX_SESSIONS', '8'))
+QUIZ_WINNING_SCORE = 10
+
+
+class QuizSession:
+    """One guild's running quiz: its voice connection, scores and upcoming tracks.
+
+    Sessions share nothing but the audio cache, so quizzes running in several
+    guilds never see each other's scores or files. The track being played
+    stays pinned until finish_round(), and stop() releases everything the
+    session still holds.
+    """
+
+    def __init__(self, guild_id, tracks):
+        self.guild_id = guild_id
+        self.tracks = tracks
+        self.voice_client = None
+        self.scores = {}
+        self.prefetcher = TrackPrefetcher(tracks)
+        self.current = None
+        self.ended = False
+        self.rounds = 0
+        self.started_at = time.monotonic()
+
+    def start(self):
+        self.prefetcher.start()
+
+    async def next_track(self, timeout):
+        """The next (anime, path) to play, or None if no track became ready in time."""
+        track = await self.prefetcher.next(timeout=timeout)
+        if track is not None:
+            self.current = track[1]
+            self.rounds += 1
+        return track
+
+    def finish_round(self):
+        if self.current is not None:
+            self.prefetcher.release(self.current)
+            self.current = None
+
+    def add_point(self, user):
+        self.scores[user] = self.scores.get(user, 0) + 1
+        return self.scores[user]
+
+    def winner(self):
+        leader = max(self.scores, key=self.scores.get, default=None)
+        return leader if leader is not None and self.scores[leader] >= QUIZ_WINNING_SCORE else None
+
+    async def stop(self):
+        self.finish_round()
+        await self.prefetcher.stop()
+        if self.voice_client is not None and self.voice_client.is_connected():
+            await self.voice_client.disconnect()
+
+
+class QuizRegistry:
+    """The quiz sessions running in this process, keyed by guild id."""
+
+    def __init__(self, limit=QUIZ_MAX_SESSIONS):
+        self.limit = limit
+        self.sessions = {}
+        self.started = 0
+        self.rejected = 0
+
+    def get(self, guild_id):
+        return self.sessions.get(guild_id)
+
+    def open(self, guild_id, tracks):
+        """Start a session for the guild, or return None when the process already runs its limit of quizzes."""
+        if len(self.sessions) >= self.limit:
+            self.rejected += 1
+            return None
+        session = self.sessions[guild_id] = QuizSession(guild_id, tracks)
+        session.start()
+        self.started += 1
+        return session
+
+    async def close(self, session):
+        if self.sessions.get(session.guild_id) is session:
+            del self.sessions[session.guild_id]
+        await session.stop()
+
+    async def close_all(self):
+        for session in list(self.sessions.values()):
+            await self.close(session)
+
+    def stats(self):
+        now = time.monotonic()
+        return {
+            'active': len(self.sessions),
+            'limit': self.limit,
+            'started': self.started,
+            'rejected': self.rejected,
+            'sessions': [
+                {'guild_id': session.guild_id, 'rounds': session.rounds, 'players': len(session.scores), 'minutes': (now - session.started_at) / 60}
+                for session in self.sessions.values()
+            ],
+        }
+
+
+quizzes = QuizRegistry()
@@ -0,0 +1,575 @@
+import asyncio
+import hashlib
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from urllib.parse import parse_qs, urlparse
+
+import discord
+import yt_dlp
+
+from storage import DATA_DIR, read_json, run_ordered, write_json_atomic
+
+# Each running quiz keeps up to QUIZ_PREFETCH downloaded tracks ready, fetched
+# by QUIZ_PREFETCH_WORKERS tasks per quiz. Downloads share one pool of
+# QUIZ_DOWNLOAD_WORKERS threads across all guilds, and a track that is not
+# ready within QUIZ_TRACK_TIMEOUT seconds is skipped.
+QUIZ_PREFETCH = int(os.getenv('NAPO_QUIZ_PREFETCH', '3'))
+QUIZ_PREFETCH_WORKERS = int(os.getenv('NAPO_QUIZ_PREFETCH_WORKERS', '2'))
+QUIZ_DOWNLOAD_WORKERS = int(os.getenv('NAPO_QUIZ_DOWNLOAD_WORKERS', '4'))
+QUIZ_TRACK_TIMEOUT = float(os.getenv('NAPO_QUIZ_TRACK_TIMEOUT', '60'))
+
+# Downloaded tracks are kept in AUDIO_CACHE_DIR, least recently played first
+# out once they take more than AUDIO_CACHE_BYTES.
+AUDIO_CACHE_DIR = os.getenv('NAPO_AUDIO_CACHE_DIR', os.path.join(DATA_DIR, 'audio'))
+AUDIO_CACHE_BYTES = int(os.getenv('NAPO_AUDIO_CACHE_BYTES', str(512 * 1024 * 1024)))
+
+# `python code/quiz_audio.py preprocess` cuts every quiz track to a guessing
+# window of QUIZ_CLIP_SECONDS starting QUIZ_CLIP_START seconds in, normalizes
+# its loudness and stores it as Opus in QUIZ_CLIP_DIR, using
+# QUIZ_PREPROCESS_WORKERS processes. Quizzes play these clips when they exist.
+QUIZ_CLIP_START = float(os.getenv('NAPO_QUIZ_CLIP_START', '0'))
+QUIZ_CLIP_SECONDS = float(os.getenv('NAPO_QUIZ_CLIP_SECONDS', '30'))
+QUIZ_CLIP_BITRATE = os.getenv('NAPO_QUIZ_CLIP_BITRATE', '96k')
+QUIZ_CLIP_DIR = os.getenv('NAPO_QUIZ_CLIP_DIR', os.path.join(DATA_DIR, 'clips'))
+QUIZ_PREPROCESS_WORKERS = int(os.getenv('NAPO_QUIZ_PREPROCESS_WORKERS', str(os.cpu_count() or 1)))
+LOUDNORM = 'loudnorm=I=-16:TP=-1.5:LRA=11'
+
+# Opus files are sent to Discord packet for packet and other tracks are encoded
+# to Opus by FFmpeg. NAPO_QUIZ_OPUS_PASSTHROUGH=0 restores the old path, FFmpeg
+# decoding to PCM and discord.py encoding it, e.g. to compare CPU in !stats.
+QUIZ_OPUS_PASSTHROUGH = os.getenv('NAPO_QUIZ_OPUS_PASSTHROUGH', '1') == '1'
+
+_download_executor = ThreadPoolExecutor(max_workers=QUIZ_DOWNLOAD_WORKERS, thread_name_prefix='napo-quiz')
+
+
+def download_track(url, outtmpl):
+    """Download a track's audio as mp3 and return the file path. Blocking; runs in the download pool."""
+    ydl_opts = {
+        'format': 'bestaudio/best',
+        'postprocessors': [{
+            'key': 'FFmpegExtractAudio',
+            'preferredcodec': 'mp3',
+            'preferredquality': '192',
+        }],
+        'outtmpl': outtmpl,
+        'quiet': True,
+        'socket_timeout': QUIZ_TRACK_TIMEOUT,
+    }
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        info_dict = ydl.extract_info(url, download=True)
+        return ydl.prepare_filename(info_dict).replace('.webm', '.mp3').replace('.m4a', '.mp3')
+
+
+def download_source(url, outtmpl):
+    """Download a track's best audio stream as is and return the file path."""
+    ydl_opts = {
+        'format': 'bestaudio/best',
+        'outtmpl': outtmpl,
+        'quiet': True,
+        'socket_timeout': QUIZ_TRACK_TIMEOUT,
+    }
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        info_dict = ydl.extract_info(url, download=True)
+        return ydl.prepare_filename(info_dict)
+
+
+def video_id(url):
+    """The YouTube video id of a watch or youtu.be URL, or the stripped URL itself for anything else."""
+    url = url.strip()
+    parsed = urlparse(url)
+    if parsed.hostname and parsed.hostname.endswith('youtu.be'):
+        return parsed.path.lstrip('/')
+    ids = parse_qs(parsed.query).get('v')
+    return ids[0] if ids else url
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def store_download(url, directory):
+    """Download url into directory under the SHA-256 of its content; returns (file name, digest, size)."""
+    work_dir = tempfile.mkdtemp(prefix='download-', dir=directory)
+    try:
+        path = download_track(url, os.path.join(work_dir, '%(id)s.%(ext)s'))
+        digest = file_digest(path)
+        name = digest + os.path.splitext(path)[1]
+        os.replace(path, os.path.join(directory, name))
+        return name, digest, os.path.getsize(os.path.join(directory, name))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+class AudioCache:
+    """Quiz tracks on local disk, so an opening is only downloaded once.
+
+    Files are stored under the SHA-256 of their content and the index maps
+    video ids to them. Every hit checks that the file is still there with the
+    recorded size, and the first hit of each entry in a process re-hashes it;
+    entries failing either check are dropped and downloaded again.
+    Concurrent misses for the same video share one download, and files being
+    played or waiting in a prefetch queue are pinned against eviction.
+    """
+
+    def __init__(self, directory=AUDIO_CACHE_DIR, budget=AUDIO_CACHE_BYTES):
+        self.directory = directory
+        self.budget = budget
+        self.index = None
+        self.verified = set()
+        self.pins = {}
+        self.downloading = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.corrupt = 0
+
+    def index_file(self):
+        return os.path.join(self.directory, 'index.json')
+
+    def load(self):
+        if self.index is None:
+            os.makedirs(self.directory, exist_ok=True)
+            self.index = read_json(self.index_file(), {})
+
+    def path(self, entry):
+        return os.path.join(self.directory, entry['file'])
+
+    def size(self):
+        return sum(entry['size'] for entry in self.index.values()) if self.index else 0
+
+    async def fetch(self, url, timeout=QUIZ_TRACK_TIMEOUT):
+        """Path of the track's audio, downloading it on a miss. The file stays pinned until release(path)."""
+        self.load()
+        key = video_id(url)
+        entry = self.index.get(key)
+        hit = entry is not None and await self.check(key, entry)
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+            if key not in self.downloading:
+                download = self.downloading[key] = asyncio.ensure_future(self._download(key, url, timeout))
+                # Dropped only once the download itself is done: a cancelled caller leaves it running.
+                download.add_done_callback(lambda _: self.downloading.pop(key, None))
+            entry = await asyncio.shield(self.downloading[key])
+        entry['last_used'] = time.time()
+        path = self.path(entry)
+        self.pins[path] = self.pins.get(path, 0) + 1
+        if not hit:
+            # Evicting only once the new track is pinned keeps it from being its own victim.
+            # Hits only refresh last_used in memory; it is written out with the next miss.
+            self.evict()
+            self.save()
+        return path
+
+    def release(self, path):
+        self.pins[path] -= 1
+        if not self.pins[path]:
+            del self.pins[path]
+
+    async def check(self, key, entry):
+        path = self.path(entry)
+        try:
+            intact = os.path.getsize(path) == entry['size']
+        except OSError:
+            intact = False
+        if intact and key not in self.verified:
+            loop = asyncio.get_running_loop()
+            intact = await loop.run_in_executor(_download_executor, file_digest, path) == entry['sha256']
+        if intact:
+            self.verified.add(key)
+            return True
+        self.corrupt += 1
+        self.verified.discard(key)
+        if self.index.get(key) is entry:
+            del self.index[key]
+            self._remove_unreferenced(entry['file'])
+        return False
+
+    async def _download(self, key, url, timeout):
+        future = _download_executor.submit(store_download, url, self.directory)
+        try:
+            name, digest, size = await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), timeout=timeout)
+        except asyncio.TimeoutError:
+            # A running download cannot be interrupted; wait it out before giving up,
+            # so timed-out tracks never pile up in the shared pool.
+            if not future.cancel():
+                await asyncio.wait([asyncio.wrap_future(future)])
+                if future.exception() is None:
+                    # The file is in the cache directory either way; indexed, it counts against the budget.
+                    self._add(key, *future.result())
+                    self.evict()
+                    self.save()
+            raise
+        return self._add(key, name, digest, size)
+
+    def _add(self, key, name, digest, size):
+        entry = self.index[key] = {'file': name, 'sha256': digest, 'size': size, 'last_used': time.time()}
+        self.verified.add(key)
+        return entry
+
+    def evict(self):
+        total = self.size()
+        for key in sorted(self.index, key=lambda key: self.index[key]['last_used']):
+            if total <= self.budget:
+                break
+            entry = self.index[key]
+            if self.path(entry) in self.pins:
+                continue
+            del self.index[key]
+            self.verified.discard(key)
+            self._remove_unreferenced(entry['file'])
+            total -= entry['size']
+            self.evictions += 1
+
+    def _remove_unreferenced(self, name):
+        # Identical audio behind two video ids is stored once.
+        if not any(entry['file'] == name for entry in self.index.values()):
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+
+    def save(self):
+        # The writer thread runs writes in submission order, so the latest index is always written last.
+        index = {key: dict(entry) for key, entry in self.index.items()}
+        future = run_ordered(write_json_atomic, self.index_file(), index)
+        future.add_done_callback(lambda f: f.exception() and print(f"Error saving the audio cache index: {f.exception()}"))
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self.index) if self.index else 0,
+            'bytes': self.size(),
+            'budget': self.budget,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'corrupt': self.corrupt,
+        }
+
+
+audio_cache = AudioCache()
+
+
+def clip_settings():
+    """Everything a clip's audio depends on besides its source; a clip made with other settings is encoded again."""
+    return {'start': QUIZ_CLIP_START, 'seconds': QUIZ_CLIP_SECONDS, 'bitrate': QUIZ_CLIP_BITRATE, 'filter': LOUDNORM}
+
+
+def encode_clip(source, path, settings):
+    # 48 kHz stereo is what Discord voice expects, so the clip needs no resampling when played.
+    subprocess.run([
+        'ffmpeg', '-nostdin', '-loglevel', 'error', '-y',
+        '-ss', str(settings['start']), '-t', str(settings['seconds']), '-i', source,
+        '-vn', '-af', settings['filter'], '-ar', '48000', '-ac', '2',
+        '-c:a', 'libopus', '-b:a', settings['bitrate'], path,
+    ], check=True, capture_output=True, timeout=QUIZ_TRACK_TIMEOUT * 5)
+
+
+def preprocess_clip(url, directory, settings):
+    """Download url and store its clip in directory under the SHA-256 of its content; returns (file name, size). Runs in a worker process."""
+    work_dir = tempfile.mkdtemp(prefix='clip-', dir=directory)
+    try:
+        source = download_source(url, os.path.join(work_dir, 'source.%(ext)s'))
+        path = os.path.join(work_dir, 'clip.opus')
+        encode_clip(source, path, settings)
+        name = file_digest(path) + '.opus'
+        os.replace(path, os.path.join(directory, name))
+        return name, os.path.getsize(os.path.join(directory, name))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+class ClipLibrary:
+    """Clips written by preprocess_library(), looked up by video id.
+
+    The manifest is re-read whenever the preprocessing job has replaced it, so
+    clips encoded while the bot runs are picked up by the next quiz round.
+    """
+
+    def __init__(self, directory=QUIZ_CLIP_DIR):
+        self.directory = directory
+        self.manifest = {}
+        self.mtime = None
+        self.hits = 0
+        self.misses = 0
+
+    def manifest_file(self):
+        return os.path.join(self.directory, 'manifest.json')
+
+    def load(self):
+        try:
+            mtime = os.stat(self.manifest_file()).st_mtime_ns
+        except FileNotFoundError:
+            self.manifest, self.mtime = {}, None
+            return
+        if mtime != self.mtime:
+            self.manifest, self.mtime = read_json(self.manifest_file(), {}), mtime
+
+    def get(self, url):
+        """Path of the clip for url, or None if it has not been preprocessed."""
+        self.load()
+        entry = self.manifest.get(video_id(url))
+        if entry is not None:
+            path = os.path.join(self.directory, entry['file'])
+            if os.path.exists(path):
+                self.hits += 1
+                return path
+        self.misses += 1
+        return None
+
+    def owns(self, path):
+        return os.path.dirname(path) == self.directory
+
+    def stats(self):
+        self.load()
+        return {
+            'clips': len(self.manifest),
+            'bytes': sum(entry['size'] for entry in self.manifest.values()),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+clips = ClipLibrary()
+
+
+def clip_current(directory, entry, url, settings):
+    if entry is None or entry['url'] != url or entry['settings'] != settings:
+        return False
+    try:
+        return os.path.getsize(os.path.join(directory, entry['file'])) == entry['size']
+    except OSError:
+        return False
+
+
+def remove_clip(directory, manifest, name):
+    # Identical audio behind two video ids is stored once.
+    if not any(entry['file'] == name for entry in manifest.values()):
+        try:
+            os.remove(os.path.join(directory, name))
+        except FileNotFoundError:
+            pass
+
+
+class VoiceMeter:
+    """CPU spent per second of quiz playback, for sizing how many quizzes a process can host.
+
+    CPU is that of the whole process plus its exited FFmpeg children, sampled
+    whenever a track starts or stops and divided over the tracks playing in
+    between. Intervals where every playing track used the same mode are
+    credited to that mode, others to 'mixed'. Idle CPU of the rest of the bot
+    is included, so compare modes under a similar load.
+    """
+
+    def __init__(self):
+        self.active = {}
+        self.modes = {}
+        self.last = None
+        self._lock = threading.Lock()
+
+    def cpu(self):
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return time.process_time() + children.ru_utime + children.ru_stime
+
+    def _advance(self):
+        now, cpu = time.monotonic(), self.cpu()
+        if self.active:
+            modes = set(self.active.values())
+            totals = self.modes.setdefault(modes.pop() if len(modes) == 1 else 'mixed', [0.0, 0.0, 0])
+            totals[0] += cpu - self.last[1]
+            totals[1] += (now - self.last[0]) * len(self.active)
+        self.last = (now, cpu)
+
+    def start(self, mode):
+        token = object()
+        with self._lock:
+            self._advance()
+            self.active[token] = mode
+        return token
+
+    def stop(self, token):
+        # Called from the voice player thread once FFmpeg has exited.
+        with self._lock:
+            self._advance()
+            mode = self.active.pop(token)
+            self.modes.setdefault(mode, [0.0, 0.0, 0])[2] += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'active': len(self.active),
+                'modes': {mode: {'tracks': tracks, 'cpu_per_session': cpu / seconds if seconds else 0.0}
+                          for mode, (cpu, seconds, tracks) in self.modes.items()},
+            }
+
+
+voice_meter = VoiceMeter()
+
+
+class MeteredSource(discord.AudioSource):
+    """Wraps a voice source to report its playback to a VoiceMeter."""
+
+    def __init__(self, source, mode, meter):
+        self.source = source
+        self.meter = meter
+        self.token = meter.start(mode)
+
+    def read(self):
+        return self.source.read()
+
+    def is_opus(self):
+        return self.source.is_opus()
+
+    def cleanup(self):
+        # discord.py may clean a source up twice, from the player and on garbage collection.
+        self.source.cleanup()
+        if self.token is not None:
+            self.meter.stop(self.token)
+            self.token = None
+
+
+def quiz_source(path, meter=voice_meter):
+    """The audio source playing path in a voice channel, copying Opus packets as they are when the file is Opus."""
+    if not QUIZ_OPUS_PASSTHROUGH:
+        return MeteredSource(discord.FFmpegPCMAudio(path), 'pcm', meter)
+    if path.endswith('.opus'):
+        return MeteredSource(discord.FFmpegOpusAudio(path, codec='copy'), 'passthrough', meter)
+    return MeteredSource(discord.FFmpegOpusAudio(path), 'ffmpeg-opus', meter)
+
+
+class TrackPrefetcher:
+    """Gets upcoming quiz tracks ready in the background while the current one plays.
+
+    Tracks are picked at random from tracks (anime -> url) and handed out as
+    (anime, path) through a bounded queue, so at most `depth` tracks wait
+    pinned in the audio cache. Preprocessed clips are handed out as they are,
+    without touching the cache. A track that fails or times out is skipped and
+    the next one is tried; the queue never blocks on it. Each path handed out
+    must be given back with release() once it has been played.
+    """
+
+    def __init__(self, tracks, depth=QUIZ_PREFETCH, workers=QUIZ_PREFETCH_WORKERS, timeout=QUIZ_TRACK_TIMEOUT, cache=audio_cache, clips=clips):
+        self.tracks = list(tracks.items())
+        self.depth = depth
+        self.workers = workers
+        self.timeout = timeout
+        self.cache = cache
+        self.clips = clips
+        self.queue = None
+        self.downloaded = 0
+        self.failures = 0
+        self.running = False
+        self._tasks = []
+
+    def start(self):
+        self.queue = asyncio.Queue(maxsize=self.depth)
+        self.running = True
+        self._tasks = [asyncio.create_task(self.run()) for _ in range(self.workers)]
+
+    async def run(self):
+        # wait_for can swallow a cancellation that races with the download finishing, hence the flag.
+        while self.running:
+            anime, url = random.choice(self.tracks)
+            clip = self.clips.get(url)
+            if clip is not None:
+                await self.queue.put((anime, clip))
+                continue
+            try:
+                path = await self.cache.fetch(url, self.timeout)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.failures += 1
+                print(f"Error downloading quiz audio for {anime} ({url}): {e!r}")
+                continue
+            self.downloaded += 1
+            try:
+                await self.queue.put((anime, path))
+            except asyncio.CancelledError:
+                self.cache.release(path)
+                raise
+
+    async def next(self, timeout=None):
+        """The next ready (anime, path), waiting at most timeout seconds (None if nothing became ready)."""
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout=timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    def release(self, path):
+        if not self.clips.owns(path):
+            self.cache.release(path)
+
+    async def stop(self):
+        self.running = False
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        while not self.queue.empty():
+            self.release(self.queue.get_nowait()[1])
+
+
+def preprocess_library(tracks, directory=QUIZ_CLIP_DIR, workers=QUIZ_PREPROCESS_WORKERS):
+    """Encode a clip for every track added or changed since the last run and drop the clips of removed tracks.
+
+    The manifest is written after each clip, so an interrupted run resumes
+    where it stopped. Returns (encoded, failed).
+    """
+    os.makedirs(directory, exist_ok=True)
+    manifest_file = os.path.join(directory, 'manifest.json')
+    manifest = read_json(manifest_file, {})
+    settings = clip_settings()
+    wanted = {}
+    for anime, url in tracks.items():
+        wanted.setdefault(video_id(url), (anime, url.strip()))
+    for key in [key for key in manifest if key not in wanted]:
+        remove_clip(directory, manifest, manifest.pop(key)['file'])
+    pending = [key for key, (anime, url) in wanted.items() if not clip_current(directory, manifest.get(key), url, settings)]
+    print(f'{len(wanted) - len(pending)} clips up to date, {len(pending)} to encode')
+    encoded = failed = 0
+    if pending:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(preprocess_clip, wanted[key][1], directory, settings): key for key in pending}
+            for future in as_completed(futures):
+                key = futures[future]
+                anime, url = wanted[key]
+                try:
+                    name, size = future.result()
+                except Exception as e:
+                    failed += 1
+                    print(f'Failed to preprocess {anime} ({url}): {e!r}')
+                    continue
+                old = manifest.get(key)
+                manifest[key] = {'anime': anime, 'url': url, 'file': name, 'size': size, 'settings': settings}
+                if old is not None and old['file'] != name:
+                    remove_clip(directory, manifest, old['file'])
+                write_json_atomic(manifest_file, manifest)
+                encoded += 1
+                print(f'[{encoded + failed}/{len(pending)}] {anime}')
+    write_json_atomic(manifest_file, manifest)
+    return encoded, failed
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ['preprocess']:
+        from utils import quiz_data
+        encoded, failed = preprocess_library(quiz_data)
+        print(f'Encoded {encoded} clips, {failed} failed')
+    else:
+        print('Usage: python code/quiz_audio.py preprocess')
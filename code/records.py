@@ -0,0 +1,170 @@
+import sys
+
+RANKS = ('SS', 'S', 'A', 'B', 'C', 'D', 'E')
+
+# Luck tables are shared between users who have the same one, which is most of them.
+_luck_tables = {}
+
+
+def encode_id(value):
+    # Discord ids are kept as ints; anything else is stored as given.
+    if isinstance(value, str) and value.isdigit() and not value.startswith('0'):
+        return int(value)
+    return value
+
+
+def decode_id(value):
+    return str(value) if isinstance(value, int) else value
+
+
+def to_json(value):
+    """json.dump default hook for records."""
+    if isinstance(value, Record):
+        return value.to_dict()
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+
+class Record:
+    """A dict-compatible record keeping its known keys in slots instead of a per-instance dict.
+
+    Unset slots are missing keys, and keys outside FIELDS go to a small overflow
+    dict, so every JSON object converts to a record and back unchanged.
+    """
+
+    __slots__ = ('extra',)
+    FIELDS = frozenset()
+
+    def __init__(self, data=()):
+        self.extra = None
+        for key in data:
+            self[key] = data[key]
+
+    def encode(self, key, value):
+        return value
+
+    def decode(self, key, value):
+        return value
+
+    def __getitem__(self, key):
+        if key in self.FIELDS:
+            try:
+                return self.decode(key, getattr(self, key))
+            except AttributeError:
+                raise KeyError(key) from None
+        if self.extra is None:
+            raise KeyError(key)
+        return self.extra[key]
+
+    def __setitem__(self, key, value):
+        if key in self.FIELDS:
+            setattr(self, key, self.encode(key, value))
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+
+    def __delitem__(self, key):
+        if key in self.FIELDS:
+            try:
+                delattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        elif self.extra is None:
+            raise KeyError(key)
+        else:
+            del self.extra[key]
+
+    def __contains__(self, key):
+        if key in self.FIELDS:
+            return hasattr(self, key)
+        return self.extra is not None and key in self.extra
+
+    def __iter__(self):
+        for key in self.__slots__:
+            if hasattr(self, key):
+                yield key
+        if self.extra:
+            yield from self.extra
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self.to_dict()!r})'
+
+    def keys(self):
+        return list(self)
+
+    def values(self):
+        return [self[key] for key in self]
+
+    def items(self):
+        return [(key, self[key]) for key in self]
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, other=(), **kwargs):
+        for key in other:
+            self[key] = other[key]
+        for key, value in kwargs.items():
+            self[key] = value
+
+    def to_dict(self):
+        return {key: self[key] for key in self}
+
+
+class Card(Record):
+    __slots__ = ('id', 'name', 'rank', 'value', 'description', 'image_urls', 'claimed_by', 'gem_claimed')
+    FIELDS = frozenset(__slots__)
+
+    def encode(self, key, value):
+        if key == 'rank' and isinstance(value, str):
+            return sys.intern(value)
+        if key == 'claimed_by':
+            return encode_id(value)
+        return value
+
+    def decode(self, key, value):
+        return decode_id(value) if key == 'claimed_by' else value
+
+
+class UserRecord(Record):
+    __slots__ = ('coins', 'luck_purchases', 'luck', 'rolls', 'rolls_window', 'claims',
+                 'claims_window', 'wishes', 'last_gem_time', 'last_daily_time', 'last_daily_reset_time')
+    FIELDS = frozenset(__slots__)
+
+    def encode(self, key, value):
+        # Luck is stored as a shared tuple in RANKS order; reading it gives a fresh dict.
+        if key == 'luck' and isinstance(value, dict) and set(value) == set(RANKS):
+            table = tuple(value[rank] for rank in RANKS)
+            return _luck_tables.setdefault(table, table)
+        return value
+
+    def decode(self, key, value):
+        if key == 'luck' and isinstance(value, tuple):
+            return dict(zip(RANKS, value))
+        return value
+
+
+class Listing(Record):
+    __slots__ = ('character', 'price', 'seller_id')
+    FIELDS = frozenset(__slots__)
+
+    def encode(self, key, value):
+        if key == 'character' and isinstance(value, dict):
+            return Card(value)
+        if key == 'seller_id':
+            return encode_id(value)
+        return value
+
+    def decode(self, key, value):
+        return decode_id(value) if key == 'seller_id' else value
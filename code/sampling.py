@@ -0,0 +1,59 @@
+import random
+
+
+class AliasSampler:
+    """Weighted choice over fixed outcomes (Vose's alias method): O(n) to build, O(1) per draw."""
+
+    def __init__(self, outcomes, weights):
+        self.outcomes = []
+        weights_by_outcome = []
+        for outcome, weight in zip(outcomes, weights):
+            if weight > 0:
+                self.outcomes.append(outcome)
+                weights_by_outcome.append(weight)
+        n = len(self.outcomes)
+        total = sum(weights_by_outcome)
+        scaled = [weight * n / total for weight in weights_by_outcome]
+        self.probabilities = [1.0] * n
+        self.aliases = list(range(n))
+        small = [i for i, p in enumerate(scaled) if p < 1.0]
+        large = [i for i, p in enumerate(scaled) if p >= 1.0]
+        while small and large:
+            less, more = small.pop(), large.pop()
+            self.probabilities[less] = scaled[less]
+            self.aliases[less] = more
+            scaled[more] -= 1.0 - scaled[less]
+            (small if scaled[more] < 1.0 else large).append(more)
+
+    def sample(self):
+        if not self.outcomes:
+            return None
+        i = random.randrange(len(self.outcomes))
+        return self.outcomes[i] if random.random() < self.probabilities[i] else self.outcomes[self.aliases[i]]
+
+    def sample_many(self, count):
+        return [self.sample() for _ in range(count)]
+
+
+class SamplerCache:
+    """Compiled samplers per user, rebuilt only when the user's luck version or the rank availability changes."""
+
+    def __init__(self):
+        self.samplers = {}
+        self.luck_versions = {}
+        self.hits = 0
+        self.builds = 0
+
+    def invalidate(self, user_id):
+        self.luck_versions[user_id] = self.luck_versions.get(user_id, 0) + 1
+
+    def get(self, user_id, availability, build):
+        key = (self.luck_versions.get(user_id, 0), availability)
+        cached = self.samplers.get(user_id)
+        if cached and cached[0] == key:
+            self.hits += 1
+            return cached[1]
+        self.builds += 1
+        sampler = build()
+        self.samplers[user_id] = (key, sampler)
+        return sampler
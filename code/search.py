@@ -0,0 +1,91 @@
+import bisect
+import heapq
+import os
+
+from fuzzywuzzy import fuzz
+
+# Matches scoring below SEARCH_THRESHOLD (0-100) are not returned; only the
+# SEARCH_CANDIDATES names sharing the most trigrams with the query get scored.
+# Below 75 unrelated names such as 'Goku' and 'Gon' start to match.
+SEARCH_THRESHOLD = int(os.getenv('NAPO_SEARCH_THRESHOLD', '75'))
+SEARCH_CANDIDATES = int(os.getenv('NAPO_SEARCH_CANDIDATES', '50'))
+
+
+def normalize(name):
+    return ' '.join(name.lower().split())
+
+
+def trigrams(text):
+    padded = f'  {text} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class NameIndex:
+    """Fuzzy name search: trigram overlap prunes the candidates, fuzz.ratio ranks them."""
+
+    def __init__(self):
+        self.names = {}
+        self.grams = {}
+
+    def add(self, key, name):
+        name = normalize(name)
+        self.names[key] = name
+        for gram in trigrams(name):
+            self.grams.setdefault(gram, set()).add(key)
+
+    def remove(self, key):
+        name = self.names.pop(key)
+        for gram in trigrams(name):
+            self.grams[gram].discard(key)
+            if not self.grams[gram]:
+                del self.grams[gram]
+
+    def search(self, query, limit=1, threshold=SEARCH_THRESHOLD, accept=None):
+        """Return up to limit (score, key) pairs, best first, for keys accepted by accept(key)."""
+        query = normalize(query)
+        overlap = {}
+        for gram in trigrams(query):
+            for key in self.grams.get(gram, ()):
+                overlap[key] = overlap.get(key, 0) + 1
+        if accept is not None:
+            overlap = {key: count for key, count in overlap.items() if accept(key)}
+        candidates = heapq.nlargest(SEARCH_CANDIDATES, overlap, key=overlap.get)
+        scored = [(fuzz.ratio(query, self.names[key]), key) for key in candidates]
+        return heapq.nlargest(limit, [(score, key) for score, key in scored if score >= threshold], key=lambda match: match[0])
+
+
+class PrefixIndex:
+    """Sorted (name, key) pairs answering prefix queries with a binary search.
+
+    Every word of a name is indexed, so 'uch' finds 'Sasuke Uchiha' as well.
+    """
+
+    def __init__(self, items=()):
+        self.entries = sorted(entry for key, name in items for entry in self.word_entries(key, name))
+
+    def word_entries(self, key, name):
+        words = normalize(name).split(' ')
+        return [(' '.join(words[i:]), key) for i in range(len(words))]
+
+    def add(self, key, name):
+        for entry in self.word_entries(key, name):
+            bisect.insort(self.entries, entry)
+
+    def remove(self, key, name):
+        for entry in self.word_entries(key, name):
+            position = bisect.bisect_left(self.entries, entry)
+            if position < len(self.entries) and self.entries[position] == entry:
+                del self.entries[position]
+
+    def complete(self, prefix, limit=25):
+        prefix = normalize(prefix)
+        keys = []
+        position = bisect.bisect_left(self.entries, (prefix,))
+        while position < len(self.entries) and len(keys) < limit:
+            name, key = self.entries[position]
+            if not name.startswith(prefix):
+                break
+            if key not in keys:
+                keys.append(key)
+            position += 1
+        return keys
@@ -0,0 +1,305 @@
+import bisect
+import random
+import time
+
+from records import Card, Listing, UserRecord
+from sampling import SamplerCache
+from search import NameIndex, PrefixIndex, normalize
+from utils import rank_sort_key
+
+
+class BlackMarket:
+    """A guild's black market listings, indexed by listing id, card name, seller and price."""
+
+    def __init__(self, listings=None):
+        self.listings = {}
+        self.by_name = {}
+        self.by_seller = {}
+        self.by_price = []
+        self._view = None
+        for listing_id, listing in (listings or {}).items():
+            self.add(listing_id, listing)
+
+    def __len__(self):
+        return len(self.listings)
+
+    def __contains__(self, listing_id):
+        return listing_id in self.listings
+
+    def __getitem__(self, listing_id):
+        return self.listings[listing_id]
+
+    def add(self, listing_id, listing):
+        if not isinstance(listing, Listing):
+            listing = Listing(listing)
+        if listing_id in self.listings:
+            self.remove(listing_id)
+        self.listings[listing_id] = listing
+        self.by_name.setdefault(normalize(listing['character']['name']), set()).add(listing_id)
+        self.by_seller.setdefault(listing['seller_id'], set()).add(listing_id)
+        bisect.insort(self.by_price, (listing['price'], listing_id))
+        self._view = None
+
+    def remove(self, listing_id):
+        listing = self.listings.pop(listing_id)
+        for index, key in ((self.by_name, normalize(listing['character']['name'])), (self.by_seller, listing['seller_id'])):
+            index[key].discard(listing_id)
+            if not index[key]:
+                del index[key]
+        del self.by_price[bisect.bisect_left(self.by_price, (listing['price'], listing_id))]
+        self._view = None
+        return listing
+
+    def find(self, name, seller_id=None):
+        """Return the id of the cheapest listing of the named card, optionally from one seller."""
+        listing_ids = self.by_name.get(normalize(name), ())
+        if seller_id is not None:
+            listing_ids = [listing_id for listing_id in listing_ids if self.listings[listing_id]['seller_id'] == seller_id]
+        return min(listing_ids, key=lambda listing_id: (self.listings[listing_id]['price'], listing_id), default=None)
+
+    def seller_count(self, seller_id):
+        return len(self.by_seller.get(seller_id, ()))
+
+    def view(self):
+        """Listings sorted by price, rebuilt only after the market changes."""
+        if self._view is None:
+            self._view = [self.listings[listing_id] for _, listing_id in self.by_price]
+        return self._view
+
+
+class RankBuckets:
+    """Cards grouped by rank, with constant-time random picks, additions and removals."""
+
+    def __init__(self, cards=()):
+        self.buckets = {}
+        self.positions = {}
+        # Bumped whenever a rank gains its first card or loses its last one.
+        self.version = 0
+        for card in cards:
+            self.add(card)
+
+    def add(self, card):
+        bucket = self.buckets.setdefault(card['rank'], [])
+        if not bucket:
+            self.version += 1
+        self.positions[card['id']] = len(bucket)
+        bucket.append(card)
+
+    def remove(self, card):
+        bucket = self.buckets[card['rank']]
+        position = self.positions.pop(card['id'])
+        last = bucket.pop()
+        if last is not card:
+            bucket[position] = last
+            self.positions[last['id']] = position
+        if not bucket:
+            self.version += 1
+
+    def count(self, rank):
+        return len(self.buckets.get(rank, ()))
+
+    def pick(self, rank, accept=None, attempts=8):
+        """Pick a random card of the rank for which accept(card) holds, or None if there is none."""
+        bucket = self.buckets.get(rank)
+        if not bucket:
+            return None
+        for _ in range(attempts if accept else 1):
+            card = random.choice(bucket)
+            if accept is None or accept(card):
+                return card
+        # The filter rejects most of the bucket, so fall back to a single pass over it.
+        candidates = [card for card in bucket if accept(card)]
+        return random.choice(candidates) if candidates else None
+
+
+class GuildState:
+    """Everything resident for one guild; unpacks as (cards, user_collections, user_data).
+
+    Cards are indexed by id and normalized name, each collection by normalized
+    name, and wishes by card id. Collections and wish lists must be changed
+    through the methods below to keep the indexes in sync.
+    """
+
+    def __init__(self, cards, user_collections, user_data, black_market=None):
+        # Loaded data comes in as plain dicts; collections and listings are relinked to the converted cards.
+        cards = [card if isinstance(card, Card) else Card(card) for card in cards]
+        by_id = {card['id']: card for card in cards}
+        for user_id, collection in user_collections.items():
+            user_collections[user_id] = [by_id[card['id']] for card in collection]
+        for user_id, user in user_data.items():
+            if not isinstance(user, UserRecord):
+                user_data[user_id] = UserRecord(user)
+        listings = {}
+        for listing_id, listing in (black_market or {}).items():
+            listing = listing if isinstance(listing, Listing) else Listing(listing)
+            # Legacy listings whose card could not be resolved keep their raw card dict, as link_listings leaves them.
+            listing['character'] = by_id.get(listing['character'].get('id'), listing['character'])
+            listings[listing_id] = listing
+        self.cards = cards
+        self.user_collections = user_collections
+        self.user_data = user_data
+        self.black_market = BlackMarket(listings)
+        self.cards_by_id = {}
+        self.cards_by_name = {}
+        self.collection_index = {}
+        self.rank_buckets = RankBuckets(cards)
+        self.recent_rolls = {}
+        self.samplers = SamplerCache()
+        self.search_index = NameIndex()
+        self.prefix_index = PrefixIndex((card['id'], card['name']) for card in cards)
+        for card in cards:
+            self.index_card(card)
+        for user_id, collection in user_collections.items():
+            index = self.collection_index[user_id] = {}
+            for card in collection:
+                index.setdefault(normalize(card['name']), card)
+        self.wishers = {}
+        for user_id, user in user_data.items():
+            for name in user.get('wishes', ()):
+                card = self.card(name)
+                if card:
+                    self.wishers.setdefault(card['id'], set()).add(user_id)
+        self.next_card_id = max(self.cards_by_id, default=0) + 1
+        # Bumped per guild file type by every journaled mutation; see cached().
+        self.versions = {}
+        self.memo = {}
+        self.memo_hits = 0
+        self.memo_builds = 0
+
+    def __iter__(self):
+        return iter((self.cards, self.user_collections, self.user_data))
+
+    def touch(self, *file_types):
+        for file_type in file_types:
+            self.versions[file_type] = self.versions.get(file_type, 0) + 1
+
+    def cached(self, key, sources, build):
+        """Return build(), reusing the last result until a mutation touches one of the sources file types."""
+        version = tuple(self.versions.get(source, 0) for source in sources)
+        entry = self.memo.get(key)
+        if entry is not None and entry[0] == version:
+            self.memo_hits += 1
+            return entry[1]
+        self.memo_builds += 1
+        value = build()
+        self.memo[key] = (version, value)
+        return value
+
+    def sorted_cards(self):
+        return self.cached('sorted_cards', ('cards',), lambda: sorted(self.cards, key=rank_sort_key))
+
+    def index_card(self, card):
+        self.cards_by_id[card['id']] = card
+        self.cards_by_name.setdefault(normalize(card['name']), card)
+        self.search_index.add(card['id'], card['name'])
+
+    def card(self, name):
+        return self.cards_by_name.get(normalize(name))
+
+    def search(self, name, limit=1, owner=None):
+        """The cards whose names best match a typed name, optionally among one user's collection."""
+        accept = None
+        if owner is not None:
+            owned = self.collection_index.get(owner, {})
+            accept = lambda card_id: owned.get(normalize(self.cards_by_id[card_id]['name'])) is self.cards_by_id[card_id]
+        return [self.cards_by_id[card_id] for _, card_id in self.search_index.search(name, limit, accept=accept)]
+
+    def complete(self, prefix, owner=None, limit=25):
+        """Cards whose name (or one of its words) starts with prefix, for autocompletion."""
+        if owner is None:
+            return [self.cards_by_id[card_id] for card_id in self.prefix_index.complete(prefix, limit)]
+        prefix = normalize(prefix)
+        owned = self.collection_index.get(owner, {})
+        names = sorted(name for name in owned if name.startswith(prefix) or f' {prefix}' in name)
+        return [owned[name] for name in names[:limit]]
+
+    def find_card(self, name, owner=None):
+        """Resolve a typed name: the exact name if there is one, else the closest match."""
+        card = self.owned_card(owner, name) if owner is not None else self.card(name)
+        if card:
+            return card
+        matches = self.search(name, owner=owner)
+        return matches[0] if matches else None
+
+    def owned_card(self, user_id, name):
+        return self.collection_index.get(user_id, {}).get(normalize(name))
+
+    def add_card(self, card):
+        card = Card(card)
+        card['id'] = self.next_card_id
+        self.next_card_id += 1
+        self.cards.append(card)
+        self.index_card(card)
+        self.prefix_index.add(card['id'], card['name'])
+        self.rank_buckets.add(card)
+        return card
+
+    def rename_card(self, card, name):
+        old_name = card['name']
+        old_key = normalize(old_name)
+        if self.cards_by_name.get(old_key) is card:
+            del self.cards_by_name[old_key]
+        owner_index = self.collection_index.get(card['claimed_by'], {})
+        if owner_index.get(old_key) is card:
+            del owner_index[old_key]
+            owner_index.setdefault(normalize(name), card)
+        listing_ids = [listing_id for listing_id in self.black_market.by_name.get(old_key, ()) if self.black_market[listing_id]['character'] is card]
+        listings = [self.black_market.remove(listing_id) for listing_id in listing_ids]
+        for user_id in self.wishers.get(card['id'], ()):
+            wishes = self.user_data[user_id]['wishes']
+            wishes[:] = [name if normalize(wish) == old_key else wish for wish in wishes]
+        card['name'] = name
+        self.cards_by_name.setdefault(normalize(name), card)
+        self.search_index.remove(card['id'])
+        self.search_index.add(card['id'], name)
+        self.prefix_index.remove(card['id'], old_name)
+        self.prefix_index.add(card['id'], name)
+        for listing_id, listing in zip(listing_ids, listings):
+            self.black_market.add(listing_id, listing)
+
+    def change_rank(self, card, rank):
+        self.rank_buckets.remove(card)
+        card['rank'] = rank
+        self.rank_buckets.add(card)
+
+    def rolled_this_hour(self, user_id):
+        """Ids of the cards the user rolled since the start of the current hour."""
+        hour = int(time.time() // 3600)
+        rolled_hour, rolled = self.recent_rolls.get(user_id, (None, None))
+        if rolled_hour != hour:
+            rolled = set()
+            self.recent_rolls[user_id] = (hour, rolled)
+        return rolled
+
+    def collect(self, user_id, card):
+        card['claimed_by'] = user_id
+        self.user_collections.setdefault(user_id, []).append(card)
+        self.collection_index.setdefault(user_id, {}).setdefault(normalize(card['name']), card)
+
+    def uncollect(self, user_id, card):
+        collection = self.user_collections[user_id]
+        collection.remove(card)
+        index = self.collection_index[user_id]
+        key = normalize(card['name'])
+        if index.get(key) is card:
+            # Another owned card may share the normalized name.
+            other = next((c for c in collection if normalize(c['name']) == key), None)
+            if other is None:
+                del index[key]
+            else:
+                index[key] = other
+
+    def add_wish(self, user_id, card):
+        self.user_data[user_id].setdefault('wishes', []).append(card['name'])
+        self.wishers.setdefault(card['id'], set()).add(user_id)
+
+    def remove_wish(self, user_id, name):
+        self.user_data[user_id]['wishes'].remove(name)
+        card = self.card(name)
+        if card and card['id'] in self.wishers:
+            self.wishers[card['id']].discard(user_id)
+            if not self.wishers[card['id']]:
+                del self.wishers[card['id']]
+
+    def wishers_of(self, card):
+        return self.wishers.get(card['id'], set())
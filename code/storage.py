@@ -0,0 +1,505 @@
+import asyncio
+import glob
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from journal import Journal, replay, replay_black_market
+from records import to_json
+
+DATA_DIR = 'data'
+# Exports for download live apart from the files the JSON backend reads.
+EXPORT_DIR = os.path.join(DATA_DIR, 'exports')
+FILE_TYPES = ('cards', 'collections', 'user_data')
+# Everything a guild snapshot can rewrite: the data files plus the black market.
+SNAPSHOT_TYPES = FILE_TYPES + ('black_market',)
+if not os.path.exists(DATA_DIR):
+    os.makedirs(DATA_DIR)
+
+# Either 'json' (one file per guild and data type, plus the mutation journal) or
+# 'sqlite' (a single database at SQLITE_PATH).
+STORAGE_BACKEND = os.getenv('NAPO_STORAGE', 'json')
+SQLITE_PATH = os.getenv('NAPO_SQLITE_PATH', os.path.join(DATA_DIR, 'napo.db'))
+IO_WORKERS = int(os.getenv('NAPO_IO_WORKERS', '4'))
+
+CARD_COLUMNS = ('id', 'name', 'rank', 'value', 'description', 'claimed_by')
+CARD_SQL_COLUMNS = 'card_id, name, rank, value, description, claimed_by'
+USER_COLUMNS = ('coins',)
+SCHEMA_VERSION = 1
+
+
+def get_guild_data_file(guild_id, file_type):
+    return os.path.join(DATA_DIR, f'{guild_id}_{file_type}.json')
+
+def get_black_market_file(guild_id):
+    return os.path.join(DATA_DIR, f'{guild_id}_black_market.json')
+
+def get_export_file(guild_id, file_type):
+    return os.path.join(EXPORT_DIR, f'{guild_id}_{file_type}.json')
+
+def write_json_atomic(path, data):
+    # A temp file of its own per write, so concurrent writers of one path never share it.
+    with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(path) or '.', prefix=os.path.basename(path) + '.', suffix='.tmp', delete=False) as f:
+        temp_path = f.name
+        try:
+            json.dump(data, f, indent=4, default=to_json)
+            f.flush()
+            os.fsync(f.fileno())
+        except BaseException:
+            f.close()
+            os.remove(temp_path)
+            raise
+    os.replace(temp_path, path)
+
+def read_json(path, default):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return default
+
+def assign_card_ids(cards):
+    next_id = max((card['id'] for card in cards if 'id' in card), default=0) + 1
+    for card in cards:
+        if 'id' not in card:
+            card['id'] = next_id
+            next_id += 1
+
+def card_resolver(cards):
+    cards_by_id = {card['id']: card for card in cards}
+    cards_by_name = {card['name']: card for card in cards}
+    def resolve(reference):
+        # Files written before cards had ids hold a copy of the card instead of its id.
+        if isinstance(reference, dict):
+            return cards_by_id.get(reference['id']) if 'id' in reference else cards_by_name.get(reference['name'])
+        return cards_by_id.get(reference)
+    return resolve
+
+def link_collections(cards, user_collections):
+    """Replace the card ids in each collection with the cards they refer to."""
+    assign_card_ids(cards)
+    resolve = card_resolver(cards)
+    for user_id, collection in user_collections.items():
+        user_collections[user_id] = [card for card in map(resolve, collection) if card is not None]
+
+def link_listings(cards, black_market):
+    resolve = card_resolver(cards)
+    for listing in black_market.values():
+        listing['character'] = resolve(listing['character']) or listing['character']
+
+def collection_ids(user_collections):
+    return {user_id: [card['id'] for card in collection] for user_id, collection in user_collections.items()}
+
+def apply_user_defaults(user_data):
+    for user in user_data.values():
+        if 'last_gem_time' not in user:
+            user['last_gem_time'] = (datetime.utcnow() - timedelta(hours=6)).isoformat()
+        if 'wishes' not in user:
+            user['wishes'] = []
+
+
+class JsonStorage:
+    needs_compaction = True
+
+    def __init__(self):
+        self.journals = {}
+
+    def get_journal(self, guild_id):
+        guild_id = str(guild_id)
+        if guild_id not in self.journals:
+            self.journals[guild_id] = Journal(os.path.join(DATA_DIR, f'{guild_id}_journal'))
+        return self.journals[guild_id]
+
+    def load(self, guild_id):
+        cards = read_json(get_guild_data_file(guild_id, 'cards'), [])
+        user_collections = read_json(get_guild_data_file(guild_id, 'collections'), {})
+        user_data = read_json(get_guild_data_file(guild_id, 'user_data'), {})
+        link_collections(cards, user_collections)
+        replay(self.get_journal(guild_id), cards, user_collections, user_data)
+        return cards, user_collections, user_data
+
+    def save(self, guild_id, cards, user_collections, user_data, file_types=FILE_TYPES):
+        contents = {'cards': cards, 'collections': collection_ids(user_collections), 'user_data': user_data}
+        for file_type in file_types:
+            write_json_atomic(get_guild_data_file(guild_id, file_type), contents[file_type])
+
+    def record(self, guild_id, payload):
+        self.get_journal(guild_id).append(payload)
+
+    def seal(self, guild_id):
+        return self.get_journal(guild_id).rotate()
+
+    def release(self, guild_id, generation):
+        self.get_journal(guild_id).discard_before(generation)
+
+    def reset(self, guild_id):
+        self.release(guild_id, self.seal(guild_id))
+
+    def load_black_market(self, guild_id):
+        black_market = read_json(get_black_market_file(guild_id), {})
+        replay_black_market(self.get_journal(guild_id), black_market)
+        return black_market
+
+    def save_black_market(self, guild_id, black_market):
+        write_json_atomic(get_black_market_file(guild_id), black_market)
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS cards (
+    guild_id TEXT NOT NULL,
+    card_id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    rank TEXT,
+    value INTEGER,
+    description TEXT,
+    claimed_by TEXT,
+    data TEXT NOT NULL DEFAULT '{}',
+    PRIMARY KEY (guild_id, card_id)
+);
+CREATE INDEX IF NOT EXISTS cards_name ON cards (guild_id, name);
+CREATE INDEX IF NOT EXISTS cards_rank ON cards (guild_id, rank);
+CREATE INDEX IF NOT EXISTS cards_claimed_by ON cards (guild_id, claimed_by);
+
+CREATE TABLE IF NOT EXISTS collections (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    guild_id TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    card_id INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS collections_user ON collections (guild_id, user_id);
+CREATE INDEX IF NOT EXISTS collections_card ON collections (guild_id, card_id);
+
+CREATE TABLE IF NOT EXISTS users (
+    guild_id TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    coins INTEGER NOT NULL DEFAULT 0,
+    data TEXT NOT NULL DEFAULT '{}',
+    PRIMARY KEY (guild_id, user_id)
+);
+
+CREATE TABLE IF NOT EXISTS black_market (
+    guild_id TEXT NOT NULL,
+    listing_id TEXT NOT NULL,
+    seller_id TEXT NOT NULL,
+    card_name TEXT NOT NULL,
+    price INTEGER NOT NULL,
+    listing TEXT NOT NULL,
+    PRIMARY KEY (guild_id, listing_id)
+);
+CREATE INDEX IF NOT EXISTS black_market_seller ON black_market (guild_id, seller_id);
+CREATE INDEX IF NOT EXISTS black_market_card_name ON black_market (guild_id, card_name COLLATE NOCASE);
+"""
+
+
+def card_to_row(card):
+    extra = {key: value for key, value in card.items() if key not in CARD_COLUMNS}
+    return tuple(card.get(column) for column in CARD_COLUMNS) + (json.dumps(extra),)
+
+def row_to_card(row):
+    card = dict(zip(CARD_COLUMNS, row[:len(CARD_COLUMNS)]))
+    card.update(json.loads(row[len(CARD_COLUMNS)]))
+    return card
+
+def user_to_row(user):
+    extra = {key: value for key, value in user.items() if key not in USER_COLUMNS}
+    return user.get('coins', 0), json.dumps(extra)
+
+def row_to_user(coins, data):
+    user = {'coins': coins}
+    user.update(json.loads(data))
+    return user
+
+
+class SqliteStorage:
+    """Row-per-entity storage; journal entries become row upserts in one transaction."""
+
+    needs_compaction = False
+
+    def __init__(self, path=SQLITE_PATH):
+        # The connection is shared by the I/O worker threads, one statement batch at a time.
+        self.lock = threading.RLock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.upgrade()
+
+    def upgrade(self):
+        db = self.connection
+        if db.execute('PRAGMA user_version').fetchone()[0] >= SCHEMA_VERSION:
+            return
+        # One explicit transaction for the whole upgrade: executescript() would commit
+        # after the DROP, and a failure past it would lose every card.
+        with self.lock:
+            db.execute('BEGIN')
+            try:
+                self._upgrade(db)
+                db.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+                db.commit()
+            except BaseException:
+                db.rollback()
+                raise
+
+    def _upgrade(self, db):
+        guilds = {}
+        if 'card' in {row[1] for row in db.execute('PRAGMA table_info(collections)')}:
+            # Version 0 had no card ids and kept a whole copy of the card in each collection row.
+            legacy_columns = CARD_COLUMNS[1:]
+            for (guild_id,) in db.execute('SELECT DISTINCT guild_id FROM cards').fetchall():
+                cards = []
+                for row in db.execute(f"SELECT {', '.join(legacy_columns)}, data FROM cards WHERE guild_id = ? ORDER BY id", (guild_id,)):
+                    card = dict(zip(legacy_columns, row))
+                    card.update(json.loads(row[-1]))
+                    cards.append(card)
+                user_collections = {}
+                for user_id, card in db.execute('SELECT user_id, card FROM collections WHERE guild_id = ? ORDER BY id', (guild_id,)):
+                    user_collections.setdefault(user_id, []).append(json.loads(card))
+                link_collections(cards, user_collections)
+                guilds[guild_id] = (cards, user_collections)
+            db.execute('DROP TABLE cards')
+            db.execute('DROP TABLE collections')
+        for statement in SCHEMA.split(';'):
+            if statement.strip():
+                db.execute(statement)
+        for guild_id, (cards, user_collections) in guilds.items():
+            self._save(db, guild_id, cards, user_collections, {}, ('cards', 'collections'))
+
+    def load(self, guild_id):
+        with self.lock:
+            return self._load(str(guild_id))
+
+    def _load(self, guild_id):
+        db = self.connection
+        cards = [row_to_card(row) for row in db.execute(
+            f"SELECT {CARD_SQL_COLUMNS}, data FROM cards WHERE guild_id = ? ORDER BY card_id", (guild_id,))]
+        cards_by_id = {card['id']: card for card in cards}
+        user_collections = {}
+        for user_id, card_id in db.execute('SELECT user_id, card_id FROM collections WHERE guild_id = ? ORDER BY id', (guild_id,)):
+            if card_id in cards_by_id:
+                user_collections.setdefault(user_id, []).append(cards_by_id[card_id])
+        user_data = {user_id: row_to_user(coins, data) for user_id, coins, data in db.execute(
+            'SELECT user_id, coins, data FROM users WHERE guild_id = ?', (guild_id,))}
+        return cards, user_collections, user_data
+
+    def save(self, guild_id, cards, user_collections, user_data, file_types=FILE_TYPES):
+        with self.lock, self.connection as db:
+            self._save(db, str(guild_id), cards, user_collections, user_data, file_types)
+
+    def _save(self, db, guild_id, cards, user_collections, user_data, file_types):
+        if 'cards' in file_types:
+            db.execute('DELETE FROM cards WHERE guild_id = ?', (guild_id,))
+            db.executemany(f"INSERT INTO cards (guild_id, {CARD_SQL_COLUMNS}, data) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                           [(guild_id,) + card_to_row(card) for card in cards])
+        if 'collections' in file_types:
+            db.execute('DELETE FROM collections WHERE guild_id = ?', (guild_id,))
+            db.executemany('INSERT INTO collections (guild_id, user_id, card_id) VALUES (?, ?, ?)',
+                           [(guild_id, user_id, card['id'])
+                            for user_id, collection in user_collections.items() for card in collection])
+        if 'user_data' in file_types:
+            db.execute('DELETE FROM users WHERE guild_id = ?', (guild_id,))
+            db.executemany('INSERT INTO users (guild_id, user_id, coins, data) VALUES (?, ?, ?, ?)',
+                           [(guild_id, user_id) + user_to_row(user) for user_id, user in user_data.items()])
+
+    def get_card(self, db, guild_id, card_id):
+        row = db.execute(f"SELECT {CARD_SQL_COLUMNS}, data FROM cards WHERE guild_id = ? AND card_id = ?",
+                         (guild_id, card_id)).fetchone()
+        return row_to_card(row) if row else None
+
+    def get_user(self, db, guild_id, user_id):
+        row = db.execute('SELECT coins, data FROM users WHERE guild_id = ? AND user_id = ?', (guild_id, user_id)).fetchone()
+        return row_to_user(*row) if row else {}
+
+    def put_user(self, db, guild_id, user_id, user):
+        db.execute('INSERT INTO users (guild_id, user_id, coins, data) VALUES (?, ?, ?, ?) '
+                   'ON CONFLICT (guild_id, user_id) DO UPDATE SET coins = excluded.coins, data = excluded.data',
+                   (guild_id, user_id) + user_to_row(user))
+
+    def record(self, guild_id, payload):
+        guild_id = str(guild_id)
+        with self.lock, self.connection as db:
+            for entry in json.loads(payload):
+                op = entry['op']
+                if op == 'add_card':
+                    db.execute(f"INSERT OR IGNORE INTO cards (guild_id, {CARD_SQL_COLUMNS}, data) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                               (guild_id,) + card_to_row(entry['card']))
+                elif op == 'card':
+                    card = self.get_card(db, guild_id, entry['id'])
+                    if card is not None:
+                        card.update(entry['fields'])
+                        db.execute(f"UPDATE cards SET {', '.join(f'{column} = ?' for column in CARD_SQL_COLUMNS.split(', '))}, data = ? "
+                                   'WHERE guild_id = ? AND card_id = ?', card_to_row(card) + (guild_id, entry['id']))
+                elif op == 'collect':
+                    exists = db.execute('SELECT 1 FROM collections WHERE guild_id = ? AND user_id = ? AND card_id = ?',
+                                        (guild_id, entry['user'], entry['id'])).fetchone()
+                    if not exists and self.get_card(db, guild_id, entry['id']) is not None:
+                        db.execute('INSERT INTO collections (guild_id, user_id, card_id) VALUES (?, ?, ?)',
+                                   (guild_id, entry['user'], entry['id']))
+                elif op == 'uncollect':
+                    db.execute('DELETE FROM collections WHERE guild_id = ? AND user_id = ? AND card_id = ?',
+                               (guild_id, entry['user'], entry['id']))
+                elif op == 'user':
+                    user = self.get_user(db, guild_id, entry['user'])
+                    user.update(entry['fields'])
+                    self.put_user(db, guild_id, entry['user'], user)
+                elif op == 'coins':
+                    user = self.get_user(db, guild_id, entry['user'])
+                    user['coins'] = entry['balance']
+                    self.put_user(db, guild_id, entry['user'], user)
+                elif op == 'list':
+                    listing = entry['listing']
+                    db.execute('INSERT OR REPLACE INTO black_market (guild_id, listing_id, seller_id, card_name, price, listing) VALUES (?, ?, ?, ?, ?, ?)',
+                               (guild_id, entry['listing_id'], listing['seller_id'], listing['character']['name'], listing['price'], json.dumps(listing)))
+                elif op == 'delist':
+                    db.execute('DELETE FROM black_market WHERE guild_id = ? AND listing_id = ?', (guild_id, entry['listing_id']))
+
+    # Every recorded entry is already committed row by row, so there is no journal to compact.
+    def seal(self, guild_id):
+        return None
+
+    def release(self, guild_id, generation):
+        pass
+
+    def reset(self, guild_id):
+        pass
+
+    def load_black_market(self, guild_id):
+        with self.lock:
+            return {listing_id: json.loads(listing) for listing_id, listing in self.connection.execute(
+                'SELECT listing_id, listing FROM black_market WHERE guild_id = ?', (str(guild_id),))}
+
+    def save_black_market(self, guild_id, black_market):
+        guild_id = str(guild_id)
+        with self.lock, self.connection as db:
+            db.execute('DELETE FROM black_market WHERE guild_id = ?', (guild_id,))
+            db.executemany('INSERT INTO black_market (guild_id, listing_id, seller_id, card_name, price, listing) VALUES (?, ?, ?, ?, ?, ?)',
+                           [(guild_id, listing_id, listing['seller_id'], listing['character']['name'], listing['price'], json.dumps(listing, default=to_json))
+                            for listing_id, listing in black_market.items()])
+
+
+def create_backend(name=STORAGE_BACKEND):
+    if name == 'sqlite':
+        return SqliteStorage()
+    if name == 'json':
+        return JsonStorage()
+    raise ValueError(f"Unknown storage backend '{name}'")
+
+
+backend = create_backend()
+
+# Journal appends, seals and releases run on a single writer thread so they hit
+# the disk in the order they were issued; loads and snapshot writes use the pool.
+writer_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='napo-writer')
+io_executor = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix='napo-io')
+
+def run_ordered(func, *args):
+    return asyncio.get_running_loop().run_in_executor(writer_executor, func, *args)
+
+def run_io(func, *args):
+    return asyncio.get_running_loop().run_in_executor(io_executor, func, *args)
+
+# Held while a guild is compacted or loaded: a compaction replaces the snapshot
+# and releases journal segments, which a load reading both must never straddle.
+guild_locks = {}
+
+def guild_lock(guild_id):
+    return guild_locks.setdefault(guild_id, asyncio.Lock())
+
+
+def load_data(guild_id):
+    cards, user_collections, user_data = backend.load(guild_id)
+    apply_user_defaults(user_data)
+    return cards, user_collections, user_data
+
+def save_data(guild_id, cards, user_collections, user_data, file_types=FILE_TYPES):
+    backend.save(guild_id, cards, user_collections, user_data, file_types)
+
+def load_black_market(guild_id):
+    return backend.load_black_market(guild_id)
+
+def save_black_market(guild_id, black_market):
+    backend.save_black_market(guild_id, black_market)
+
+def load_guild(guild_id):
+    cards, user_collections, user_data = load_data(guild_id)
+    black_market = load_black_market(guild_id)
+    link_listings(cards, black_market)
+    return cards, user_collections, user_data, black_market
+
+def save_guild(guild_id, cards, user_collections, user_data, black_market, file_types=SNAPSHOT_TYPES):
+    data_types = [file_type for file_type in file_types if file_type in FILE_TYPES]
+    if data_types:
+        save_data(guild_id, cards, user_collections, user_data, data_types)
+    if 'black_market' in file_types:
+        save_black_market(guild_id, black_market)
+
+async def load_guild_async(guild_id):
+    async with guild_lock(guild_id):
+        # Let journal writes already queued for this guild land before reading it back.
+        await run_ordered(lambda: None)
+        return await run_io(load_guild, guild_id)
+
+def export_guild(guild_id, cards, user_collections, user_data):
+    """Write the guild's state to JSON files in EXPORT_DIR, whatever the backend, e.g. before sending them; returns their paths."""
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    contents = {'cards': cards, 'collections': collection_ids(user_collections), 'user_data': user_data}
+    paths = [get_export_file(guild_id, file_type) for file_type in FILE_TYPES]
+    for file_type, path in zip(FILE_TYPES, paths):
+        write_json_atomic(path, contents[file_type])
+    return paths
+
+def import_guild(guild_id):
+    """Replace the guild's stored state with the contents of its JSON files."""
+    backend.reset(guild_id)
+    cards = read_json(get_guild_data_file(guild_id, 'cards'), [])
+    user_collections = read_json(get_guild_data_file(guild_id, 'collections'), {})
+    user_data = read_json(get_guild_data_file(guild_id, 'user_data'), {})
+    link_collections(cards, user_collections)
+    save_data(guild_id, cards, user_collections, user_data)
+    return load_data(guild_id)
+
+
+def json_guild_ids():
+    return sorted({os.path.basename(p)[:-len('_cards.json')] for p in glob.glob(os.path.join(DATA_DIR, '*_cards.json'))}
+                  | {os.path.basename(p)[:-len('_user_data.json')] for p in glob.glob(os.path.join(DATA_DIR, '*_user_data.json'))})
+
+def migrate_json_to_sqlite(path=SQLITE_PATH):
+    """Import every guild's JSON files (journal included) into a SQLite database."""
+    source = JsonStorage()
+    target = SqliteStorage(path)
+    guild_ids = json_guild_ids()
+    for guild_id in guild_ids:
+        cards, user_collections, user_data = source.load(guild_id)
+        black_market = source.load_black_market(guild_id)
+        link_listings(cards, black_market)
+        target.save(guild_id, cards, user_collections, user_data)
+        target.save_black_market(guild_id, black_market)
+        print(f'Migrated guild {guild_id}: {len(cards)} cards, {len(user_collections)} collections, {len(user_data)} users')
+    return guild_ids
+
+def migrate_card_ids():
+    """Rewrite every guild's JSON files so cards carry ids and collections hold only those ids."""
+    storage = JsonStorage()
+    guild_ids = json_guild_ids()
+    for guild_id in guild_ids:
+        generation = storage.seal(guild_id)
+        cards, user_collections, user_data = storage.load(guild_id)
+        black_market = storage.load_black_market(guild_id)
+        link_listings(cards, black_market)
+        storage.save(guild_id, cards, user_collections, user_data)
+        storage.save_black_market(guild_id, black_market)
+        storage.release(guild_id, generation)
+        print(f'Migrated guild {guild_id}: {len(cards)} cards')
+    return guild_ids
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ['migrate']:
+        migrate_json_to_sqlite()
+    elif sys.argv[1:] == ['migrate-ids']:
+        migrate_card_ids()
+    else:
+        print('Usage: python code/storage.py migrate | migrate-ids')
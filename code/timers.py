@@ -0,0 +1,142 @@
+import asyncio
+import heapq
+import itertools
+import os
+import time
+
+# Due callbacks are run by TIMER_WORKERS tasks, so a burst of expiring timers
+# never turns into a burst of concurrent coroutines.
+TIMER_WORKERS = int(os.getenv('NAPO_TIMER_WORKERS', '8'))
+
+
+class Timer:
+    """Handle returned by TimerService.schedule, used to cancel or reschedule the callback."""
+
+    __slots__ = ('when', 'callback', 'args', 'cancelled', 'fired')
+
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+        self.fired = False
+
+    @property
+    def active(self):
+        return not (self.cancelled or self.fired)
+
+
+class TimerService:
+    """One min-heap of deadlines for the whole process.
+
+    Instead of a sleeping coroutine per delayed action, callers schedule an
+    async callback and keep the returned Timer. A single task sleeps until the
+    earliest deadline and hands due timers to a fixed pool of workers.
+    Cancelled and rescheduled timers leave stale heap entries behind, which are
+    skipped when they come up and purged once they outnumber the live ones.
+    """
+
+    def __init__(self, workers=TIMER_WORKERS):
+        self.workers = workers
+        self.heap = []
+        self.counter = itertools.count()
+        self.pending = 0
+        self.fired = 0
+        self.errors = 0
+        self.total_lateness = 0.0
+        self.max_lateness = 0.0
+        self._queue = None
+        self._wakeup = None
+        self._tasks = []
+
+    def schedule(self, delay, callback, *args):
+        """Run await callback(*args) in delay seconds."""
+        timer = Timer(time.monotonic() + delay, callback, args)
+        self.pending += 1
+        self._push(timer)
+        return timer
+
+    def reschedule(self, timer, delay):
+        """Move a pending timer's deadline to delay seconds from now; a timer that fired or was cancelled stays that way."""
+        if not timer.active:
+            return timer
+        timer.when = time.monotonic() + delay
+        self._push(timer)
+        return timer
+
+    def cancel(self, timer):
+        if timer.active:
+            self.pending -= 1
+        # Also stops a timer that is due but still waiting for a worker.
+        timer.cancelled = True
+
+    def _push(self, timer):
+        if len(self.heap) > 2 * self.pending + 64:
+            self.heap = [entry for entry in self.heap if entry[2].active and entry[0] == entry[2].when]
+            heapq.heapify(self.heap)
+        heapq.heappush(self.heap, (timer.when, next(self.counter), timer))
+        if self._wakeup is not None and self.heap[0][2] is timer:
+            self._wakeup.set()
+
+    def _pop_due(self, now):
+        while self.heap and self.heap[0][0] <= now:
+            when, _, timer = heapq.heappop(self.heap)
+            # Entries left behind by cancel() or reschedule() no longer match their timer.
+            if timer.active and when == timer.when:
+                timer.fired = True
+                self.pending -= 1
+                self._queue.put_nowait((when, timer))
+
+    async def run(self):
+        while True:
+            timeout = max(0.0, self.heap[0][0] - time.monotonic()) if self.heap else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            self._pop_due(time.monotonic())
+
+    async def worker(self):
+        while True:
+            when, timer = await self._queue.get()
+            if timer.cancelled or when != timer.when:
+                continue
+            lateness = time.monotonic() - timer.when
+            self.fired += 1
+            self.total_lateness += lateness
+            self.max_lateness = max(self.max_lateness, lateness)
+            try:
+                await timer.callback(*timer.args)
+            except Exception as e:
+                self.errors += 1
+                print(f"Error in timer callback {getattr(timer.callback, '__name__', timer.callback)}: {e}")
+
+    def start(self):
+        if not self._tasks:
+            self._queue = asyncio.Queue()
+            self._wakeup = asyncio.Event()
+            self._tasks = [asyncio.create_task(self.run())] + [asyncio.create_task(self.worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        for task in self._tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._tasks = []
+
+    def stats(self):
+        return {
+            'pending': self.pending,
+            'queued': self._queue.qsize() if self._queue is not None else 0,
+            'fired': self.fired,
+            'errors': self.errors,
+            'avg_lateness_ms': self.total_lateness / self.fired * 1000 if self.fired else 0.0,
+            'max_lateness_ms': self.max_lateness * 1000,
+        }
+
+
+scheduler = TimerService()
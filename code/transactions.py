@@ -0,0 +1,105 @@
+import asyncio
+import time
+
+from persistence import manager as persistence
+
+
+class Transaction:
+    """One multi-entity change to a guild, used as `async with transactions.transaction(...) as tx`.
+
+    The users and cards it names are locked for the whole block, so checks
+    made inside it still hold when the changes are applied. Journal entries
+    added with record() are committed as a single batch when the block exits,
+    even if it raises half way, so the journal always matches memory.
+    """
+
+    def __init__(self, manager, guild_id, keys):
+        self.manager = manager
+        self.guild_id = guild_id
+        self.keys = keys
+        self.entries = []
+
+    def record(self, *entries):
+        self.entries.extend(entries)
+
+    async def __aenter__(self):
+        await self.manager.acquire(self.keys)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        try:
+            if self.entries:
+                persistence.record(self.guild_id, *self.entries)
+                self.manager.commits += 1
+        finally:
+            self.manager.release(self.keys)
+
+
+class TransactionManager:
+    """Per-entity asyncio locks for guild transactions.
+
+    Locks exist only while someone holds or waits for them. A transaction
+    takes its locks in one global order, so two transactions can never wait on
+    each other, and commands touching other users and cards are not blocked.
+    """
+
+    def __init__(self):
+        self.locks = {}
+        self.commits = 0
+        self.waits = 0
+        self.total_wait = 0.0
+
+    def transaction(self, guild_id, users=(), cards=()):
+        keys = [(guild_id, 'card', card_id) for card_id in sorted(set(cards))]
+        keys += [(guild_id, 'user', user_id) for user_id in sorted(set(users))]
+        return Transaction(self, guild_id, keys)
+
+    async def acquire(self, keys):
+        acquired = []
+        try:
+            for key in keys:
+                if key not in self.locks:
+                    self.locks[key] = [asyncio.Lock(), 0]
+                entry = self.locks[key]
+                entry[1] += 1
+                if entry[0].locked():
+                    self.waits += 1
+                    start = time.perf_counter()
+                    try:
+                        await entry[0].acquire()
+                    except BaseException:
+                        self._drop(key)
+                        raise
+                    self.total_wait += time.perf_counter() - start
+                else:
+                    await entry[0].acquire()
+                acquired.append(key)
+        except BaseException:
+            self.release(acquired)
+            raise
+
+    def _drop(self, key):
+        entry = self.locks[key]
+        entry[1] -= 1
+        if not entry[1]:
+            del self.locks[key]
+
+    def release(self, keys):
+        for key in reversed(keys):
+            self.locks[key][0].release()
+            self._drop(key)
+
+    def busy(self, guild_id):
+        """Whether a transaction on the guild is open or waiting for its locks."""
+        return any(key[0] == guild_id for key in self.locks)
+
+    def stats(self):
+        return {
+            'commits': self.commits,
+            'held_locks': len(self.locks),
+            'waits': self.waits,
+            'avg_wait_ms': self.total_wait / self.waits * 1000 if self.waits else 0.0,
+        }
+
+
+manager = TransactionManager()
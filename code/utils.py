@@ -1,62 +1,13 @@
-import json
-import os
+import time
 from datetime import datetime, timedelta
 
-DATA_DIR = 'data'
-if not os.path.exists(DATA_DIR):
-    os.makedirs(DATA_DIR)
+max_rolls_per_hour = 5
+max_claims_per_3_hours = 1
 
-def get_guild_data_file(guild_id, file_type):
-    return os.path.join(DATA_DIR, f'{guild_id}_{file_type}.json')
-
-def load_data(guild_id):
-    cards_file = get_guild_data_file(guild_id, 'cards')
-    collections_file = get_guild_data_file(guild_id, 'collections')
-    user_data_file = get_guild_data_file(guild_id, 'user_data')
-
-    try:
-        with open(cards_file, 'r') as f:
-            cards = json.load(f)
-    except FileNotFoundError:
-        cards = []
-
-    try:
-        with open(collections_file, 'r') as f:
-            user_collections = json.load(f)
-    except FileNotFoundError:
-        user_collections = {}
-
-    try:
-        with open(user_data_file, 'r') as f:
-            user_data = json.load(f)
-    except FileNotFoundError:
-        user_data = {}
-
-    for user in user_data.values():
-        if 'last_gem_time' not in user:
-            user['last_gem_time'] = (datetime.utcnow() - timedelta(hours=6)).isoformat()
-        if 'wishes' not in user:
-            user['wishes'] = []
-            
-    return cards, user_collections, user_data
-
-def save_data(guild_id, cards, user_collections, user_data):
-    cards_file = get_guild_data_file(guild_id, 'cards')
-    collections_file = get_guild_data_file(guild_id, 'collections')
-    user_data_file = get_guild_data_file(guild_id, 'user_data')
-
-    with open(cards_file, 'w') as f:
-        json.dump(cards, f, indent=4)
-
-    with open(collections_file, 'w') as f:
-        json.dump(user_collections, f, indent=4)
-
-    with open(user_data_file, 'w') as f:
-        json.dump(user_data, f, indent=4)
+RANK_ORDER = {'SS': 0, 'S': 1, 'A': 2, 'B': 3, 'C': 4, 'D': 5, 'E': 6}
 
 def rank_sort_key(card):
-    rank_order = {'SS': 0, 'S': 1, 'A': 2, 'B': 3, 'C': 4, 'D': 5, 'E': 6}
-    return rank_order.get(card['rank'], 7)
+    return RANK_ORDER.get(card['rank'], 7)
 
 def get_time_until_next_reset():
     now = datetime.utcnow()
@@ -66,25 +17,27 @@ def get_time_until_next_reset():
         next_reset_time += timedelta(days=1)
     return next_reset_time - now
 
-def get_black_market_file(guild_id):
-    return os.path.join(DATA_DIR, f'{guild_id}_black_market.json')
+def roll_window():
+    """The current roll window: hours since the epoch."""
+    return int(time.time() // 3600)
 
-def load_black_market(guild_id):
-    black_market_file = get_black_market_file(guild_id)
-    try:
-        with open(black_market_file, 'r') as f:
-            black_market = json.load(f)
-    except FileNotFoundError:
-        black_market = {}
-    return black_market
+def claim_window():
+    """The current claim window: the hour starting the 3-hour block get_time_until_next_reset ends."""
+    hour = roll_window()
+    return hour - hour % 3
 
-def save_black_market(guild_id, black_market):
-    black_market_file = get_black_market_file(guild_id)
-    with open(black_market_file, 'w') as f:
-        json.dump(black_market, f, indent=4)
+def quota_left(user, key, limit, window):
+    """Uses left of a quota stored as (count, window start); a count from an earlier window is refilled on access."""
+    if user.get(f'{key}_window') != window:
+        user[key] = limit
+        user[f'{key}_window'] = window
+    return user[key]
 
+def rolls_left(user):
+    return quota_left(user, 'rolls', max_rolls_per_hour, roll_window())
 
-scores = {}
+def claims_left(user):
+    return quota_left(user, 'claims', max_claims_per_3_hours, claim_window())
 
 quiz_data = {
     'Naruto': 'https://www.youtube.com/watch?v=4t__wczfpRI',
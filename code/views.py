@@ -1,8 +1,13 @@
 import discord
 from datetime import datetime, timedelta
 from discord.ext import commands
-from utils import save_data, get_time_until_next_reset
+from utils import get_time_until_next_reset, claims_left
+from config import guild_data
+from transactions import manager as transactions
+from members import members
+import journal
 import random
+from functools import partial
 
 def get_gem_value():
     probabilities = [0.6, 0.3, 0.1]
@@ -14,78 +19,95 @@ def get_gem_value():
 
 
 class ClaimButton(discord.ui.Button):
-    def __init__(self, guild_id, card, user_data, user_collections, cards):
+    def __init__(self, guild_id, card):
         super().__init__(label="🐷", style=discord.ButtonStyle.primary)
         self.guild_id = guild_id
-        self.card = card
-        self.user_data = user_data
-        self.user_collections = user_collections
-        self.cards = cards
+        self.card_id = card['id']
 
     async def callback(self, interaction: discord.Interaction):
         user_id = str(interaction.user.id)
         time_until_reset = get_time_until_next_reset()
 
-        if self.user_data[user_id]['claims'] == 0:
-            await interaction.response.send_message(f"You can only claim once every 3 hours. The next reset is in **{time_until_reset.seconds // 3600}h {time_until_reset.seconds % 3600 // 60}m**.", ephemeral=True)
+        # The guild may have been evicted and reloaded since the roll, so only its live state is changed
+        state = await guild_data.load(self.guild_id)
+        card = state.cards_by_id.get(self.card_id)
+        if card is None:
+            await interaction.response.send_message("This card no longer exists.", ephemeral=True)
             return
-
-        if self.card['claimed_by']:
-            await interaction.response.send_message(f"This card is already claimed by **<@{self.card['claimed_by']}>**. You receive **100** <:bluegem:1246468408963367003>!", ephemeral=True)
-            self.user_data.setdefault(user_id, {}).setdefault('coins', 0)
-            self.user_data[user_id]['coins'] += 100
+        user_data = state.user_data
+
+        async with transactions.transaction(self.guild_id, users=[user_id], cards=[card['id']]) as tx:
+            if claims_left(user_data[user_id]) == 0:
+                claimed = None
+            elif card['claimed_by']:
+                claimed = False
+                owner_id = card['claimed_by']
+                user_data[user_id]['coins'] += 100
+                tx.record(journal.coins(user_id, user_data[user_id], 100))
+            else:
+                claimed = True
+                state.collect(user_id, card)
+                user_data[user_id]['claims'] = 0
+                tx.record(journal.update_card(card, 'claimed_by'), journal.collect(user_id, card), journal.update_user(user_id, user_data[user_id], 'claims', 'claims_window'))
+
+        if claimed is None:
+            await interaction.response.send_message(f"You can only claim once every 3 hours. The next reset is in **{time_until_reset.seconds // 3600}h {time_until_reset.seconds % 3600 // 60}m**.", ephemeral=True)
+        elif not claimed:
+            await interaction.response.send_message(f"This card is already claimed by **<@{owner_id}>**. You receive **100** <:bluegem:1246468408963367003>!", ephemeral=True)
         else:
-            self.card['claimed_by'] = user_id
-            self.user_collections.setdefault(user_id, []).append(self.card)
-            await interaction.response.send_message(f"You have claimed **{self.card['name']}**!", ephemeral=True)
-            embed = discord.Embed(title=self.card['name'], description=self.card['description'], color=discord.Color.red())
-            embed.add_field(name=f"{self.card['rank']} • {self.card['value']} <:bluegem:1246468408963367003>", value="")
-            embed.set_image(url=self.card['image_urls'][0])
-            user = await interaction.guild.fetch_member(user_id)
+            await interaction.response.send_message(f"You have claimed **{card['name']}**!", ephemeral=True)
+            embed = discord.Embed(title=card['name'], description=card['description'], color=discord.Color.red())
+            embed.add_field(name=f"{card['rank']} • {card['value']} <:bluegem:1246468408963367003>", value="")
+            embed.set_image(url=card['image_urls'][0])
+            user = await members.get(interaction.guild, user_id)
             claimed_by = f'Claimed by {user.display_name}'
-            profile_url = user.avatar.url if user.avatar else user.default_avatar.url
+            profile_url = user.avatar_url
             embed.set_footer(text=claimed_by, icon_url=profile_url)
-            self.user_data[user_id]['claims'] = 0
 
             await interaction.message.edit(embed=embed, view=None)
 
-        save_data(self.guild_id, self.cards, self.user_collections, self.user_data)
-
 class GemButton(discord.ui.Button):
-    def __init__(self, guild_id, card, user_data, user_collections, cards):
+    def __init__(self, guild_id, card):
         gem_value, gem_color = get_gem_value()
         super().__init__(label="", emoji=gem_color, style=discord.ButtonStyle.primary)
         self.guild_id = guild_id
-        self.card = card
-        self.user_data = user_data
-        self.user_collections = user_collections
-        self.cards = cards
+        self.card_id = card['id']
         self.gem_value = gem_value
 
     async def callback(self, interaction: discord.Interaction):
         user_id = str(interaction.user.id)
         now = datetime.utcnow()
+
+        state = await guild_data.load(self.guild_id)
+        card = state.cards_by_id.get(self.card_id)
+        if card is None:
+            await interaction.response.send_message("This card no longer exists.", ephemeral=True)
+            return
+        user_data = state.user_data
         
-        if 'last_gem_time' not in self.user_data[user_id]:
-            self.user_data[user_id]['last_gem_time'] = (now - timedelta(hours=6)).isoformat()
+        async with transactions.transaction(self.guild_id, users=[user_id], cards=[card['id']]) as tx:
+            if 'last_gem_time' not in user_data[user_id]:
+                user_data[user_id]['last_gem_time'] = (now - timedelta(hours=6)).isoformat()
 
-        last_gem_time = datetime.fromisoformat(self.user_data[user_id]['last_gem_time'])
-        if now - last_gem_time < timedelta(hours=5):
+            last_gem_time = datetime.fromisoformat(user_data[user_id]['last_gem_time'])
             time_left = timedelta(hours=5) - (now - last_gem_time)
+            already_claimed = card.get('gem_claimed', False)
+            if time_left <= timedelta(0) and not already_claimed:
+                card['gem_claimed'] = True
+                user_data[user_id]['coins'] += self.gem_value
+                user_data[user_id]['last_gem_time'] = now.isoformat()
+                tx.record(journal.update_card(card, 'gem_claimed'), journal.coins(user_id, user_data[user_id], self.gem_value), journal.update_user(user_id, user_data[user_id], 'last_gem_time'))
+
+        if time_left > timedelta(0):
             hours, remainder = divmod(time_left.seconds, 3600)
             minutes, _ = divmod(remainder, 60)
             await interaction.response.send_message(f"You can claim another gem in {hours}h {minutes}m.", ephemeral=True)
             return
         
-        if self.card.get('gem_claimed', False):
+        if already_claimed:
             await interaction.response.send_message(f"This card's gem has already been claimed.", ephemeral=True)
             return
         
-        self.card['gem_claimed'] = True
-        self.user_data[user_id]['coins'] += self.gem_value
-        self.user_data[user_id]['last_gem_time'] = now.isoformat()
-
-        save_data(self.guild_id, self.cards, self.user_collections, self.user_data)
         await interaction.response.send_message(f"You received {self.gem_value} coins from the gem <:bluegem:1246468408963367003>!", ephemeral=True)
         embed = interaction.message.embeds[0]
         embed.add_field(name="Gem Claimed", value=f"{self.gem_value} coins received", inline=False)
@@ -115,9 +137,9 @@ class Paginator(discord.ui.View):
         embed.color = discord.Color.red() if card['claimed_by'] else discord.Color.orange()
 
         if card["claimed_by"]:
-            user = await ctx_or_interaction.guild.fetch_member(card["claimed_by"])
+            user = await members.get(ctx_or_interaction.guild, card["claimed_by"])
             claimed_by = f'Claimed by {user.display_name}'
-            profile_url = user.avatar.url if user.avatar else user.default_avatar.url
+            profile_url = user.avatar_url
             embed.set_footer(text=f'{self.current_page + 1}/{len(self.collection)} • {claimed_by}', icon_url=profile_url)
         else:
             embed.set_footer(text=f'{self.current_page + 1}/{len(self.collection)} • Not claimed')
@@ -157,9 +179,9 @@ class GlobalPaginator(discord.ui.View):
         embed.set_image(url=card["image_urls"][0])
 
         if card["claimed_by"]:
-            user = await ctx_or_interaction.guild.fetch_member(card["claimed_by"])
+            user = await members.get(ctx_or_interaction.guild, card["claimed_by"])
             claimed_by = f'Claimed by {user.display_name}'
-            profile_url = user.avatar.url if user.avatar else user.default_avatar.url
+            profile_url = user.avatar_url
             embed.set_footer(text=f'{self.current_page + 1}/{len(self.collection)} • {claimed_by}', icon_url=profile_url)
         else:
             embed.set_footer(text=f'{self.current_page + 1}/{len(self.collection)} • Not claimed')
@@ -199,9 +221,9 @@ class ImagePaginator(discord.ui.View):
         embed.add_field(name=f"{self.card['rank']} • {self.card['value']} <:bluegem:1246468408963367003>", value="")
 
         if self.card["claimed_by"]:
-            user = await ctx_or_interaction.guild.fetch_member(self.card["claimed_by"])
+            user = await members.get(ctx_or_interaction.guild, self.card["claimed_by"])
             claimed_by = f'Claimed by {user.display_name}'
-            profile_url = user.avatar.url if user.avatar else user.default_avatar.url
+            profile_url = user.avatar_url
             embed.set_footer(text=f'{self.current_image + 1}/{len(self.card["image_urls"])} • {claimed_by}', icon_url=profile_url)
         else:
             embed.set_footer(text=f'{self.current_image + 1}/{len(self.card["image_urls"])} • Not claimed')
@@ -222,51 +244,42 @@ class ImagePaginator(discord.ui.View):
         embed = await self.create_embed(interaction)
         await interaction.response.edit_message(embed=embed, view=self)
 
-class TopPaginator(discord.ui.View):
-    def __init__(self, guild_id, collection, current_page=0):
-        super().__init__(timeout=60)
-        self.guild_id = guild_id
-        self.collection = collection
-        self.current_page = current_page
-        self.items_per_page = 10
+def paginate(lines, items_per_page=10):
+    """Join lines into page bodies; there is always at least one, possibly empty, page."""
+    return ['\n'.join(lines[i:i + items_per_page]) for i in range(0, len(lines), items_per_page)] or ['']
 
-    async def send_initial_message(self, ctx_or_interaction):
-        embed = self.create_embed()
-        if isinstance(ctx_or_interaction, commands.Context):
-            await ctx_or_interaction.send(embed=embed, view=self)
-        else:
-            await ctx_or_interaction.response.send_message(embed=embed, view=self)
+def top_pages(state):
+    return state.cached('top_pages', ('cards',), lambda: paginate(
+        [f"**({card['rank']})** • {card['name']} {'❤️' if card['claimed_by'] else ''}" for card in state.sorted_cards()]))
 
-    def create_embed(self):
-        start_index = self.current_page * self.items_per_page
-        end_index = start_index + self.items_per_page
-        total_pages = (len(self.collection) + self.items_per_page - 1) // self.items_per_page
-        top_list = '\n'.join([f"**({card['rank']})** • {card['name']} {'❤️' if card['claimed_by'] else ''}" for card in self.collection[start_index:end_index]])
-        embed = discord.Embed(title="<:naporight:1246789280211406888> • Top Characters", description=top_list)
-        embed.set_thumbnail(url=self.collection[0]['image_urls'][0])
-        embed.set_footer(text=f"Page {self.current_page + 1} of {total_pages}")
-        return embed
+def collection_pages(state, user_id):
+    return state.cached(('collection_pages', user_id), ('cards', 'collections'), lambda: paginate(
+        [f"**({card['rank']})** • {card['name']} - *{card['description']}*" for card in state.user_collections.get(user_id, [])]))
 
-    @discord.ui.button(label="", emoji="<:left:1246472391052234762>", style=discord.ButtonStyle.secondary)
-    async def previous_page(self, interaction: discord.Interaction, button: discord.ui.Button):
-        self.current_page = (self.current_page - 1) % ((len(self.collection) + self.items_per_page - 1) // self.items_per_page)
-        embed = self.create_embed()
-        await interaction.response.edit_message(embed=embed, view=self)
+def black_market_pages(state):
+    return state.cached('black_market_pages', ('cards', 'black_market'), lambda: paginate(
+        [f"**{item['character']['name']}** - {item['price']} coins (Seller: <@{item['seller_id']}>)" for item in state.black_market.view()]))
 
-    @discord.ui.button(label="", emoji="<:right:1246472426410217594>", style=discord.ButtonStyle.secondary)
-    async def next_page(self, interaction: discord.Interaction, button: discord.ui.Button):
-        self.current_page = (self.current_page + 1) % ((len(self.collection) + self.items_per_page - 1) // self.items_per_page)
-        embed = self.create_embed()
-        await interaction.response.edit_message(embed=embed, view=self)
 
-class CollectionPaginator(discord.ui.View):
-    def __init__(self, guild_id, collection, member, current_page=0):
+class PageCachePaginator(discord.ui.View):
+    """Flips through page bodies rendered once per guild data version and shared by every open view.
+
+    build_pages returns the current page bodies; it is called on every flip,
+    so the pages follow the guild data while the view is open.
+    """
+
+    def __init__(self, guild_id, state, build_pages, current_page=0):
         super().__init__(timeout=60)
         self.guild_id = guild_id
-        self.collection = collection
+        self.state = state
+        self.build_pages = build_pages
         self.current_page = current_page
-        self.items_per_page = 10
-        self.member = member
+
+    def pages(self):
+        return self.build_pages()
+
+    def decorate(self, embed):
+        pass
 
     async def send_initial_message(self, ctx_or_interaction):
         embed = self.create_embed()
@@ -276,60 +289,50 @@ class CollectionPaginator(discord.ui.View):
             await ctx_or_interaction.response.send_message(embed=embed, view=self)
 
     def create_embed(self):
-        start_index = self.current_page * self.items_per_page
-        end_index = start_index + self.items_per_page
-        total_pages = (len(self.collection) + self.items_per_page - 1) // self.items_per_page
-        collection_list = '\n'.join([f"**({card['rank']})** • {card['name']} - *{card['description']}*" for card in self.collection[start_index:end_index]])
-        embed = discord.Embed(title=f"<:naporight:1246789280211406888> • {self.member.display_name}'s Collection", description=collection_list)
-        embed.set_thumbnail(url=self.collection[0]['image_urls'][0])
-        embed.set_footer(text=f"Page {self.current_page + 1} of {total_pages}")
+        pages = self.pages()
+        self.current_page %= len(pages)
+        embed = discord.Embed(title=self.title, description=pages[self.current_page])
+        self.decorate(embed)
+        embed.set_footer(text=f"Page {self.current_page + 1} of {len(pages)}")
         return embed
 
     @discord.ui.button(label="", emoji="<:left:1246472391052234762>", style=discord.ButtonStyle.secondary)
     async def previous_page(self, interaction: discord.Interaction, button: discord.ui.Button):
-        self.current_page = (self.current_page - 1) % ((len(self.collection) + self.items_per_page - 1) // self.items_per_page)
+        self.current_page = (self.current_page - 1) % len(self.pages())
         embed = self.create_embed()
         await interaction.response.edit_message(embed=embed, view=self)
 
     @discord.ui.button(label="", emoji="<:right:1246472426410217594>", style=discord.ButtonStyle.secondary)
     async def next_page(self, interaction: discord.Interaction, button: discord.ui.Button):
-        self.current_page = (self.current_page + 1) % ((len(self.collection) + self.items_per_page - 1) // self.items_per_page)
+        self.current_page = (self.current_page + 1) % len(self.pages())
         embed = self.create_embed()
         await interaction.response.edit_message(embed=embed, view=self)
 
-class BlackMarketPaginator(discord.ui.View):
-    def __init__(self, guild_id, black_market, current_page=0):
-        super().__init__(timeout=60)
-        self.guild_id = guild_id
-        self.black_market = black_market
-        self.current_page = current_page
-        self.items_per_page = 10
+class TopPaginator(PageCachePaginator):
+    title = "<:naporight:1246789280211406888> • Top Characters"
 
-    async def send_initial_message(self, ctx_or_interaction):
-        embed = self.create_embed()
-        if isinstance(ctx_or_interaction, commands.Context):
-            await ctx_or_interaction.send(embed=embed, view=self)
-        else:
-            await ctx_or_interaction.response.send_message(embed=embed, view=self)
+    def __init__(self, guild_id, state, current_page=0):
+        super().__init__(guild_id, state, partial(top_pages, state), current_page)
 
-    def create_embed(self):
-        start_index = self.current_page * self.items_per_page
-        end_index = start_index + self.items_per_page
-        total_pages = (len(self.black_market) + self.items_per_page - 1) // self.items_per_page
-        listings = list(self.black_market.values())[start_index:end_index]
-        listings_text = [f"**{item['character']['name']}** - {item['price']} coins (Seller: <@{item['seller_id']}>)" for item in listings]
-        embed = discord.Embed(title="<:naporight:1246789280211406888> • Black Market Listings", description="\n".join(listings_text))
-        embed.set_footer(text=f"Page {self.current_page + 1} of {total_pages}")
-        return embed
+    def decorate(self, embed):
+        cards = self.state.sorted_cards()
+        if cards:
+            embed.set_thumbnail(url=cards[0]['image_urls'][0])
 
-    @discord.ui.button(label="", emoji="<:left:1246472391052234762>", style=discord.ButtonStyle.secondary)
-    async def previous_page(self, interaction: discord.Interaction, button: discord.ui.Button):
-        self.current_page = (self.current_page - 1) % ((len(self.black_market) + self.items_per_page - 1) // self.items_per_page)
-        embed = self.create_embed()
-        await interaction.response.edit_message(embed=embed, view=self)
+class CollectionPaginator(PageCachePaginator):
+    def __init__(self, guild_id, state, member, current_page=0):
+        super().__init__(guild_id, state, partial(collection_pages, state, str(member.id)), current_page)
+        self.member = member
+        self.user_id = str(member.id)
+        self.title = f"<:naporight:1246789280211406888> • {member.display_name}'s Collection"
 
-    @discord.ui.button(label="", emoji="<:right:1246472426410217594>", style=discord.ButtonStyle.secondary)
-    async def next_page(self, interaction: discord.Interaction, button: discord.ui.Button):
-        self.current_page = (self.current_page + 1) % ((len(self.black_market) + self.items_per_page - 1) // self.items_per_page)
-        embed = self.create_embed()
-        await interaction.response.edit_message(embed=embed, view=self)
+    def decorate(self, embed):
+        collection = self.state.user_collections.get(self.user_id)
+        if collection:
+            embed.set_thumbnail(url=collection[0]['image_urls'][0])
+
+class BlackMarketPaginator(PageCachePaginator):
+    title = "<:naporight:1246789280211406888> • Black Market Listings"
+
+    def __init__(self, guild_id, state, current_page=0):
+        super().__init__(guild_id, state, partial(black_market_pages, state), current_page)